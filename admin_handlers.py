@@ -1,4 +1,3 @@
-import asyncio
 import logging
 
 from aiogram import Bot, F, Router, types
@@ -12,14 +11,12 @@ from aiogram.utils.keyboard import InlineKeyboardBuilder
 
 from core.states import AdminAmbassador, AdminStates, IsAdminFilter
 from database import (
-    confirm_referral_payouts, get_all_ambassadors,
-    get_all_users, get_bot_statistics,
-    get_pending_payouts_count, get_referral_stats, get_bulk_referral_stats,
-    get_subscription_stats, get_user_by_username,
+    confirm_referral_payouts, get_admin_statistics, get_ambassador_leaderboard,
+    get_user_by_username,
     get_user_detailed_stats, give_subscription_to_user,
-    revoke_subscription, set_ambassador_status,
-    get_subscribed_users, get_unsubscribed_users  # For targeted broadcast
+    revoke_subscription, set_ambassador_status
 )
+from core import broadcast
 
 logger = logging.getLogger(__name__)
 admin_router = Router()
@@ -89,26 +86,24 @@ async def handle_admin_panel(callback: types.CallbackQuery, state: FSMContext):
 async def handle_admin_stats(callback: types.CallbackQuery):
     """Показывает расширенную статистику бота."""
     try:
-        bot_stats = await get_bot_statistics()
-        sub_stats = await get_subscription_stats()
-        pending_payouts = await get_pending_payouts_count()
+        stats = await get_admin_statistics()
 
         # Формируем детальную строку по подпискам
-        other_subs_line = f"\n   - Другие (старые/неопределенные): <b>{sub_stats['total_other']}</b>" if sub_stats['total_other'] > 0 else ""
+        other_subs_line = f"\n   - Другие (старые/неопределенные): <b>{stats['total_other']}</b>" if stats['total_other'] > 0 else ""
         
         stats_text = (
             f"<b>📊 Статистика Бота</b>\n\n"
             f"<b>Общее:</b>\n"
-            f"- Всего пользователей: <b>{bot_stats['total_users']}</b>\n"
-            f"- Амбассадоры (ожидают выплаты): <b>{pending_payouts}</b>\n\n"
+            f"- Всего пользователей: <b>{stats['total_users']}</b>\n"
+            f"- Амбассадоры (ожидают выплаты): <b>{stats['pending_payouts']}</b>\n\n"
             f"<b>Подписки:</b>\n"
-            f"- Всего активных: <b>{sub_stats['total_active']}</b>\n"
-            f"   - Купленные: <b>{sub_stats['total_purchased']}</b>\n"
-            f"   - Выданные админом: <b>{sub_stats['total_granted']}</b>{other_subs_line}\n\n"
+            f"- Всего активных: <b>{stats['total_active']}</b>\n"
+            f"   - Купленные: <b>{stats['total_purchased']}</b>\n"
+            f"   - Выданные админом: <b>{stats['total_granted']}</b>{other_subs_line}\n\n"
             f"<b>Динамика (новые активные подписки):</b>\n"
-            f"- За 24 часа: <b>{sub_stats['new_24h']}</b>\n"
-            f"- За 48 часов: <b>{sub_stats['new_48h']}</b>\n"
-            f"- За 7 дней: <b>{sub_stats['new_7d']}</b>\n"
+            f"- За 24 часа: <b>{stats['new_24h']}</b>\n"
+            f"- За 48 часов: <b>{stats['new_48h']}</b>\n"
+            f"- За 7 дней: <b>{stats['new_7d']}</b>\n"
         )
 
         await callback.message.edit_text(
@@ -149,7 +144,8 @@ async def confirm_payouts(callback: types.CallbackQuery):
 @admin_router.callback_query(F.data == "list_ambassadors")
 async def list_ambassadors(callback: types.CallbackQuery, should_answer: bool = True):
     """Displays a list of all ambassadors with their stats."""
-    ambassadors = await get_all_ambassadors()
+    # Рейтинг по оплатившим; счётчики уже лежат в строках амбассадоров
+    ambassadors = await get_ambassador_leaderboard()
     if not ambassadors:
         await callback.answer("Список амбассадоров пуст.", show_alert=True)
         return
@@ -157,15 +153,11 @@ async def list_ambassadors(callback: types.CallbackQuery, should_answer: bool =
     response_text = "<b>👑 Список Амбассадоров:</b>\n\n"
     keyboard = InlineKeyboardBuilder()
 
-    # Получаем статистику одним запросом для оптимизации
-    stats_map = await get_bulk_referral_stats([a.id for a in ambassadors])
-
     for amb in ambassadors:
-        stats = stats_map.get(amb.id, {})
         username = f"@{amb.username}" if amb.username else f"ID: {amb.id}"
-        pending = stats.get("pending_payouts", 0)
-        paid = stats.get("total_paid_referrals", 0)
-        total_clicks = stats.get("total_referred", 0)
+        pending = amb.pending_payouts_count
+        paid = amb.paid_referrals_count
+        total_clicks = amb.referred_count
 
         response_text += (
             f"<b>{username}</b>\n"
@@ -323,42 +315,25 @@ async def process_broadcast_audience(callback: types.CallbackQuery, state: FSMCo
 
 @admin_router.message(StateFilter(AdminStates.BROADCAST_MESSAGE), F.text)
 async def process_broadcast_message(message: types.Message, state: FSMContext, bot: Bot):
-    """Обрабатывает сообщение для рассылки и отправляет его выбранной аудитории."""
+    """Запускает рассылку выбранной аудитории фоновой задачей с прогрессом в отдельном сообщении."""
     broadcast_text = message.text
     user_data = await state.get_data()
     audience = user_data.get('audience')
     await state.clear()
 
-    users = []
-    audience_text = ""
-    if audience == 'all':
-        users = await get_all_users()
-        audience_text = "всем пользователям"
-    elif audience == 'subscribed':
-        users = await get_subscribed_users()
-        audience_text = "пользователям с подпиской"
-    elif audience == 'unsubscribed':
-        users = await get_unsubscribed_users()
-        audience_text = "пользователям без подписки"
-
-    if not users:
+    job_id = await broadcast.start_broadcast(bot, audience, broadcast_text, message.chat.id)
+    if not job_id:
         await message.answer("Не найдено пользователей для данной аудитории.")
-        await message.answer("👑 <b>Админ-панель</b> 👑", reply_markup=get_admin_panel_keyboard())
-        return
-
-    sent_count = 0
-    failed_count = 0
+    await message.answer("👑 <b>Админ-панель</b> 👑", reply_markup=get_admin_panel_keyboard())
 
-    await message.answer(f"Начинаю рассылку {audience_text}... Всего получателей: {len(users)}")
 
-    for user in users:
-        try:
-            await bot.send_message(user.id, broadcast_text)
-            sent_count += 1
-            await asyncio.sleep(0.05)  # Небольшая задержка, чтобы не спамить API
-        except Exception as e:
-            logger.warning(f"Не удалось отправить сообщение пользователю {user.id}: {e}")
-            failed_count += 1
+@admin_router.callback_query(F.data.startswith("brdjob_"))
+async def control_broadcast(callback: types.CallbackQuery, bot: Bot):
+    """Пауза, продолжение и остановка рассылки из сообщения с прогрессом."""
+    _, action, job_id = callback.data.split('_', 2)
+    status = {"pause": broadcast.PAUSED, "resume": broadcast.RUNNING, "cancel": broadcast.CANCELLED}[action]
+    if await broadcast.set_status(bot, job_id, status):
+        await callback.answer()
+    else:
+        await callback.answer("Рассылка уже завершена.", show_alert=True)
 
-    await message.answer(f"✅ Рассылка завершена!\n\nОтправлено: {sent_count}\nНе удалось отправить: {failed_count}")
-    await message.answer("👑 <b>Админ-панель</b> 👑", reply_markup=get_admin_panel_keyboard())
@@ -1,34 +1,8 @@
 import json
 from typing import Dict, Any
 
-from core.integrations.deepseek import get_deepseek_response as get_ai_answer
-
-def get_system_prompt_from_context(file_path: str = 'context.md') -> str:
-    """
-    Reads the system prompt from the context.md file.
-
-    Args:
-        file_path: The path to the context file.
-
-    Returns:
-        The extracted system prompt as a string.
-    """
-    try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-        
-        # Extract the prompt section
-        prompt_start = content.find('# === SYSTEM PROMPT FOR DeepSeek ===')
-        if prompt_start == -1:
-            return ""  # Or raise an error
-        
-        prompt_text = content[prompt_start:]
-        # Clean up the header
-        prompt_text = prompt_text.split('\n', 1)[1].strip()
-        return prompt_text
-    except FileNotFoundError:
-        # Fallback or error handling
-        return "" 
+from core import prompts
+from core.integrations.deepseek import DEEPSEEK_REPORT_TIMEOUT, deepseek_client
 
 async def create_report_for_user(metrics: Dict[str, Any]) -> str:
     """
@@ -46,12 +20,20 @@ async def create_report_for_user(metrics: Dict[str, Any]) -> str:
     # Формируем финальный промпт для пользователя, который будет передан AI
     user_prompt = f"Проанализируй эти метрики и составь отчет, следуя всем инструкциям из системного промпта:\n{user_metrics_json}"
 
-    # Получаем ответ от AI
-    system_prompt = get_system_prompt_from_context()
+    # Получаем ответ от AI; промпт из context.md читается один раз при загрузке реестра
+    system_prompt = prompts.CONTEXT_REPORT.text
     if not system_prompt:
         # Handle case where prompt could not be loaded
         return "Ошибка: не удалось загрузить системный промпт для анализа."
 
-    ai_response = await get_ai_answer(system_prompt, user_prompt)
+    ai_response = await deepseek_client.complete(
+        [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt},
+        ],
+        timeout=DEEPSEEK_REPORT_TIMEOUT,
+        prompt=prompts.CONTEXT_REPORT.label,
+        model="deepseek-chat",
+    )
 
     return ai_response
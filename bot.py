@@ -16,10 +16,13 @@ from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_applicati
 from aiohttp import web
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from database import get_session, create_db_and_tables
-from models import User, Session, SessionStatus
+from database import get_session, create_db_and_tables, reserve_quota, release_quota
+from models import QuotaKind, User, Session, SessionStatus
 from validators import validate_front_photo, validate_profile_photo, validate_image_quality
-from task_queue import task_queue, init_queue
+from task_queue import AnalysisScheduler
+from core import entitlements
+from core.redis_client import get_redis
+from core.session_events import listen_session_events
 from payments import payment_manager
 from dotenv import load_dotenv
 
@@ -46,6 +49,8 @@ if not BOT_TOKEN:
 bot = Bot(token=BOT_TOKEN)
 storage = MemoryStorage()
 dp = Dispatcher(storage=storage)
+analysis_scheduler = AnalysisScheduler(get_redis())
+session_events_task: Optional[asyncio.Task] = None
 
 
 class PhotoStates(StatesGroup):
@@ -233,24 +238,44 @@ async def handle_photo(message: Message, state: FSMContext):
             await state.clear()
             return
         
-        # Create session
-        async for db_session in get_session():
-            session = Session(
-                user_id=user.id,
-                front_file_id=front_file_id,
-                profile_file_id=photo.file_id,
-                status=SessionStatus.PENDING
-            )
-            db_session.add(session)
-            await db_session.commit()
-            await db_session.refresh(session)
-            
-            # Enqueue for processing
-            await task_queue.enqueue(session.id)
-            
-            # Update user quotas
-            user.analyses_left -= 1
-            await db_session.commit()
+        # Reserve the analysis up front; the worker commits it or gives it back
+        reservation_id = await reserve_quota(user.id, QuotaKind.ANALYSIS)
+        if reservation_id is None:
+            await message.answer("❌ У вас закончились анализы. Используйте /renew для продления.")
+            await state.clear()
+            return
+        
+        # Create the session and enqueue it; a failure before the worker has the task gives the analysis back
+        submitted = False
+        try:
+            async for db_session in get_session():
+                session = Session(
+                    user_id=user.id,
+                    front_file_id=front_file_id,
+                    profile_file_id=photo.file_id,
+                    status=SessionStatus.PENDING
+                )
+                db_session.add(session)
+                await db_session.commit()
+                await db_session.refresh(session)
+
+                # The worker reports the result through a session event
+                await analysis_scheduler.submit(
+                    {
+                        "session_id": session.id,
+                        "user_id": user.id,
+                        "chat_id": message.chat.id,
+                        "front_photo_id": front_file_id,
+                        "profile_photo_id": photo.file_id,
+                        "reservation_id": reservation_id,
+                    },
+                    priority="paid",
+                )
+                submitted = True
+        except Exception:
+            if not submitted:
+                await release_quota(reservation_id)
+            raise
         
         await state.clear()
         
@@ -260,47 +285,25 @@ async def handle_photo(message: Message, state: FSMContext):
             "🔬 Обрабатываем ваши фото с помощью ИИ\n\n"
             "Результат придёт автоматически!"
         )
-        
-        # Start checking for results
-        asyncio.create_task(check_session_result(message.from_user.id, session.id))
 
 
-async def check_session_result(user_id: int, session_id: int):
-    """Check session result and send when ready."""
-    max_attempts = 60  # 5 minutes max
-    attempt = 0
+async def handle_session_event(event: Dict[str, Any]):
+    """Send the session result as soon as the worker reports it."""
+    user_id = event["user_id"]
+    result = event.get("result") or {}
     
-    while attempt < max_attempts:
-        await asyncio.sleep(5)  # Check every 5 seconds
-        attempt += 1
-        
-        async for db_session in get_session():
-            session = await db_session.get(Session, session_id)
-            
-            if session.status == SessionStatus.DONE and session.result_json:
-                # Send results
-                report = session.result_json.get("report", "Отчёт не найден")
-                metrics = session.result_json.get("metrics", {})
-                
-                await bot.send_message(
-                    user_id,
-                    f"🎉 <b>Анализ готов!</b>\n\n{report}",
-                    parse_mode="HTML"
-                )
-                return
-            
-            elif session.status == SessionStatus.FAILED:
-                await bot.send_message(
-                    user_id,
-                    "❌ Произошла ошибка при анализе. Попробуйте ещё раз или обратитесь в поддержку."
-                )
-                return
-    
-    # Timeout
-    await bot.send_message(
-        user_id,
-        "⏰ Анализ занимает больше времени, чем обычно. Результат придёт позже."
-    )
+    if event["status"] == SessionStatus.DONE.value:
+        report = result.get("report", "Отчёт не найден")
+        await bot.send_message(
+            user_id,
+            f"🎉 <b>Анализ готов!</b>\n\n{report}",
+            parse_mode="HTML"
+        )
+    elif event["status"] == SessionStatus.FAILED.value:
+        await bot.send_message(
+            user_id,
+            f"❌ {result.get('error') or 'Произошла ошибка при анализе. Попробуйте ещё раз или обратитесь в поддержку.'}"
+        )
 
 
 @dp.message(F.text)
@@ -348,6 +351,7 @@ async def payment_webhook_handler(request):
                     user.analyses_left = 3
                     user.messages_left = 200
                     await db_session.commit()
+                    await entitlements.invalidate(user_id)
                     
                     # Notify user
                     await bot.send_message(
@@ -374,8 +378,9 @@ async def on_startup():
     # Initialize database
     await create_db_and_tables()
     
-    # Initialize queue
-    await init_queue()
+    # Listen for finished sessions
+    global session_events_task
+    session_events_task = asyncio.create_task(listen_session_events(handle_session_event))
     
     # Set webhook if URL provided
     if WEBHOOK_URL:
@@ -388,8 +393,10 @@ async def on_startup():
 async def on_shutdown():
     """Cleanup on shutdown."""
     logger.info("Shutting down bot...")
+    if session_events_task:
+        session_events_task.cancel()
     await bot.session.close()
-    await task_queue.disconnect()
+    await get_redis().close()
 
 
 def create_app():
@@ -0,0 +1,63 @@
+"""Cached snapshot of the admin panel statistics.
+
+The statistics are one aggregate query over `users`; the admin panel reads
+them from Redis and recomputes them only when the snapshot has expired or
+a subscription event (grant, revoke, payout) has invalidated it.
+"""
+
+import json
+import logging
+import os
+from typing import Any, Dict, Optional, Tuple
+
+from core.redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+# New users and expiring subscriptions change the numbers without an event, so the snapshot also expires
+ADMIN_STATS_TTL = int(os.getenv("ADMIN_STATS_TTL", "300"))
+
+SNAPSHOT_KEY = "admin_stats"
+GENERATION_KEY = "admin_stats:gen"
+
+# Same guard as the entitlement cache: a snapshot computed before an invalidation is not stored
+_STORE_SCRIPT = """
+if (redis.call('GET', KEYS[2]) or '0') ~= ARGV[1] then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+return 1
+"""
+
+
+async def lookup() -> Tuple[Optional[Dict[str, Any]], str]:
+    """Returns (cached snapshot or None, generation to pass to `store` after computing it)."""
+    try:
+        raw, generation = await get_redis().mget(SNAPSHOT_KEY, GENERATION_KEY)
+    except Exception as e:
+        logger.warning(f"Admin stats cache read failed: {e}")
+        return None, ""
+    return (json.loads(raw) if raw else None), (generation.decode() if generation else "0")
+
+
+async def store(stats: Dict[str, Any], generation: str) -> None:
+    if not generation:
+        return
+    try:
+        await get_redis().register_script(_STORE_SCRIPT)(
+            keys=[SNAPSHOT_KEY, GENERATION_KEY],
+            args=[generation, json.dumps(stats), ADMIN_STATS_TTL],
+        )
+    except Exception as e:
+        logger.warning(f"Admin stats cache write failed: {e}")
+
+
+async def invalidate() -> None:
+    """Drops the snapshot; call after a committed subscription change."""
+    try:
+        async with get_redis().pipeline(transaction=False) as pipe:
+            pipe.incr(GENERATION_KEY)
+            pipe.delete(SNAPSHOT_KEY)
+            await pipe.execute()
+    except Exception as e:
+        logger.warning(f"Admin stats cache invalidation failed: {e}")
@@ -0,0 +1,83 @@
+"""Per-user index of recent analyses for answering repeat submissions of the same photos."""
+
+import json
+import logging
+import os
+import time
+from typing import Any, Dict, Optional
+
+from core.redis_client import get_redis
+from core.validators import hamming_distance
+
+logger = logging.getLogger(__name__)
+
+# How long a finished analysis can be reused for the same photos
+DEDUP_TTL = int(os.getenv("DEDUP_TTL", str(7 * 24 * 3600)))
+# Max differing dHash bits (of 64) for two photos to count as the same
+DEDUP_HAMMING_THRESHOLD = int(os.getenv("DEDUP_HAMMING_THRESHOLD", "6"))
+# Analyses kept per user
+DEDUP_HISTORY = 5
+# How long the task of a deduplicated submission is kept for a forced re-analysis
+FORCE_TASK_TTL = 3600
+
+
+def _index_key(user_id: int) -> str:
+    return f"analysis_dedup:{user_id}"
+
+
+def _task_key(user_id: int) -> str:
+    return f"analysis_dedup:last_task:{user_id}"
+
+
+def _same_photo(stored: Optional[str], current: Optional[int]) -> bool:
+    if stored is None or current is None:
+        return stored is None and current is None
+    return hamming_distance(int(stored, 16), current) <= DEDUP_HAMMING_THRESHOLD
+
+
+async def find_match(user_id: int, front_hash: Optional[int], profile_hash: Optional[int]) -> Optional[Dict[str, Any]]:
+    """Returns a recent analysis of the same front/profile pair, if there is one."""
+    if front_hash is None:
+        return None
+    try:
+        entries = await get_redis().lrange(_index_key(user_id), 0, -1)
+    except Exception as e:
+        logger.warning(f"Dedup index read failed for user {user_id}: {e}")
+        return None
+    for raw in entries:
+        entry = json.loads(raw)
+        if _same_photo(entry["front"], front_hash) and _same_photo(entry["profile"], profile_hash):
+            return entry
+    return None
+
+
+async def remember(user_id: int, front_hash: Optional[int], profile_hash: Optional[int], metrics: dict, report: str) -> None:
+    """Adds a finished analysis to the user's index."""
+    if front_hash is None:
+        return
+    entry = json.dumps({
+        "front": format(front_hash, "x"),
+        "profile": format(profile_hash, "x") if profile_hash is not None else None,
+        "metrics": metrics,
+        "report": report,
+        "created_at": int(time.time()),
+    }, ensure_ascii=False, default=str)
+    try:
+        async with get_redis().pipeline(transaction=True) as pipe:
+            pipe.lpush(_index_key(user_id), entry)
+            pipe.ltrim(_index_key(user_id), 0, DEDUP_HISTORY - 1)
+            pipe.expire(_index_key(user_id), DEDUP_TTL)
+            await pipe.execute()
+    except Exception as e:
+        logger.warning(f"Dedup index write failed for user {user_id}: {e}")
+
+
+async def save_deduplicated_task(user_id: int, task_data: dict) -> None:
+    """Keeps the task of a deduplicated submission so the user can force a full run."""
+    await get_redis().set(_task_key(user_id), json.dumps(task_data), ex=FORCE_TASK_TTL)
+
+
+async def pop_deduplicated_task(user_id: int) -> Optional[dict]:
+    """Returns and forgets the last deduplicated task of the user."""
+    raw = await get_redis().getdel(_task_key(user_id))
+    return json.loads(raw) if raw else None
@@ -0,0 +1,311 @@
+"""Admin broadcasts as resumable background jobs with their progress kept in Redis.
+
+A job walks the audience in keyset pages of user IDs and sends each page
+concurrently under a shared adaptive rate limit. Every delivery is recorded
+in Redis as it happens and the cursor moves after each page, so after a
+restart the job continues where it stopped without messaging anyone twice.
+"""
+
+import asyncio
+import logging
+import os
+import time
+from typing import Dict, List, Optional
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+
+from core.edit_scheduler import edit_scheduler
+from core.rate_limit import AdaptiveRateLimiter
+from core.redis_lock import RedisLock
+from core.redis_client import get_redis
+from database import count_broadcast_recipients, get_broadcast_recipient_ids, mark_users_blocked
+
+logger = logging.getLogger(__name__)
+
+# Telegram allows about 30 messages per second per bot; leave room for regular traffic
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "20"))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "10"))
+BROADCAST_PAGE_SIZE = int(os.getenv("BROADCAST_PAGE_SIZE", "200"))
+# How often the admin's progress message is refreshed
+BROADCAST_PROGRESS_INTERVAL = 3.0
+BROADCAST_MAX_ATTEMPTS = 3
+# Only one process runs a job; its runner keeps the lock extended while it works
+BROADCAST_LOCK_TTL = 120
+# Finished jobs are kept this long for reference
+BROADCAST_DONE_TTL = 7 * 24 * 3600
+
+RUNNING, PAUSED, CANCELLED, DONE = "running", "paused", "cancelled", "done"
+AUDIENCE_LABELS = {
+    "all": "всем пользователям",
+    "subscribed": "пользователям с подпиской",
+    "unsubscribed": "пользователям без подписки",
+}
+
+ACTIVE_JOBS_KEY = "broadcast:active"
+broadcast_limiter = AdaptiveRateLimiter(
+    "telegram_broadcast",
+    max_rate=BROADCAST_RATE,
+    max_concurrency=BROADCAST_CONCURRENCY,
+    lease_timeout=30,
+)
+_runners: Dict[str, asyncio.Task] = {}
+
+
+def _key(job_id: str) -> str:
+    return f"broadcast:{job_id}"
+
+
+def _page_key(job_id: str) -> str:
+    # Recipients of the current page who were already handled
+    return f"broadcast:{job_id}:page"
+
+
+def _blocked_key(job_id: str) -> str:
+    # Recipients who blocked the bot, not yet flagged in the DB
+    return f"broadcast:{job_id}:blocked"
+
+
+def _lock_key(job_id: str) -> str:
+    return f"broadcast:{job_id}:lock"
+
+
+def _decode(raw: Dict[bytes, bytes]) -> Dict[str, str]:
+    return {k.decode(): v.decode() for k, v in raw.items()}
+
+
+async def get_job(job_id: str) -> Optional[Dict[str, str]]:
+    raw = await get_redis().hgetall(_key(job_id))
+    return _decode(raw) if raw else None
+
+
+def progress_text(job: Dict[str, str]) -> str:
+    total = int(job["total"])
+    handled = int(job["sent"]) + int(job["failed"]) + int(job["blocked"])
+    # Users who joined after the start are sent to as well, so the count may pass the total
+    percent = min(100, handled * 100 // total) if total else 100
+    title = {
+        RUNNING: "📢 Рассылка идёт",
+        PAUSED: "⏸ Рассылка на паузе",
+        CANCELLED: "⏹ Рассылка остановлена",
+        DONE: "✅ Рассылка завершена!",
+    }[job["status"]]
+    return (
+        f"{title} ({AUDIENCE_LABELS.get(job['audience'], job['audience'])})\n\n"
+        f"Прогресс: {handled}/{total} ({percent}%)\n"
+        f"Отправлено: {job['sent']}\n"
+        f"Заблокировали бота: {job['blocked']}\n"
+        f"Не удалось отправить: {job['failed']}"
+    )
+
+
+def progress_keyboard(job_id: str, status: str) -> Optional[InlineKeyboardMarkup]:
+    if status == RUNNING:
+        buttons = [InlineKeyboardButton(text="⏸ Пауза", callback_data=f"brdjob_pause_{job_id}")]
+    elif status == PAUSED:
+        buttons = [InlineKeyboardButton(text="▶️ Продолжить", callback_data=f"brdjob_resume_{job_id}")]
+    else:
+        return None
+    buttons.append(InlineKeyboardButton(text="⏹ Остановить", callback_data=f"brdjob_cancel_{job_id}"))
+    return InlineKeyboardMarkup(inline_keyboard=[buttons])
+
+
+async def _show_progress(bot: Bot, job_id: str, final: bool = False) -> None:
+    job = await get_job(job_id)
+    if not job or not job.get("progress_message_id"):
+        return
+    chat_id, message_id = int(job["admin_chat_id"]), int(job["progress_message_id"])
+
+    async def edit(text: str) -> None:
+        await bot.edit_message_text(
+            text, chat_id=chat_id, message_id=message_id, reply_markup=progress_keyboard(job_id, job["status"])
+        )
+
+    future = edit_scheduler.submit(chat_id, message_id, progress_text(job), edit, final=final)
+    if final:
+        try:
+            await future
+        except Exception as e:
+            logger.warning(f"Could not update progress of broadcast {job_id}: {e}")
+
+
+async def start_broadcast(bot: Bot, audience: str, text: str, admin_chat_id: int) -> Optional[str]:
+    """Creates a job, posts its progress message to the admin and starts sending; None if nobody matches."""
+    total = await count_broadcast_recipients(audience)
+    if not total:
+        return None
+    client = get_redis()
+    job_id = str(await client.incr("broadcast:seq"))
+    job = {
+        "audience": audience,
+        "text": text,
+        "admin_chat_id": admin_chat_id,
+        "cursor": 0,
+        "total": total,
+        "sent": 0,
+        "failed": 0,
+        "blocked": 0,
+        "status": RUNNING,
+        "created_at": int(time.time()),
+    }
+    async with client.pipeline(transaction=True) as pipe:
+        pipe.hset(_key(job_id), mapping=job)
+        pipe.sadd(ACTIVE_JOBS_KEY, job_id)
+        await pipe.execute()
+
+    progress = await bot.send_message(
+        admin_chat_id,
+        progress_text({k: str(v) for k, v in job.items()}),
+        reply_markup=progress_keyboard(job_id, RUNNING),
+    )
+    await client.hset(_key(job_id), "progress_message_id", progress.message_id)
+    _spawn(bot, job_id)
+    logger.info(f"Broadcast {job_id} to '{audience}' started, {total} recipients")
+    return job_id
+
+
+async def set_status(bot: Bot, job_id: str, status: str) -> bool:
+    """Pauses, resumes or cancels a job; False if the job is unknown or already finished."""
+    job = await get_job(job_id)
+    if not job or job["status"] in (DONE, CANCELLED):
+        return False
+    await get_redis().hset(_key(job_id), "status", status)
+    if status == RUNNING:
+        _spawn(bot, job_id)
+    elif status == CANCELLED and (job["status"] == PAUSED or not await get_redis().exists(_lock_key(job_id))):
+        # Nobody runs the job (paused, or its runner died), so close it here;
+        # a live runner closes it itself once it sees the status
+        await _close(job_id)
+    await _show_progress(bot, job_id)
+    return True
+
+
+async def resume_broadcasts(bot: Bot) -> None:
+    """Restarts the jobs that were running when the process stopped; call on startup.
+
+    Jobs cancelled while their runner was down are closed instead.
+    """
+    for raw_id in await get_redis().smembers(ACTIVE_JOBS_KEY):
+        job_id = raw_id.decode()
+        job = await get_job(job_id)
+        if not job:
+            await get_redis().srem(ACTIVE_JOBS_KEY, job_id)
+        elif job["status"] == RUNNING:
+            logger.info(f"Resuming broadcast {job_id} after user {job['cursor']}")
+            _spawn(bot, job_id)
+        elif job["status"] == CANCELLED:
+            await _close(job_id)
+
+
+async def stop_broadcasts() -> None:
+    """Stops the local runners; their jobs stay running in Redis and resume on the next start."""
+    for task in list(_runners.values()):
+        task.cancel()
+    await asyncio.gather(*_runners.values(), return_exceptions=True)
+
+
+def _spawn(bot: Bot, job_id: str) -> None:
+    if job_id in _runners and not _runners[job_id].done():
+        return
+    task = asyncio.create_task(_run(bot, job_id), name=f"broadcast-{job_id}")
+    _runners[job_id] = task
+    task.add_done_callback(lambda _: _runners.pop(job_id, None))
+
+
+async def _close(job_id: str) -> None:
+    await _flush_blocked(job_id)
+    client = get_redis()
+    async with client.pipeline(transaction=True) as pipe:
+        pipe.srem(ACTIVE_JOBS_KEY, job_id)
+        pipe.expire(_key(job_id), BROADCAST_DONE_TTL)
+        pipe.delete(_page_key(job_id), _blocked_key(job_id))
+        await pipe.execute()
+
+
+async def _run(bot: Bot, job_id: str) -> None:
+    lock = RedisLock(_lock_key(job_id), BROADCAST_LOCK_TTL)
+    if not await lock.acquire():
+        logger.info(f"Broadcast {job_id} is already running in another process")
+        return
+    try:
+        async with lock.heartbeat():
+            await _send_pages(bot, job_id, lock)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logger.error(f"Broadcast {job_id} stopped by an error, it resumes on the next start: {e}", exc_info=True)
+    finally:
+        await lock.release()
+
+
+async def _send_pages(bot: Bot, job_id: str, lock: RedisLock) -> None:
+    client = get_redis()
+    job = await get_job(job_id)
+    last_progress = 0.0
+    while job and job["status"] == RUNNING:
+        if lock.lost:
+            logger.error(f"Broadcast {job_id} lost its lock, leaving the job to its new runner")
+            return
+        page = await get_broadcast_recipient_ids(job["audience"], int(job["cursor"]), BROADCAST_PAGE_SIZE)
+        if not page:
+            await client.hset(_key(job_id), "status", DONE)
+            await _close(job_id)
+            logger.info(f"Broadcast {job_id} finished")
+            break
+
+        done = {int(uid) for uid in await client.smembers(_page_key(job_id))}
+        await asyncio.gather(*(
+            _deliver(bot, job_id, job["text"], user_id) for user_id in page if user_id not in done
+        ))
+        await _flush_blocked(job_id)
+        async with client.pipeline(transaction=True) as pipe:
+            pipe.hset(_key(job_id), "cursor", page[-1])
+            pipe.delete(_page_key(job_id))
+            await pipe.execute()
+
+        if time.monotonic() - last_progress >= BROADCAST_PROGRESS_INTERVAL:
+            last_progress = time.monotonic()
+            await _show_progress(bot, job_id)
+        job = await get_job(job_id)  # Picks up pause/cancel from the admin
+    if job and job["status"] == CANCELLED:
+        await _close(job_id)
+    await _show_progress(bot, job_id, final=True)
+
+
+async def _deliver(bot: Bot, job_id: str, text: str, user_id: int) -> None:
+    """Sends one message and records the outcome together with the user being handled."""
+    outcome = "failed"
+    for attempt in range(1, BROADCAST_MAX_ATTEMPTS + 1):
+        try:
+            async with broadcast_limiter.slot(timeout=300):
+                await bot.send_message(user_id, text)
+            outcome = "sent"
+            await broadcast_limiter.record_success()
+            break
+        except TelegramRetryAfter as e:
+            # Flood limit is per bot: every sender backs off, this one waits as told and retries
+            await broadcast_limiter.record_overload()
+            logger.warning(f"Broadcast {job_id} rate limited, retrying user {user_id} after {e.retry_after}s")
+            await asyncio.sleep(e.retry_after)
+        except TelegramForbiddenError:
+            outcome = "blocked"
+            break
+        except Exception as e:
+            logger.warning(f"Broadcast {job_id}: could not send to user {user_id}: {e}")
+            break
+
+    async with get_redis().pipeline(transaction=True) as pipe:
+        pipe.sadd(_page_key(job_id), user_id)
+        pipe.hincrby(_key(job_id), outcome, 1)
+        if outcome == "blocked":
+            pipe.sadd(_blocked_key(job_id), user_id)
+        await pipe.execute()
+
+
+async def _flush_blocked(job_id: str) -> None:
+    client = get_redis()
+    blocked: List[int] = [int(uid) for uid in await client.smembers(_blocked_key(job_id))]
+    if blocked:
+        await mark_users_blocked(blocked)
+        await client.srem(_blocked_key(job_id), *blocked)
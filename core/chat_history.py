@@ -0,0 +1,185 @@
+"""Per-user chat history with ND, kept in its own Redis list outside the FSM state.
+
+Only the most recent turns that fit a token budget are sent to the model
+verbatim. Older turns are folded in the background into a running summary,
+so the prompt size stays flat however long the conversation gets.
+"""
+
+import asyncio
+import json
+import logging
+import os
+from typing import Dict, List, Optional, Set, Tuple
+
+from core.integrations.deepseek import deepseek_client
+from core.prompts import count_tokens
+from core.redis_client import get_redis
+from core.redis_lock import RedisLock
+
+logger = logging.getLogger(__name__)
+
+# Hard cap on stored messages in case summarization keeps failing
+CHAT_HISTORY_LIMIT = 40
+CHAT_HISTORY_TTL = int(os.getenv("CHAT_HISTORY_TTL", str(7 * 24 * 3600)))
+# Tokens of recent history sent verbatim; everything older goes into the summary
+CHAT_HISTORY_TOKEN_BUDGET = int(os.getenv("CHAT_HISTORY_TOKEN_BUDGET", "1500"))
+SUMMARY_MAX_TOKENS = 400
+SUMMARY_TIMEOUT = 60
+MESSAGE_OVERHEAD_TOKENS = 4
+
+SUMMARY_PROMPT = (
+    "Ты сжимаешь переписку пользователя с AI-ментором по внешности. Обнови краткое содержание: "
+    "сохрани факты о пользователе (внешность, цели, ограничения), данные ему советы и договорённости, "
+    "открытые вопросы. Без вступлений и форматирования, не больше 150 слов."
+)
+
+_summary_tasks: Set[asyncio.Task] = set()
+
+# Removes the summarized messages by content, not by position: while the summary was being written
+# append_turn may have cut the oldest of them with its LTRIM, so only the part still at the head
+# (the longest tail of ARGV[3..] that starts the list) is popped. Nothing matching means the list
+# was cleared or rewritten meanwhile, and then the summary is not stored either.
+_FOLD_SCRIPT = """
+local folded = #ARGV - 2
+local head = redis.call('LRANGE', KEYS[1], 0, folded - 1)
+for skip = 0, folded - 1 do
+    local count = folded - skip
+    local match = #head >= count
+    for i = 1, count do
+        if not match then break end
+        match = head[i] == ARGV[2 + skip + i]
+    end
+    if match then
+        redis.call('LPOP', KEYS[1], count)
+        redis.call('SET', KEYS[2], ARGV[1], 'EX', ARGV[2])
+        return count
+    end
+end
+return 0
+"""
+
+
+def _key(user_id: int) -> str:
+    return f"chat_history:{user_id}"
+
+
+def _summary_key(user_id: int) -> str:
+    return f"chat_summary:{user_id}"
+
+
+def _lock_key(user_id: int) -> str:
+    return f"chat_summary_lock:{user_id}"
+
+
+def estimate_tokens(message: Dict[str, str]) -> int:
+    """Approximate token count of one chat message, including the per-message overhead."""
+    return count_tokens(message["content"]) + MESSAGE_OVERHEAD_TOKENS
+
+
+def split_by_budget(messages: List[Dict[str, str]], budget: int = CHAT_HISTORY_TOKEN_BUDGET) -> Tuple[List[Dict[str, str]], List[Dict[str, str]]]:
+    """Splits history into (older, recent): recent is the longest tail of whole turns within budget.
+
+    The last turn is always kept, even when it alone exceeds the budget.
+    """
+    cut = len(messages)
+    used = 0
+    while cut >= 2:
+        turn_tokens = estimate_tokens(messages[cut - 2]) + estimate_tokens(messages[cut - 1])
+        if used + turn_tokens > budget and cut < len(messages):
+            break
+        used += turn_tokens
+        cut -= 2
+    return messages[:cut], messages[cut:]
+
+
+async def load_history(user_id: int) -> List[Dict[str, str]]:
+    """Returns the stored (not yet summarized) conversation, oldest message first."""
+    try:
+        raw_messages = await get_redis().lrange(_key(user_id), 0, -1)
+    except Exception as e:
+        logger.warning(f"Could not load chat history for user {user_id}: {e}")
+        return []
+    return [json.loads(raw) for raw in raw_messages]
+
+
+async def build_context(user_id: int) -> Tuple[List[Dict[str, str]], Optional[str]]:
+    """Returns the recent messages to send verbatim and the summary of everything before them."""
+    try:
+        async with get_redis().pipeline(transaction=False) as pipe:
+            pipe.lrange(_key(user_id), 0, -1)
+            pipe.get(_summary_key(user_id))
+            raw_messages, summary = await pipe.execute()
+    except Exception as e:
+        logger.warning(f"Could not load chat context for user {user_id}: {e}")
+        return [], None
+
+    _, recent = split_by_budget([json.loads(raw) for raw in raw_messages])
+    return recent, summary.decode("utf-8") if summary else None
+
+
+async def append_turn(user_id: int, question: str, answer: str) -> None:
+    """Adds one question/answer pair and folds older turns into the summary in the background."""
+    key = _key(user_id)
+    messages = [
+        json.dumps({"role": "user", "content": question}, ensure_ascii=False, separators=(",", ":")),
+        json.dumps({"role": "assistant", "content": answer}, ensure_ascii=False, separators=(",", ":")),
+    ]
+    try:
+        async with get_redis().pipeline(transaction=True) as pipe:
+            pipe.rpush(key, *messages)
+            pipe.ltrim(key, -CHAT_HISTORY_LIMIT, -1)
+            pipe.expire(key, CHAT_HISTORY_TTL)
+            await pipe.execute()
+    except Exception as e:
+        logger.warning(f"Could not save chat history for user {user_id}: {e}")
+        return
+
+    task = asyncio.create_task(_fold_old_turns(user_id))
+    _summary_tasks.add(task)
+    task.add_done_callback(_summary_tasks.discard)
+
+
+async def clear_history(user_id: int) -> None:
+    await get_redis().delete(_key(user_id), _summary_key(user_id))
+
+
+async def _summarize(previous: Optional[str], messages: List[Dict[str, str]]) -> str:
+    transcript = "\n".join(
+        f"{'Пользователь' if m['role'] == 'user' else 'ND'}: {m['content']}" for m in messages
+    )
+    content = f"Текущее краткое содержание:\n{previous or '(пусто)'}\n\nНовые сообщения:\n{transcript}"
+    return await deepseek_client.complete(
+        [{"role": "system", "content": SUMMARY_PROMPT}, {"role": "user", "content": content}],
+        timeout=SUMMARY_TIMEOUT,
+        model="deepseek-chat",
+        temperature=0.2,
+        max_tokens=SUMMARY_MAX_TOKENS,
+    )
+
+
+async def _fold_old_turns(user_id: int) -> None:
+    """Moves turns that no longer fit the budget from the list into the summary."""
+    client = get_redis()
+    try:
+        if not deepseek_client.is_available():
+            return  # Try again after the next turn; the list cap bounds growth meanwhile
+        lock = RedisLock(_lock_key(user_id), SUMMARY_TIMEOUT * 2)
+        if not await lock.acquire():
+            return  # Another replica is already summarizing this user
+        try:
+            raw_messages = await client.lrange(_key(user_id), 0, -1)
+            messages = [json.loads(raw) for raw in raw_messages]
+            older, _ = split_by_budget(messages)
+            if not older:
+                return
+            previous = await client.get(_summary_key(user_id))
+            summary = await _summarize(previous.decode("utf-8") if previous else None, older)
+            folded = await client.register_script(_FOLD_SCRIPT)(
+                keys=[_key(user_id), _summary_key(user_id)],
+                args=[summary, CHAT_HISTORY_TTL, *raw_messages[:len(older)]],
+            )
+            logger.info(f"Folded {folded} of {len(older)} chat messages of user {user_id} into the summary")
+        finally:
+            await lock.release()
+    except Exception as e:
+        logger.warning(f"Chat history summarization failed for user {user_id}: {e}")
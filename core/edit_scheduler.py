@@ -0,0 +1,232 @@
+"""Shared pacing of Telegram message edits for everything that streams text into a message."""
+
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from core.rate_limit import AdaptiveRateLimiter, RateLimitTimeout
+
+logger = logging.getLogger(__name__)
+
+# Edits per second for the whole bot, shared by the bot and worker processes through Redis
+TELEGRAM_EDIT_RATE = float(os.getenv("TELEGRAM_EDIT_RATE", "20"))
+TELEGRAM_EDIT_CONCURRENCY = int(os.getenv("TELEGRAM_EDIT_CONCURRENCY", "10"))
+# Base pause between edits in one chat; grows on 429 and shrinks back on success
+TELEGRAM_CHAT_EDIT_INTERVAL = float(os.getenv("TELEGRAM_CHAT_EDIT_INTERVAL", "1.0"))
+MAX_CHAT_EDIT_INTERVAL = 10.0
+# How long an edit may wait for global capacity before it is put back and retried
+GLOBAL_WAIT_TIMEOUT = 5.0
+SEEN_MESSAGES_SIZE = 10000
+
+EditFn = Callable[[str], Awaitable[Any]]
+
+
+class _PendingEdit:
+    def __init__(self, chat_id: int, message_id: int, text: str, edit: EditFn, first: bool):
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.text = text
+        self.edit = edit
+        self.first = first
+        self.waiters: List[asyncio.Future] = []
+
+
+def _retry_after(error: Exception) -> Optional[float]:
+    """Seconds Telegram asked to wait, if the error is a flood limit."""
+    retry_after = getattr(error, "retry_after", None)
+    if retry_after is not None:
+        return float(retry_after)
+    if getattr(error, "error_code", None) == 429:
+        return TELEGRAM_CHAT_EDIT_INTERVAL
+    return None
+
+
+def _not_modified(error: Exception) -> bool:
+    return "message is not modified" in str(error)
+
+
+class EditScheduler:
+    """Coalesces edits per message and paces them under global and per-chat budgets.
+
+    Callers `submit` the full current text whenever it changes. Only the
+    latest text of a message is kept, so a fast stream costs one edit per
+    pacing slot, not one per chunk. The first edit of a message goes out
+    right away; later ones wait for the chat's interval. A 429 doubles that
+    interval for the chat (and halves the global rate through the shared
+    limiter); successful edits shrink it back. Intermediate edits are best
+    effort; a `final` submit returns a future that resolves once its text
+    is shown, or raises the edit's error.
+    """
+
+    def __init__(
+        self,
+        limiter: AdaptiveRateLimiter,
+        chat_interval: float = TELEGRAM_CHAT_EDIT_INTERVAL,
+        max_chat_interval: float = MAX_CHAT_EDIT_INTERVAL,
+    ):
+        self.limiter = limiter
+        self.chat_interval = chat_interval
+        self.max_chat_interval = max_chat_interval
+        self._pending: "OrderedDict[Tuple[int, int], _PendingEdit]" = OrderedDict()
+        self._busy_chats: Set[int] = set()
+        self._chat_next: Dict[int, float] = {}  # chat -> monotonic time of its next allowed edit
+        self._chat_intervals: Dict[int, float] = {}
+        self._seen: "OrderedDict[Tuple[int, int], None]" = OrderedDict()
+        self._wakeup = asyncio.Event()
+        self._dispatcher: Optional[asyncio.Task] = None
+        self._tasks: Set[asyncio.Task] = set()
+        self.coalesced = 0
+
+    def submit(self, chat_id: int, message_id: int, text: str, edit: EditFn, final: bool = False) -> asyncio.Future:
+        """Queues `text` as the new content of the message; supersedes any queued text for it."""
+        key = (chat_id, message_id)
+        future = asyncio.get_running_loop().create_future()
+        pending = self._pending.get(key)
+        if pending:
+            self.coalesced += 1
+            pending.text, pending.edit = text, edit
+        else:
+            pending = _PendingEdit(chat_id, message_id, text, edit, first=key not in self._seen)
+            self._pending[key] = pending
+            self._remember(key)
+        if final:
+            pending.waiters.append(future)
+        else:
+            future.set_result(None)
+        self._ensure_dispatcher()
+        self._wakeup.set()
+        return future
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "pending": len(self._pending),
+            "in_flight": len(self._busy_chats),
+            "coalesced": self.coalesced,
+            "slowed_chats": sum(1 for interval in self._chat_intervals.values() if interval > self.chat_interval),
+        }
+
+    def _remember(self, key: Tuple[int, int]) -> None:
+        self._seen[key] = None
+        while len(self._seen) > SEEN_MESSAGES_SIZE:
+            self._seen.popitem(last=False)
+
+    def _ensure_dispatcher(self) -> None:
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch_loop())
+
+    async def _dispatch_loop(self) -> None:
+        while True:
+            self._wakeup.clear()
+            now = time.monotonic()
+            next_due = None
+            for key, pending in list(self._pending.items()):
+                if pending.chat_id in self._busy_chats:
+                    continue
+                due = self._chat_next.get(pending.chat_id, 0.0)
+                if pending.first:
+                    # Nothing shown yet: don't hold the first chunk back, unless Telegram asked us to wait
+                    due = min(due, self._chat_penalty_until(pending.chat_id))
+                if due > now:
+                    next_due = due if next_due is None else min(next_due, due)
+                    continue
+                del self._pending[key]
+                self._busy_chats.add(pending.chat_id)
+                task = asyncio.create_task(self._apply(pending))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+
+            if not self._pending and not self._busy_chats:
+                self._forget_idle_chats()
+                self._dispatcher = None
+                return
+            timeout = None if next_due is None else max(0.0, next_due - time.monotonic())
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def _forget_idle_chats(self) -> None:
+        """Drops pacing state of chats that are back to the base interval and past their pause."""
+        now = time.monotonic()
+        for chat_id, next_at in list(self._chat_next.items()):
+            if next_at <= now and self._chat_intervals.get(chat_id, self.chat_interval) <= self.chat_interval:
+                del self._chat_next[chat_id]
+                self._chat_intervals.pop(chat_id, None)
+
+    def _chat_penalty_until(self, chat_id: int) -> float:
+        interval = self._chat_intervals.get(chat_id, self.chat_interval)
+        return self._chat_next.get(chat_id, 0.0) if interval > self.chat_interval else 0.0
+
+    async def _apply(self, pending: _PendingEdit) -> None:
+        chat_id = pending.chat_id
+        interval = self._chat_intervals.get(chat_id, self.chat_interval)
+        try:
+            try:
+                async with self.limiter.slot(timeout=GLOBAL_WAIT_TIMEOUT):
+                    await pending.edit(pending.text)
+            except RateLimitTimeout:
+                self._requeue(pending)
+                return
+            except Exception as e:
+                retry_after = _retry_after(e)
+                if retry_after is not None:
+                    interval = min(self.max_chat_interval, interval * 2)
+                    self._chat_intervals[chat_id] = interval
+                    self._chat_next[chat_id] = time.monotonic() + max(retry_after, interval)
+                    await self.limiter.record_overload()
+                    logger.warning(f"Edits in chat {chat_id} rate limited, next in {max(retry_after, interval):.1f}s")
+                    self._requeue(pending)
+                    return
+                if not _not_modified(e):
+                    # A failed edit still used the chat's slot, but is no reason to speed up
+                    self._chat_next[chat_id] = time.monotonic() + interval
+                    if pending.waiters:
+                        self._resolve(pending, e)
+                        return
+                    logger.debug(f"Edit of message {pending.message_id} in chat {chat_id} failed: {e}")
+                    return
+
+            self._chat_intervals[chat_id] = max(self.chat_interval, interval * 0.8)
+            self._chat_next[chat_id] = time.monotonic() + self._chat_intervals[chat_id]
+            await self.limiter.record_success()
+            self._resolve(pending, None)
+        except asyncio.CancelledError:
+            self._resolve(pending, asyncio.CancelledError())
+            raise
+        finally:
+            self._busy_chats.discard(chat_id)
+            self._wakeup.set()
+
+    def _requeue(self, pending: _PendingEdit) -> None:
+        """Puts a failed edit back unless a newer text was submitted meanwhile."""
+        key = (pending.chat_id, pending.message_id)
+        newer = self._pending.get(key)
+        if newer:
+            newer.waiters.extend(pending.waiters)
+        else:
+            self._pending[key] = pending
+
+    @staticmethod
+    def _resolve(pending: _PendingEdit, error: Optional[BaseException]) -> None:
+        for waiter in pending.waiters:
+            if waiter.done():
+                continue
+            if error is None:
+                waiter.set_result(None)
+            elif isinstance(error, asyncio.CancelledError):
+                waiter.cancel()
+            else:
+                waiter.set_exception(error)
+
+
+edit_limiter = AdaptiveRateLimiter(
+    "telegram_edits",
+    max_rate=TELEGRAM_EDIT_RATE,
+    max_concurrency=TELEGRAM_EDIT_CONCURRENCY,
+    lease_timeout=30,
+)
+# One per process: every streaming message of the process goes through it
+edit_scheduler = EditScheduler(edit_limiter)
@@ -0,0 +1,199 @@
+"""Read-through cache of what a user is entitled to: subscription expiry and remaining quota."""
+
+import asyncio
+import json
+import logging
+import os
+import socket
+import time
+from collections import OrderedDict
+from dataclasses import asdict, dataclass
+from datetime import datetime, timezone
+from typing import Any, Dict, Optional, Tuple
+
+from core.redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+ENTITLEMENT_TTL = int(os.getenv("ENTITLEMENT_TTL", "300"))
+# Other processes (the worker) only invalidate Redis, so local copies must expire quickly
+ENTITLEMENT_LOCAL_TTL = float(os.getenv("ENTITLEMENT_LOCAL_TTL", "15"))
+ENTITLEMENT_LOCAL_SIZE = 10000
+# Every change to a cached entitlement is announced here, so other processes drop their local copies
+UPDATES_CHANNEL = "entitlement:updates"
+_PROCESS_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+# Stores the entry only if no invalidation happened since the caller read the generation,
+# so a slow reader can never put back a row that was changed while it was loading.
+_STORE_SCRIPT = """
+if (redis.call('GET', KEYS[2]) or '0') ~= ARGV[1] then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+return 1
+"""
+
+# Applies a committed balance change to the cached entry in place instead of dropping it. The
+# generation is bumped as well, so a reader that loaded the row before the change cannot store it.
+_ADJUST_SCRIPT = """
+redis.call('INCR', KEYS[2])
+redis.call('EXPIRE', KEYS[2], ARGV[3])
+local raw = redis.call('GET', KEYS[1])
+if not raw then
+    return 0
+end
+local pattern = '"' .. ARGV[1] .. '": (%-?%d+)'
+local updated, found = string.gsub(raw, pattern, function(value)
+    return '"' .. ARGV[1] .. '": ' .. math.max(0, tonumber(value) + tonumber(ARGV[2]))
+end, 1)
+if found == 0 then
+    redis.call('DEL', KEYS[1])
+    return 0
+end
+redis.call('SET', KEYS[1], updated, 'KEEPTTL')
+return 1
+"""
+
+
+@dataclass
+class Entitlement:
+    """The part of a user row the hot paths need."""
+
+    user_id: int
+    active_until: Optional[datetime]
+    analyses_left: int
+    messages_left: int
+    is_ambassador: bool = False
+    last_analysis_metrics: Optional[Dict[str, Any]] = None  # context for the chat
+
+    @property
+    def has_subscription(self) -> bool:
+        return self.active_until is not None and self.active_until > datetime.now(timezone.utc)
+
+    def to_json(self) -> str:
+        data = asdict(self)
+        data["active_until"] = self.active_until.isoformat() if self.active_until else None
+        return json.dumps(data)
+
+    @classmethod
+    def from_json(cls, raw: str | bytes) -> "Entitlement":
+        data = json.loads(raw)
+        if data["active_until"]:
+            data["active_until"] = datetime.fromisoformat(data["active_until"])
+        return cls(**data)
+
+
+_local: "OrderedDict[int, Tuple[Entitlement, float]]" = OrderedDict()
+
+
+def _key(user_id: int) -> str:
+    return f"entitlement:{user_id}"
+
+
+def _gen_key(user_id: int) -> str:
+    return f"entitlement:gen:{user_id}"
+
+
+def _remember_locally(entitlement: Entitlement) -> None:
+    _local[entitlement.user_id] = (entitlement, time.monotonic() + ENTITLEMENT_LOCAL_TTL)
+    _local.move_to_end(entitlement.user_id)
+    while len(_local) > ENTITLEMENT_LOCAL_SIZE:
+        _local.popitem(last=False)
+
+
+async def lookup(user_id: int) -> Tuple[Optional[Entitlement], str]:
+    """Returns (cached entitlement or None, generation to pass to `store` after a DB read)."""
+    cached = _local.get(user_id)
+    if cached and cached[1] > time.monotonic():
+        _local.move_to_end(user_id)
+        return cached[0], ""
+
+    try:
+        raw, generation = await get_redis().mget(_key(user_id), _gen_key(user_id))
+    except Exception as e:
+        logger.warning(f"Entitlement cache read failed for user {user_id}: {e}")
+        return None, ""
+    generation = generation.decode() if generation else "0"
+    if raw:
+        entitlement = Entitlement.from_json(raw)
+        _remember_locally(entitlement)
+        return entitlement, generation
+    return None, generation
+
+
+async def store(entitlement: Entitlement, generation: str) -> None:
+    """Caches an entitlement loaded from the DB, unless it was invalidated meanwhile."""
+    if not generation:
+        return
+    try:
+        stored = await get_redis().register_script(_STORE_SCRIPT)(
+            keys=[_key(entitlement.user_id), _gen_key(entitlement.user_id)],
+            args=[generation, entitlement.to_json(), ENTITLEMENT_TTL],
+        )
+    except Exception as e:
+        logger.warning(f"Entitlement cache write failed for user {entitlement.user_id}: {e}")
+        return
+    if stored:
+        _remember_locally(entitlement)
+
+
+async def invalidate(*user_ids: int) -> None:
+    """Drops cached entitlements; call after the DB change is committed."""
+    for user_id in user_ids:
+        _local.pop(user_id, None)
+    if not user_ids:
+        return
+    try:
+        async with get_redis().pipeline(transaction=False) as pipe:
+            for user_id in user_ids:
+                pipe.incr(_gen_key(user_id))
+                pipe.expire(_gen_key(user_id), ENTITLEMENT_TTL * 2)
+                pipe.delete(_key(user_id))
+                pipe.publish(UPDATES_CHANNEL, f"{_PROCESS_ID} {user_id}")
+            await pipe.execute()
+    except Exception as e:
+        logger.warning(f"Entitlement cache invalidation failed for {user_ids}: {e}")
+
+
+async def adjust(user_id: int, balance: str, delta: int) -> None:
+    """Applies a committed change of `balance` ('analyses_left' or 'messages_left') to the cache.
+
+    Quota is reserved and refunded on every chat message, so the entry is
+    updated in place (write-through) rather than invalidated, and the next
+    lookup still needs no DB query.
+    """
+    cached = _local.get(user_id)
+    if cached:
+        entitlement = cached[0]
+        setattr(entitlement, balance, max(0, getattr(entitlement, balance) + delta))
+    try:
+        client = get_redis()
+        await client.register_script(_ADJUST_SCRIPT)(
+            keys=[_key(user_id), _gen_key(user_id)],
+            args=[balance, delta, ENTITLEMENT_TTL * 2],
+        )
+        await client.publish(UPDATES_CHANNEL, f"{_PROCESS_ID} {user_id}")
+    except Exception as e:
+        _local.pop(user_id, None)
+        logger.warning(f"Entitlement cache update failed for user {user_id}: {e}")
+
+
+async def listen_updates() -> None:
+    """Drops local copies changed by other processes (e.g. refunds by the worker); run as a task."""
+    while True:
+        pubsub = get_redis().pubsub(ignore_subscribe_messages=True)
+        try:
+            await pubsub.subscribe(UPDATES_CHANNEL)
+            # Anything changed while we were not subscribed may be stale
+            _local.clear()
+            async for message in pubsub.listen():
+                sender, _, user_id = message["data"].decode().partition(" ")
+                if sender != _PROCESS_ID:
+                    _local.pop(int(user_id), None)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"Entitlement updates subscription failed, retrying: {e}")
+            await asyncio.sleep(1)
+        finally:
+            await pubsub.aclose()
@@ -0,0 +1,56 @@
+"""Redis FSM storage with expiring keys and compact, compressed state data."""
+
+import json
+import os
+import zlib
+from typing import Any, Dict
+
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.fsm.storage.redis import RedisStorage
+import redis.asyncio as redis
+
+# A half-finished photo upload is abandoned after a day
+FSM_STATE_TTL = int(os.getenv("FSM_STATE_TTL", "86400"))
+FSM_DATA_TTL = int(os.getenv("FSM_DATA_TTL", "86400"))
+# Smaller payloads are not worth the CPU: zlib would barely shrink them
+COMPRESS_MIN_BYTES = 256
+_COMPRESSED_MARKER = b"z:"
+
+
+class CompactRedisStorage(RedisStorage):
+    """RedisStorage that writes state data as minified JSON, zlib-compressed when large.
+
+    Every key gets a TTL, so users who walk away do not keep state forever.
+    Plain JSON values written by the stock RedisStorage are still readable.
+    """
+
+    def __init__(self, redis_client: redis.Redis, state_ttl: int = FSM_STATE_TTL, data_ttl: int = FSM_DATA_TTL):
+        super().__init__(redis_client, state_ttl=state_ttl, data_ttl=data_ttl)
+
+    @staticmethod
+    def _encode(data: Dict[str, Any]) -> bytes:
+        raw = json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        if len(raw) < COMPRESS_MIN_BYTES:
+            return raw
+        return _COMPRESSED_MARKER + zlib.compress(raw)
+
+    @staticmethod
+    def _decode(value: bytes) -> Dict[str, Any]:
+        if value.startswith(_COMPRESSED_MARKER):
+            value = zlib.decompress(value[len(_COMPRESSED_MARKER):])
+        return json.loads(value)
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        redis_key = self.key_builder.build(key, "data")
+        if not data:
+            await self.redis.delete(redis_key)
+            return
+        await self.redis.set(redis_key, self._encode(data), ex=self.data_ttl)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        value = await self.redis.get(self.key_builder.build(key, "data"))
+        if value is None:
+            return {}
+        if isinstance(value, str):
+            value = value.encode("utf-8")
+        return self._decode(value)
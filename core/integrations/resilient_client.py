@@ -0,0 +1,294 @@
+"""Latency-aware wrapper around an OpenAI-compatible client: circuit breaker, deadlines, hedging."""
+
+import asyncio
+import logging
+import math
+import os
+import time
+from collections import deque
+from typing import Any, AsyncGenerator, Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+from openai import APIConnectionError, InternalServerError, RateLimitError
+
+logger = logging.getLogger(__name__)
+
+# Consecutive upstream failures after which the circuit opens
+LLM_FAILURE_THRESHOLD = int(os.getenv("LLM_FAILURE_THRESHOLD", "5"))
+# Seconds the circuit stays open before one probe request is let through
+LLM_RESET_TIMEOUT = float(os.getenv("LLM_RESET_TIMEOUT", "30"))
+# Send a duplicate request when the first one is slower than the p90 latency (doubles the cost of slow calls)
+LLM_HEDGING = os.getenv("LLM_HEDGING", "0") == "1"
+# Latency samples needed before the p90 is trusted for hedging
+LLM_HEDGE_MIN_SAMPLES = 20
+
+# Errors that mean the provider is unhealthy; client-side errors (auth, bad request) don't count
+UPSTREAM_FAILURES = (APIConnectionError, InternalServerError, RateLimitError, asyncio.TimeoutError)
+
+
+class CircuitOpenError(Exception):
+    """The provider is considered down; the call was not attempted."""
+
+
+def _cache_tokens(usage: Any) -> Optional[Tuple[int, int]]:
+    """(hit, miss) prompt tokens of DeepSeek's context cache, if the provider reported them."""
+    if usage is None:
+        return None
+    if isinstance(usage, dict):  # usage of stream chunks is not parsed into a model
+        hit, miss = usage.get("prompt_cache_hit_tokens"), usage.get("prompt_cache_miss_tokens")
+    else:
+        hit, miss = getattr(usage, "prompt_cache_hit_tokens", None), getattr(usage, "prompt_cache_miss_tokens", None)
+    if hit is None or miss is None:
+        return None
+    return int(hit), int(miss)
+
+
+def _chunk_text(chunk: Any) -> str:
+    if not chunk.choices:
+        return ""
+    return chunk.choices[0].delta.content or ""
+
+
+class ResilientLLMClient:
+    """Circuit breaker, per-call deadlines and hedged requests for one LLM provider.
+
+    The breaker opens after `failure_threshold` consecutive upstream failures
+    and rejects calls with CircuitOpenError. After `reset_timeout` it lets a
+    single probe through (half-open); success closes it again, failure
+    re-opens it. Latencies of successful calls feed a p90 estimate: when a
+    call is still unanswered after that p90, a duplicate request is sent and
+    whichever answers first wins. For streams this applies to the time to the
+    first chunk. `is_available()` and `snapshot()` let callers degrade
+    before they even try. Prompt-cache usage is logged per `prompt` label.
+    """
+
+    def __init__(
+        self,
+        client: Any,
+        name: str,
+        failure_threshold: int = LLM_FAILURE_THRESHOLD,
+        reset_timeout: float = LLM_RESET_TIMEOUT,
+        hedging: bool = LLM_HEDGING,
+        window: int = 200,
+    ):
+        self.client = client
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.hedging = hedging
+        self._state = "closed"
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._latencies: Deque[float] = deque(maxlen=window)  # full non-streaming calls
+        self._first_chunk_latencies: Deque[float] = deque(maxlen=window)  # streams
+        self.hedged_calls = 0
+        self._cache_usage: Dict[str, List[int]] = {}  # prompt label -> [hit tokens, miss tokens]
+
+    # --- breaker ---
+
+    @property
+    def state(self) -> str:
+        if self._state == "open" and time.monotonic() - self._opened_at >= self.reset_timeout:
+            return "half_open"
+        return self._state
+
+    def is_available(self) -> bool:
+        """False while calls would be rejected without being attempted."""
+        state = self.state
+        return state == "closed" or (state == "half_open" and not self._probe_in_flight)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "state": self.state,
+            "consecutive_failures": self._failures,
+            "p90_latency": self._p90(self._latencies),
+            "p90_first_chunk": self._p90(self._first_chunk_latencies),
+            "hedged_calls": self.hedged_calls,
+            "prompt_cache_hit_rate": {label: self._hit_rate(*usage) for label, usage in self._cache_usage.items()},
+        }
+
+    def _before_call(self) -> bool:
+        """Admits a call or raises CircuitOpenError; True if this call is the half-open probe."""
+        state = self.state
+        if state == "open" or (state == "half_open" and self._probe_in_flight):
+            raise CircuitOpenError(f"{self.name} circuit is open")
+        if state == "half_open":
+            self._state = "half_open"
+            self._probe_in_flight = True
+            return True
+        return False
+
+    def _on_success(self) -> None:
+        if self._state != "closed":
+            logger.info(f"{self.name} circuit closed")
+        self._state = "closed"
+        self._failures = 0
+
+    def _on_failure(self, error: Exception) -> None:
+        if not isinstance(error, UPSTREAM_FAILURES):
+            return
+        self._failures += 1
+        if self._state == "half_open" or self._failures >= self.failure_threshold:
+            if self._state != "open":
+                logger.error(f"{self.name} circuit opened after {self._failures} failures: {error!r}")
+            self._state = "open"
+            self._opened_at = time.monotonic()
+
+    # --- prompt cache ---
+
+    @staticmethod
+    def _hit_rate(hit: int, miss: int) -> Optional[float]:
+        return round(hit / (hit + miss), 3) if hit + miss else None
+
+    def _record_usage(self, prompt: Optional[str], usage: Any) -> None:
+        tokens = _cache_tokens(usage)
+        if tokens is None:
+            return
+        hit, miss = tokens
+        totals = self._cache_usage.setdefault(prompt or "unlabeled", [0, 0])
+        totals[0] += hit
+        totals[1] += miss
+        logger.info(
+            f"{self.name} prompt cache [{prompt or 'unlabeled'}]: {hit}/{hit + miss} tokens hit, "
+            f"{self._hit_rate(*totals):.0%} overall"
+        )
+
+    # --- latency ---
+
+    @staticmethod
+    def _p90(samples: Deque[float]) -> Optional[float]:
+        if len(samples) < LLM_HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(samples)
+        # Nearest-rank p90: the smallest sample with at least 90% of the samples at or below it
+        return round(ordered[min(len(ordered) - 1, math.ceil(0.9 * len(ordered)) - 1)], 2)
+
+    async def _race(
+        self,
+        factory: Callable[[], Awaitable[Any]],
+        hedge_after: Optional[float],
+        discard: Optional[Callable[[Any], Awaitable[None]]] = None,
+    ) -> Any:
+        """Runs factory(), starting a second copy after `hedge_after` seconds; first success wins."""
+        tasks: List[asyncio.Task] = [asyncio.create_task(factory())]
+        winner: Optional[asyncio.Task] = None
+        try:
+            if self.hedging and hedge_after is not None:
+                done, _ = await asyncio.wait(tasks, timeout=hedge_after)
+                if not done:
+                    self.hedged_calls += 1
+                    logger.info(f"{self.name} call slower than p90 ({hedge_after}s), sending a hedged request")
+                    tasks.append(asyncio.create_task(factory()))
+
+            pending = set(tasks)
+            error: Optional[BaseException] = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        winner = task
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                if task is winner:
+                    continue
+                if not task.done():
+                    task.cancel()
+                elif discard and not task.cancelled() and task.exception() is None:
+                    await discard(task.result())
+
+    # --- calls ---
+
+    async def complete(self, messages: List[Dict[str, str]], timeout: float, prompt: Optional[str] = None, **kwargs) -> str:
+        """Non-streaming chat completion with a deadline; returns the message text.
+
+        `prompt` labels the template the messages were built from, for cache statistics.
+        """
+        probe = self._before_call()
+        started = time.monotonic()
+        try:
+            response = await asyncio.wait_for(
+                self._race(
+                    lambda: self.client.chat.completions.create(messages=messages, **kwargs),
+                    self._p90(self._latencies),
+                ),
+                timeout=timeout,
+            )
+        except Exception as e:
+            self._on_failure(e)
+            raise
+        finally:
+            if probe:  # Only the probe clears the flag; other calls may finish while it runs
+                self._probe_in_flight = False
+        self._latencies.append(time.monotonic() - started)
+        self._on_success()
+        self._record_usage(prompt, response.usage)
+        return response.choices[0].message.content
+
+    async def stream(
+        self,
+        messages: List[Dict[str, str]],
+        timeout: float,
+        idle_timeout: float = 30.0,
+        prompt: Optional[str] = None,
+        **kwargs,
+    ) -> AsyncGenerator[str, None]:
+        """Streaming chat completion; `timeout` bounds the whole answer, `idle_timeout` each gap."""
+        probe = self._before_call()
+        started = time.monotonic()
+        deadline = started + timeout
+        # The final chunk then carries the usage, including prompt-cache tokens
+        extra_body = {**(kwargs.pop("extra_body", None) or {}), "stream_options": {"include_usage": True}}
+
+        async def open_stream():
+            stream = await self.client.chat.completions.create(
+                messages=messages, stream=True, extra_body=extra_body, **kwargs
+            )
+            try:
+                first = await stream.__anext__()
+            except StopAsyncIteration:
+                first = None
+            return stream, first
+
+        async def close_stream(opened):
+            await opened[0].close()
+
+        stream = None
+        try:
+            stream, first = await asyncio.wait_for(
+                self._race(open_stream, self._p90(self._first_chunk_latencies), discard=close_stream),
+                timeout=min(idle_timeout, timeout),
+            )
+            self._first_chunk_latencies.append(time.monotonic() - started)
+            if first is not None:
+                if getattr(first, "usage", None) is not None:
+                    self._record_usage(prompt, first.usage)
+                text = _chunk_text(first)
+                if text:
+                    yield text
+                while True:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise asyncio.TimeoutError(f"{self.name} stream exceeded {timeout}s")
+                    try:
+                        chunk = await asyncio.wait_for(stream.__anext__(), timeout=min(idle_timeout, remaining))
+                    except StopAsyncIteration:
+                        break
+                    if getattr(chunk, "usage", None) is not None:
+                        self._record_usage(prompt, chunk.usage)
+                    text = _chunk_text(chunk)
+                    if text:
+                        yield text
+        except Exception as e:
+            self._on_failure(e)
+            raise
+        else:
+            self._on_success()
+        finally:
+            if probe:
+                self._probe_in_flight = False
+            if stream is not None:
+                await stream.close()
@@ -0,0 +1,73 @@
+"""Redis sorted set of ambassadors ranked by paid referrals.
+
+The DB counters on the ambassador row are the source of truth; this set only
+orders them. Every write sets the absolute counter value, so a lost update is
+fixed by the next event, and a missing set is rebuilt from the DB.
+"""
+
+import logging
+from typing import Dict, List, Optional
+
+from core.redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+LEADERBOARD_KEY = "ambassadors:leaderboard"
+
+# A missing board is left missing: one member added to it would hide everyone else until a rebuild
+_SET_SCORE_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('ZADD', KEYS[1], ARGV[2], ARGV[1])
+end
+"""
+
+
+async def set_score(ambassador_id: int, paid_referrals: int) -> None:
+    try:
+        await get_redis().register_script(_SET_SCORE_SCRIPT)(
+            keys=[LEADERBOARD_KEY], args=[str(ambassador_id), paid_referrals]
+        )
+    except Exception as e:
+        logger.warning(f"Leaderboard update failed for ambassador {ambassador_id}: {e}")
+
+
+async def remove(ambassador_id: int) -> None:
+    try:
+        await get_redis().zrem(LEADERBOARD_KEY, str(ambassador_id))
+    except Exception as e:
+        logger.warning(f"Leaderboard removal failed for ambassador {ambassador_id}: {e}")
+
+
+async def top(limit: int = -1) -> Optional[List[int]]:
+    """Ambassador IDs, most paid referrals first; None if the set is missing or Redis is unavailable."""
+    try:
+        client = get_redis()
+        if not await client.exists(LEADERBOARD_KEY):
+            return None
+        members = await client.zrevrange(LEADERBOARD_KEY, 0, limit - 1 if limit > 0 else -1)
+    except Exception as e:
+        logger.warning(f"Leaderboard read failed: {e}")
+        return None
+    return [int(member) for member in members]
+
+
+async def rank(ambassador_id: int) -> Optional[int]:
+    """1-based place of the ambassador, or None if they are not on the board."""
+    try:
+        place = await get_redis().zrevrank(LEADERBOARD_KEY, str(ambassador_id))
+    except Exception as e:
+        logger.warning(f"Leaderboard rank read failed for ambassador {ambassador_id}: {e}")
+        return None
+    return None if place is None else place + 1
+
+
+async def rebuild(scores: Dict[int, int]) -> None:
+    """Replaces the whole board with `scores` (ambassador ID -> paid referrals)."""
+    try:
+        async with get_redis().pipeline(transaction=True) as pipe:
+            pipe.delete(LEADERBOARD_KEY)
+            if scores:
+                pipe.zadd(LEADERBOARD_KEY, {str(amb_id): paid for amb_id, paid in scores.items()})
+            await pipe.execute()
+    except Exception as e:
+        logger.warning(f"Leaderboard rebuild failed: {e}")
@@ -0,0 +1,71 @@
+"""Telegram messages that show text while it is still being generated."""
+
+import asyncio
+import logging
+from typing import List
+
+from core.edit_scheduler import edit_scheduler
+from core.telegram_api import TelegramAPIError, TelegramTransport
+from core.utils import TELEGRAM_MAX_MESSAGE_LENGTH
+
+logger = logging.getLogger(__name__)
+
+CURSOR = " ▌"
+
+
+class LiveMessages:
+    """A run of messages that follows a growing text.
+
+    `update()` gets the whole text so far, already split into parts, one per
+    message. The first part is sent as soon as there is any text. The last
+    part is edited in place (with a cursor); when a new part appears, the
+    previous one gets its final text and a new message is sent for the new
+    part. Edits go through the shared edit scheduler, which coalesces them
+    and paces them, so `update()` can be called on every chunk.
+    """
+
+    def __init__(self, transport: TelegramTransport, chat_id: int):
+        self.transport = transport
+        self.chat_id = chat_id
+        self._messages: List[List] = []  # [message_id, last submitted text] per part
+
+    @property
+    def started(self) -> bool:
+        """True once something is visible to the user."""
+        return bool(self._messages)
+
+    async def update(self, parts: List[str], final: bool = False) -> None:
+        """Shows `parts`; with `final` waits until every message shows its text without the cursor."""
+        waiting = []
+        for i, part in enumerate(parts):
+            text = part
+            if not final and i == len(parts) - 1 and len(part) + len(CURSOR) <= TELEGRAM_MAX_MESSAGE_LENGTH:
+                text += CURSOR
+            if i < len(self._messages):
+                if self._messages[i][1] != text:
+                    waiting.append(self._edit(i, text, final))
+            elif not await self._send(text):
+                break  # Keep the order; the next update tries again
+        if final:
+            for result in await asyncio.gather(*waiting, return_exceptions=True):
+                if isinstance(result, Exception):
+                    logger.warning(f"Final edit of a live message in {self.chat_id} failed: {result}")
+
+    async def _send(self, text: str) -> bool:
+        try:
+            message = await self.transport.send_message(self.chat_id, text)
+        except TelegramAPIError as e:
+            logger.error(f"Failed to send live message to {self.chat_id}: {e}")
+            return False
+        self._messages.append([message["message_id"], text])
+        return True
+
+    def _edit(self, index: int, text: str, final: bool) -> asyncio.Future:
+        message_id = self._messages[index][0]
+        self._messages[index][1] = text
+
+        async def edit(new_text: str):
+            # One attempt: the scheduler handles 429 and retries with the latest text
+            await self.transport.edit_message_text(self.chat_id, message_id, new_text, max_retries=1)
+
+        return edit_scheduler.submit(self.chat_id, message_id, text, edit, final=final)
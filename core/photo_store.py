@@ -0,0 +1,35 @@
+"""Short-lived handoff of validated photo bytes from the bot process to the worker."""
+
+import logging
+import os
+from typing import Optional
+
+from core.redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+# Long enough to cover the front -> profile upload and the wait in the analysis queue
+PHOTO_HANDOFF_TTL = int(os.getenv("PHOTO_HANDOFF_TTL", "1800"))
+
+
+def _key(file_unique_id: str) -> str:
+    return f"photo_blob:{file_unique_id}"
+
+
+async def put_photo(file_unique_id: str, photo_bytes: bytes) -> None:
+    """Stores photo bytes the bot has already downloaded; failures are only logged."""
+    try:
+        await get_redis().set(_key(file_unique_id), photo_bytes, ex=PHOTO_HANDOFF_TTL)
+    except Exception as e:
+        logger.warning(f"Could not store photo {file_unique_id} for handoff: {e}")
+
+
+async def get_photo(file_unique_id: Optional[str]) -> Optional[bytes]:
+    """Returns handed-off photo bytes, or None if they are missing or expired."""
+    if not file_unique_id:
+        return None
+    try:
+        return await get_redis().get(_key(file_unique_id))
+    except Exception as e:
+        logger.warning(f"Could not read handed-off photo {file_unique_id}: {e}")
+        return None
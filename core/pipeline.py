@@ -0,0 +1,155 @@
+"""Staged async pipeline: stages joined by queues, each with its own concurrency limit."""
+
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class PipelineJob:
+    """Base class for jobs that flow through a Pipeline."""
+
+    def __init__(self):
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.cancelled = False
+        self.timings: Dict[str, float] = {}  # stage name -> seconds spent in the handler
+        self._stage_entered = time.monotonic()
+        self._current: Optional[asyncio.Future] = None
+
+    def cancel(self) -> None:
+        """Stops the job: it is skipped by later stages and its running handler is cancelled."""
+        self.cancelled = True
+        if self._current and not self._current.done():
+            self._current.cancel()
+
+
+class Stage:
+    """One pipeline step with its own queue, worker count and counters.
+
+    The handler returns True to pass the job on to the next stage and False
+    when the job is finished early (for example, a photo failed validation).
+    """
+
+    def __init__(self, name: str, handler: Callable[[Any], Awaitable[bool]], concurrency: int):
+        self.name = name
+        self.handler = handler
+        self.concurrency = max(1, concurrency)
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.next: Optional["Stage"] = None
+        self.processed = 0
+        self.failed = 0
+        self.in_flight = 0
+        self.busy_seconds = 0.0
+        self.wait_seconds = 0.0
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Current counters; averages are per handled job."""
+        handled = self.processed + self.failed
+        return {
+            "stage": self.name,
+            "concurrency": self.concurrency,
+            "queued": self.queue.qsize(),
+            "in_flight": self.in_flight,
+            "processed": self.processed,
+            "failed": self.failed,
+            "avg_wait": round(self.wait_seconds / handled, 2) if handled else 0.0,
+            "avg_busy": round(self.busy_seconds / handled, 2) if handled else 0.0,
+        }
+
+
+class Pipeline:
+    """Runs jobs through a chain of stages.
+
+    Each stage has an independent pool of workers, so a slow or throttled stage
+    only queues jobs in front of itself while the other stages keep working on
+    jobs that are already past it.
+    """
+
+    def __init__(
+        self,
+        stages: List[Stage],
+        on_error: Optional[Callable[[Any, str, Exception], Awaitable[None]]] = None,
+    ):
+        self.stages = stages
+        self.on_error = on_error
+        for current, following in zip(stages, stages[1:]):
+            current.next = following
+        self._workers: List[asyncio.Task] = []
+
+    def start(self) -> None:
+        """Starts the stage workers (idempotent)."""
+        if self._workers:
+            return
+        for stage in self.stages:
+            for i in range(stage.concurrency):
+                self._workers.append(asyncio.create_task(self._work(stage), name=f"{stage.name}-{i}"))
+
+    async def stop(self) -> None:
+        """Cancels all stage workers."""
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    async def run(self, job: PipelineJob) -> None:
+        """Pushes a job through all stages and waits until it is finished."""
+        self.start()
+        job._stage_entered = time.monotonic()
+        self.stages[0].queue.put_nowait(job)
+        try:
+            await asyncio.shield(job.future)
+        except asyncio.CancelledError:
+            job.cancel()
+            raise
+
+    def metrics(self) -> List[Dict[str, Any]]:
+        """Snapshot of every stage, in pipeline order."""
+        return [stage.snapshot() for stage in self.stages]
+
+    @staticmethod
+    def _finish(job: PipelineJob) -> None:
+        if not job.future.done():
+            job.future.set_result(None)
+
+    async def _work(self, stage: Stage) -> None:
+        while True:
+            job = await stage.queue.get()
+            if job.cancelled:
+                self._finish(job)
+                continue
+
+            started = time.monotonic()
+            stage.wait_seconds += started - job._stage_entered
+            stage.in_flight += 1
+            job._current = asyncio.ensure_future(stage.handler(job))
+            try:
+                proceed = await job._current
+            except asyncio.CancelledError:
+                if not job.cancelled:
+                    raise  # The worker itself is being stopped
+                proceed = False
+            except Exception as e:
+                stage.failed += 1
+                logger.error(f"Pipeline stage '{stage.name}' failed: {e}", exc_info=True)
+                if self.on_error:
+                    try:
+                        await self.on_error(job, stage.name, e)
+                    except Exception as hook_error:
+                        logger.error(f"Pipeline error hook failed: {hook_error}", exc_info=True)
+                proceed = None
+            finally:
+                elapsed = time.monotonic() - started
+                stage.in_flight -= 1
+                stage.busy_seconds += elapsed
+                job.timings[stage.name] = elapsed
+                job._current = None
+
+            if proceed is not None:
+                stage.processed += 1
+            if proceed and stage.next and not job.cancelled:
+                job._stage_entered = time.monotonic()
+                stage.next.queue.put_nowait(job)
+            else:
+                self._finish(job)
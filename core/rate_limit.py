@@ -0,0 +1,173 @@
+"""Redis-backed adaptive rate limiter shared by every process that calls a rate-limited API."""
+
+import asyncio
+import contextlib
+import logging
+import random
+import uuid
+from typing import Any, AsyncIterator, Dict, Optional
+
+from redis.exceptions import RedisError
+
+from core.redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+# Takes one token from the bucket and one concurrency slot, or returns how many ms to wait.
+# The bucket refills at the current adaptive rate; slots are leases that expire if the
+# holder dies, so a crashed process never keeps capacity.
+_ACQUIRE_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local s = redis.call('HMGET', KEYS[1], 'tokens', 'ts', 'rate', 'limit')
+local rate = tonumber(s[3]) or tonumber(ARGV[3])
+local limit = tonumber(s[4]) or tonumber(ARGV[4])
+local burst = math.max(1, math.floor(rate))
+local tokens = tonumber(s[1]) or burst
+local ts = tonumber(s[2]) or now
+tokens = math.min(burst, tokens + (now - ts) * rate / 1000)
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', now)
+local wait = 0
+if redis.call('ZCARD', KEYS[2]) >= math.floor(limit) then
+    local oldest = redis.call('ZRANGE', KEYS[2], 0, 0, 'WITHSCORES')
+    wait = math.max(1, math.min(250, tonumber(oldest[2]) - now))
+elseif tokens < 1 then
+    wait = math.ceil((1 - tokens) * 1000 / rate)
+else
+    tokens = tokens - 1
+    redis.call('ZADD', KEYS[2], now + tonumber(ARGV[2]), ARGV[1])
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', now, 'rate', tostring(rate), 'limit', tostring(limit))
+return wait
+"""
+
+# AIMD: every success adds a little rate and concurrency, an overload halves both.
+# Overloads reported within the cooldown belong to the same episode and cut only once.
+_ADJUST_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local s = redis.call('HMGET', KEYS[1], 'rate', 'limit', 'cut_at')
+local rate = tonumber(s[1]) or tonumber(ARGV[2])
+local limit = tonumber(s[2]) or tonumber(ARGV[3])
+if ARGV[1] == 'decrease' then
+    if now - (tonumber(s[3]) or 0) < tonumber(ARGV[6]) then
+        return {tostring(rate), tostring(limit), 0}
+    end
+    rate = math.max(tonumber(ARGV[4]), rate / 2)
+    limit = math.max(1, limit / 2)
+    redis.call('HSET', KEYS[1], 'cut_at', now)
+else
+    rate = math.min(tonumber(ARGV[2]), rate + tonumber(ARGV[5]))
+    limit = math.min(tonumber(ARGV[3]), limit + 1 / limit)
+end
+redis.call('HSET', KEYS[1], 'rate', tostring(rate), 'limit', tostring(limit))
+return {tostring(rate), tostring(limit), 1}
+"""
+
+
+class RateLimitTimeout(Exception):
+    """No capacity became available within the caller's timeout."""
+
+
+class AdaptiveRateLimiter:
+    """Token bucket plus concurrency semaphore in Redis with AIMD tuning.
+
+    All bot and worker processes share the same state, so together they stay
+    within the limits of one API key. Callers that find no capacity wait in
+    line instead of failing. When the API reports overload, call
+    `record_overload()`: rate and concurrency are halved and then grow back
+    by `increase_step` per successful call up to the configured maximums.
+    If Redis is unavailable the limiter lets calls through rather than
+    blocking them.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        max_rate: float,
+        max_concurrency: int,
+        min_rate: float = 0.5,
+        increase_step: float = 0.1,
+        lease_timeout: float = 60.0,
+        overload_cooldown: float = 2.0,
+    ):
+        self.name = name
+        self.max_rate = max_rate
+        self.max_concurrency = max_concurrency
+        self.min_rate = min_rate
+        self.increase_step = increase_step
+        self.lease_timeout = lease_timeout
+        self.overload_cooldown = overload_cooldown
+        self.state_key = f"ratelimit:{name}"
+        self.slots_key = f"ratelimit:{name}:slots"
+
+    async def acquire(self, timeout: float) -> Optional[str]:
+        """Waits for a token and a free slot; returns the slot token to release."""
+        client = get_redis()
+        acquire_script = client.register_script(_ACQUIRE_SCRIPT)
+        token = uuid.uuid4().hex
+        deadline = asyncio.get_running_loop().time() + timeout
+        while True:
+            try:
+                wait_ms = await acquire_script(
+                    keys=[self.state_key, self.slots_key],
+                    args=[token, int(self.lease_timeout * 1000), self.max_rate, self.max_concurrency],
+                )
+            except RedisError as e:
+                logger.warning(f"Rate limiter '{self.name}' unavailable, calling without it: {e}")
+                return None
+            if not wait_ms:
+                return token
+
+            remaining = deadline - asyncio.get_running_loop().time()
+            if remaining <= 0:
+                raise RateLimitTimeout(f"No '{self.name}' capacity within {timeout:.1f}s")
+            # Jitter spreads out callers that were told the same wait
+            await asyncio.sleep(min(remaining, int(wait_ms) / 1000 * random.uniform(1.0, 1.5)))
+
+    async def release(self, token: Optional[str]) -> None:
+        if token is None:
+            return
+        try:
+            await get_redis().zrem(self.slots_key, token)
+        except RedisError as e:
+            logger.warning(f"Rate limiter '{self.name}' release failed, slot will expire: {e}")
+
+    @contextlib.asynccontextmanager
+    async def slot(self, timeout: float) -> AsyncIterator[None]:
+        """Holds one unit of capacity for the duration of the block."""
+        token = await self.acquire(timeout)
+        try:
+            yield
+        finally:
+            await self.release(token)
+
+    async def _adjust(self, mode: str) -> None:
+        client = get_redis()
+        try:
+            rate, limit, changed = await client.register_script(_ADJUST_SCRIPT)(
+                keys=[self.state_key],
+                args=[mode, self.max_rate, self.max_concurrency, self.min_rate, self.increase_step,
+                      int(self.overload_cooldown * 1000)],
+            )
+        except RedisError as e:
+            logger.warning(f"Rate limiter '{self.name}' adjust failed: {e}")
+            return
+        if mode == "decrease" and changed:
+            logger.warning(f"Rate limiter '{self.name}' backed off to {float(rate):.2f} req/s, {int(float(limit))} concurrent")
+
+    async def record_success(self) -> None:
+        await self._adjust("increase")
+
+    async def record_overload(self) -> None:
+        await self._adjust("decrease")
+
+    async def state(self) -> Dict[str, Any]:
+        """Current adaptive rate, concurrency limit and slots in use."""
+        client = get_redis()
+        rate, limit = await client.hmget(self.state_key, "rate", "limit")
+        return {
+            "rate": float(rate) if rate else self.max_rate,
+            "limit": int(float(limit)) if limit else self.max_concurrency,
+            "in_flight": await client.zcard(self.slots_key),
+        }
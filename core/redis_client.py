@@ -0,0 +1,16 @@
+"""Shared Redis connection pool for the current process."""
+
+import os
+from typing import Optional
+
+import redis.asyncio as redis
+
+_client: Optional[redis.Redis] = None
+
+
+def get_redis() -> redis.Redis:
+    """Returns the process-wide Redis client, creating it on first use."""
+    global _client
+    if _client is None:
+        _client = redis.from_url(os.getenv("REDIS_URL", "redis://localhost"))
+    return _client
@@ -0,0 +1,69 @@
+"""Redis locks owned by a token: only the holder can extend or release them."""
+
+import asyncio
+import contextlib
+import logging
+import uuid
+from typing import AsyncIterator
+
+from core.redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+_RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+_EXTEND_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+
+class RedisLock:
+    """A lock on `key` that expires after `ttl` seconds unless its holder extends it."""
+
+    def __init__(self, key: str, ttl: float):
+        self.key = key
+        self.ttl = ttl
+        self.token = uuid.uuid4().hex
+        self.lost = False  # set by heartbeat() when the lock expired under its holder
+
+    async def acquire(self) -> bool:
+        return bool(await get_redis().set(self.key, self.token, nx=True, px=int(self.ttl * 1000)))
+
+    async def extend(self) -> bool:
+        """False if the lock expired (and may now belong to someone else)."""
+        client = get_redis()
+        return bool(await client.register_script(_EXTEND_SCRIPT)(keys=[self.key], args=[self.token, int(self.ttl * 1000)]))
+
+    async def release(self) -> None:
+        """Deletes the lock only if it is still ours."""
+        await get_redis().register_script(_RELEASE_SCRIPT)(keys=[self.key], args=[self.token])
+
+    @contextlib.asynccontextmanager
+    async def heartbeat(self) -> AsyncIterator[None]:
+        """Keeps the lock extended while the block runs, however long it takes."""
+
+        async def beat():
+            while True:
+                await asyncio.sleep(self.ttl / 3)
+                try:
+                    if not await self.extend():
+                        self.lost = True
+                        logger.error(f"Lost lock '{self.key}' while holding it")
+                        return
+                except Exception as e:
+                    logger.warning(f"Could not extend lock '{self.key}': {e}")
+
+        task = asyncio.create_task(beat())
+        try:
+            yield
+        finally:
+            task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
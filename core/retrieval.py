@@ -0,0 +1,175 @@
+"""In-process BM25 index over the sections of the looksmaxing knowledge base.
+
+Instead of sending the whole knowledge base with every request, the report
+gets the sections that match the user's weakest metrics and the chat gets
+the sections that match the question.
+"""
+
+import math
+import os
+import re
+from collections import Counter
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+
+from core.knowledge_base import LOOKSMAXING_KNOWLEDGE
+
+# Sections added to a report (beyond the pinned ones) and to a chat answer
+KNOWLEDGE_REPORT_SECTIONS = int(os.getenv("KNOWLEDGE_REPORT_SECTIONS", "3"))
+KNOWLEDGE_CHAT_SECTIONS = int(os.getenv("KNOWLEDGE_CHAT_SECTIONS", "2"))
+WEAK_METRICS_LIMIT = 3
+
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+# Sections every report needs whatever the metrics: terminology and the rating scale
+PINNED_SECTIONS = ("ОСНОВНЫЕ КОНЦЕПЦИИ ЛУКСМАКСИНГА", "Тир-метрика")
+
+_HEADING = re.compile(r"^\*\*(.+?):?\*\*$|^---\s*(.+?)\s*---$")
+_WORD = re.compile(r"[\w\-]+", re.UNICODE)
+# Common Russian inflection endings, longest first; crude, but enough to match "кожа" with "кожи"
+_ENDINGS = sorted(
+    "ами ями ого его ому ему ыми ими ой ей ий ый ая яя ое ее ые ие ую юю ах ях ам ям ом ем ов ев а я о е ы и у ю ь".split(),
+    key=len,
+    reverse=True,
+)
+_STOPWORDS = {"и", "в", "во", "на", "с", "со", "по", "за", "для", "от", "до", "не", "но", "а", "или", "как", "что",
+              "это", "то", "же", "ли", "бы", "при", "без", "под", "над", "из", "к", "у", "о", "об", "мне", "мой",
+              "моя", "мои", "я", "ты", "он", "она", "the", "a", "of", "and", "or", "to", "in"}
+
+
+@dataclass(frozen=True)
+class Section:
+    title: str
+    text: str
+
+
+def _stem(word: str) -> str:
+    for ending in _ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= 3:
+            return word[: -len(ending)]
+    return word
+
+
+def tokenize(text: str) -> List[str]:
+    words = (w.strip("-") for w in _WORD.findall(text.lower().replace("ё", "е")))
+    return [_stem(w) for w in words if w and w not in _STOPWORDS and not w.isdigit()]
+
+
+def split_sections(knowledge: str) -> List[Section]:
+    """Splits the knowledge base at its bold (**...**) and --- ... --- headings."""
+    sections: List[Section] = []
+    title, lines = None, []
+
+    def flush():
+        body = "\n".join(lines).strip()
+        if title and body:
+            text = f"{title}:\n{body}"
+            sections.append(Section(title=title, text=text))
+
+    for line in knowledge.strip().splitlines():
+        match = _HEADING.match(line.strip())
+        if match:
+            flush()
+            title, lines = (match.group(1) or match.group(2)).strip(), []
+        else:
+            lines.append(line)
+    flush()
+    return sections
+
+
+class KnowledgeIndex:
+    """Okapi BM25 over a fixed list of sections, built once per process."""
+
+    def __init__(self, sections: List[Section]):
+        self.sections = sections
+        self._term_freqs = [Counter(tokenize(section.text)) for section in sections]
+        self._lengths = [sum(tf.values()) for tf in self._term_freqs]
+        self._avg_length = sum(self._lengths) / len(self._lengths) if self._lengths else 0.0
+        doc_freq = Counter(term for tf in self._term_freqs for term in tf)
+        n = len(sections)
+        self._idf = {term: math.log(1 + (n - df + 0.5) / (df + 0.5)) for term, df in doc_freq.items()}
+
+    def score(self, query: str) -> List[float]:
+        terms = tokenize(query)
+        scores = []
+        for tf, length in zip(self._term_freqs, self._lengths):
+            score = 0.0
+            for term in terms:
+                freq = tf.get(term)
+                if not freq:
+                    continue
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * length / self._avg_length)
+                score += self._idf[term] * freq * (BM25_K1 + 1) / (freq + norm)
+            scores.append(score)
+        return scores
+
+    def search(self, query: str, k: int, exclude: tuple = ()) -> List[Section]:
+        """Up to k best matching sections, best first; sections with no matching term are never returned."""
+        ranked = sorted(zip(self.score(query), range(len(self.sections))), reverse=True)
+        found = []
+        for score, i in ranked:
+            if len(found) == k or score <= 0:
+                break
+            if self.sections[i].title not in exclude:
+                found.append(self.sections[i])
+        return found
+
+    def get(self, title: str) -> Optional[Section]:
+        return next((s for s in self.sections if s.title == title), None)
+
+
+index = KnowledgeIndex(split_sections(LOOKSMAXING_KNOWLEDGE))
+
+
+def pinned_text() -> str:
+    """Sections that go into the static report prompt."""
+    return "\n\n".join(s.text for s in (index.get(title) for title in PINNED_SECTIONS) if s)
+
+
+# --- Weakest metrics ---
+
+# metric -> (ideal low, ideal high, tolerance, query); the deviation outside the ideal range,
+# in tolerances, is how weak the metric is. Skin values are 0-100 where 100 is best.
+METRIC_TARGETS: Dict[str, tuple] = {
+    "skin_score": (75, 100, 15, "кожа уход ретинол SPF текстура пор лимфоток отёчность"),
+    "health": (75, 100, 15, "кожа уход коллаген витамин микроциркуляция glow"),
+    "acne": (80, 100, 15, "акне пилинг AHA ретинол цинк молочку рубцов"),
+    "stain": (80, 100, 15, "пигментные пятна SPF IPL лазер фотодамаж"),
+    "symmetry_score": (0.9, 1.0, 0.05, "асимметричный прикус симметрия осанка harmony"),
+    "canthal_tilt": (4, 8, 3, "canthal tilt наклон глаза hunter eyes prey брови"),
+    "eye_whr": (0.0, 0.33, 0.05, "глаза hunter eyes prey eyes брови"),
+    "gonial_angle": (110, 125, 6, "челюсть jawline жевательная мышца mastic gum mewing"),
+    "jaw_prominence": (0.85, 0.95, 0.04, "челюсть jawline борода low-box подбородок жевательная"),
+    "beauty_avg": (60, 100, 10, "PSL рейтинг стрижка стиль укладка брови зубы"),
+}
+
+
+def weakest_metrics(metrics: Dict[str, Any], limit: int = WEAK_METRICS_LIMIT) -> List[str]:
+    """Names of the metrics furthest outside their ideal range, weakest first."""
+    deviations = []
+    for name, (low, high, tolerance, _) in METRIC_TARGETS.items():
+        value = metrics.get(name)
+        if not isinstance(value, (int, float)):
+            continue
+        deviation = max(low - value, value - high, 0) / tolerance
+        if deviation > 0:
+            deviations.append((deviation, name))
+    return [name for _, name in sorted(deviations, reverse=True)[:limit]]
+
+
+def sections_for_metrics(metrics: Dict[str, Any], k: int = KNOWLEDGE_REPORT_SECTIONS) -> List[Section]:
+    """Knowledge sections for the user's weakest metrics, excluding the pinned ones."""
+    weak = weakest_metrics(metrics)
+    if not weak:
+        # Nothing stands out: general upkeep advice
+        return index.search("кожа осанка стиль уход", k, exclude=PINNED_SECTIONS)
+    return index.search(" ".join(METRIC_TARGETS[name][3] for name in weak), k, exclude=PINNED_SECTIONS)
+
+
+def sections_for_question(question: str, k: int = KNOWLEDGE_CHAT_SECTIONS) -> List[Section]:
+    return index.search(question, k)
+
+
+def format_sections(sections: List[Section]) -> str:
+    return "\n\n".join(section.text for section in sections)
@@ -0,0 +1,105 @@
+"""Completion events for analysis sessions, pushed by the worker to the bot."""
+
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import socket
+import time
+import uuid
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from core.redis_client import get_redis
+from core.redis_lock import RedisLock
+from database import set_session_status
+from models import SessionStatus
+
+logger = logging.getLogger(__name__)
+
+SESSION_EVENTS_KEY = "session_events"
+# Each listener moves the events it takes into its own processing list and holds a lease on it;
+# lists whose lease expired (the listener died) are moved back to the queue by the other listeners
+SESSION_EVENTS_CONSUMERS_KEY = "session_events:consumers"
+CONSUMER_LEASE_TTL = 30
+RECLAIM_INTERVAL = 30
+
+
+def _processing_key(consumer: str) -> str:
+    return f"session_events:processing:{consumer}"
+
+
+def _lease_key(consumer: str) -> str:
+    return f"session_events:lease:{consumer}"
+
+
+async def complete_session(
+    session_id: int,
+    user_id: int,
+    status: SessionStatus,
+    result: Optional[Dict[str, Any]] = None,
+) -> None:
+    """Stores the final session status and notifies the bot about it."""
+    await set_session_status(session_id, status, result)
+    event = {"session_id": session_id, "user_id": user_id, "status": status.value, "result": result or {}}
+    await get_redis().lpush(SESSION_EVENTS_KEY, json.dumps(event, ensure_ascii=False))
+    logger.info(f"Session {session_id} finished with status {status.value}")
+
+
+async def _reclaim_abandoned(client) -> None:
+    """Moves the events of listeners whose lease expired back to the queue."""
+    for raw in await client.smembers(SESSION_EVENTS_CONSUMERS_KEY):
+        consumer = raw.decode()
+        if await client.exists(_lease_key(consumer)):
+            continue
+        moved = 0
+        while await client.lmove(_processing_key(consumer), SESSION_EVENTS_KEY, "RIGHT", "RIGHT"):
+            moved += 1
+        await client.srem(SESSION_EVENTS_CONSUMERS_KEY, consumer)
+        if moved:
+            logger.warning(f"Requeued {moved} session event(s) left by listener {consumer}")
+
+
+async def listen_session_events(handler: Callable[[Dict[str, Any]], Awaitable[None]], timeout: int = 5) -> None:
+    """Delivers completion events to `handler` as soon as the worker publishes them.
+
+    An event stays in this listener's processing list until the handler
+    returns. If the listener dies, its lease expires and another listener
+    (or this one after a restart) puts the unhandled events back in the
+    queue, so nothing is lost and nothing still in progress is taken away.
+    """
+    client = get_redis()
+    consumer = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+    processing_key = _processing_key(consumer)
+    lease = RedisLock(_lease_key(consumer), CONSUMER_LEASE_TTL)
+    await lease.acquire()
+    await client.sadd(SESSION_EVENTS_CONSUMERS_KEY, consumer)
+
+    try:
+        async with lease.heartbeat():
+            next_reclaim = 0.0
+            while True:
+                try:
+                    if time.monotonic() >= next_reclaim:
+                        next_reclaim = time.monotonic() + RECLAIM_INTERVAL
+                        await _reclaim_abandoned(client)
+                    raw = await client.blmove(SESSION_EVENTS_KEY, processing_key, timeout, "RIGHT", "LEFT")
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logger.error(f"Failed to read session events: {e}")
+                    await asyncio.sleep(timeout)
+                    continue
+                if raw is None:
+                    continue
+
+                try:
+                    await handler(json.loads(raw))
+                except Exception as e:
+                    logger.error(f"Session event handler failed: {e}", exc_info=True)
+                await client.lrem(processing_key, 1, raw)
+    finally:
+        # Leaving cleanly: hand back whatever was not handled
+        with contextlib.suppress(Exception):
+            await lease.release()
+            await _reclaim_abandoned(client)
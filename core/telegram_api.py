@@ -0,0 +1,147 @@
+"""Pooled Telegram Bot API transport for processes that do not run aiogram (the worker)."""
+
+import asyncio
+import importlib.util
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+API_BASE = "https://api.telegram.org"
+# Telegram keeps a file link valid for at least one hour; stay a little below that
+FILE_PATH_TTL = 55 * 60
+FILE_PATH_CACHE_SIZE = 1024
+MAX_RETRIES = 4
+# HTTP/2 needs the optional 'h2' package (httpx[http2]); fall back to keep-alive HTTP/1.1 without it
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+
+class TelegramAPIError(Exception):
+    """Bot API call failed after retries."""
+
+    def __init__(self, method: str, error_code: Optional[int], description: str, retry_after: Optional[float] = None):
+        super().__init__(f"{method} failed ({error_code}): {description}")
+        self.method = method
+        self.error_code = error_code
+        self.description = description
+        self.retry_after = retry_after  # set for 429 responses
+
+
+class TelegramTransport:
+    """Shared keep-alive client for the Bot API.
+
+    One connection pool serves every call, so a multi-part report reuses the
+    same connection instead of a new TCP+TLS handshake per message. 429
+    responses are retried after the `retry_after` Telegram asks for, other
+    transient failures with exponential backoff. getFile results are cached
+    for the lifetime of the file link.
+    """
+
+    def __init__(self, token: str, max_retries: int = MAX_RETRIES):
+        self.token = token
+        self.max_retries = max_retries
+        self._client: Optional[httpx.AsyncClient] = None
+        self._file_paths: "OrderedDict[str, tuple[str, float]]" = OrderedDict()
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                http2=HTTP2_AVAILABLE,
+                timeout=httpx.Timeout(30.0, connect=10.0),
+                limits=httpx.Limits(max_connections=50, max_keepalive_connections=20, keepalive_expiry=120),
+            )
+        return self._client
+
+    async def close(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def call(self, method: str, payload: Dict[str, Any], max_retries: Optional[int] = None) -> Any:
+        """Calls a Bot API method and returns its `result`."""
+        url = f"{API_BASE}/bot{self.token}/{method}"
+        max_retries = max_retries or self.max_retries
+        delay = 1.0
+        for attempt in range(1, max_retries + 1):
+            try:
+                response = await self.client.post(url, json=payload)
+                body = response.json()
+            except (httpx.TransportError, ValueError) as e:
+                if attempt == max_retries:
+                    raise TelegramAPIError(method, None, str(e)) from e
+                logger.warning(f"Telegram {method} transport error: {e}; retrying in {delay:.0f}s")
+                await asyncio.sleep(delay)
+                delay *= 2
+                continue
+
+            if body.get("ok"):
+                return body["result"]
+
+            error_code = body.get("error_code", response.status_code)
+            description = body.get("description", response.text)
+            retry_after = body.get("parameters", {}).get("retry_after") if error_code == 429 else None
+            if attempt < max_retries:
+                if error_code == 429:
+                    logger.warning(f"Telegram {method} rate limited, retrying after {retry_after or delay}s")
+                    await asyncio.sleep(retry_after or delay)
+                    continue
+                if error_code >= 500:
+                    await asyncio.sleep(delay)
+                    delay *= 2
+                    continue
+            raise TelegramAPIError(method, error_code, description, retry_after=retry_after)
+
+    async def get_file_path(self, file_id: str) -> str:
+        """Resolves a file_id to a download path, served from cache while the link is valid."""
+        cached = self._file_paths.get(file_id)
+        if cached and cached[1] > time.monotonic():
+            self._file_paths.move_to_end(file_id)
+            return cached[0]
+
+        result = await self.call("getFile", {"file_id": file_id})
+        file_path = result["file_path"]
+        self._file_paths[file_id] = (file_path, time.monotonic() + FILE_PATH_TTL)
+        self._file_paths.move_to_end(file_id)
+        while len(self._file_paths) > FILE_PATH_CACHE_SIZE:
+            self._file_paths.popitem(last=False)
+        return file_path
+
+    async def download_file(self, file_id: str) -> bytes:
+        """Downloads a file by its file_id."""
+        for attempt in range(2):
+            file_path = await self.get_file_path(file_id)
+            response = await self.client.get(f"{API_BASE}/file/bot{self.token}/{file_path}")
+            if response.status_code == 404 and attempt == 0:
+                # The cached link expired early; resolve it again once
+                self._file_paths.pop(file_id, None)
+                continue
+            response.raise_for_status()
+            return response.content
+        raise TelegramAPIError("downloadFile", 404, "file link expired")
+
+    async def send_message(self, chat_id: int, text: str, parse_mode: Optional[str] = None, **kwargs) -> Dict[str, Any]:
+        """Sends a text message and returns the Message object."""
+        payload = {"chat_id": chat_id, "text": text, **kwargs}
+        if parse_mode:
+            payload["parse_mode"] = parse_mode
+        return await self.call("sendMessage", payload)
+
+    async def edit_message_text(
+        self,
+        chat_id: int,
+        message_id: int,
+        text: str,
+        parse_mode: Optional[str] = None,
+        max_retries: Optional[int] = None,
+        **kwargs,
+    ) -> Any:
+        """Replaces the text of a sent message; pass max_retries=1 when the caller handles 429 itself."""
+        payload = {"chat_id": chat_id, "message_id": message_id, "text": text, **kwargs}
+        if parse_mode:
+            payload["parse_mode"] = parse_mode
+        return await self.call("editMessageText", payload, max_retries=max_retries)
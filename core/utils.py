@@ -55,6 +55,14 @@ def split_long_message(text: str) -> List[str]:
     # Clean up any empty parts that might have been created
     return [p.strip() for p in parts if p.strip()]
 
+def split_by_sections(text: str, marker: str = "## ") -> List[str]:
+    """Splits text into one message per section (a line starting with `marker`), long sections further."""
+    parts = []
+    for section in re.split(rf"\n(?={re.escape(marker)})", text):
+        if section.strip():
+            parts.extend(split_long_message(section.strip()))
+    return parts
+
 def sanitize_html_for_telegram(text: str) -> str:
     """Converts common Markdown styling (bold/italic) to Telegram HTML and ensures tags are balanced.
 
@@ -1,4 +1,7 @@
 import os
+import asyncio
+import hashlib
+import random
 import numpy as np
 import cv2
 import logging
@@ -9,10 +12,32 @@ from aiogram import Bot
 import aiohttp
 import json
 
+from core.rate_limit import AdaptiveRateLimiter, RateLimitTimeout
+from core.redis_client import get_redis
+
 # --- Конфигурация Face++ ---
 FACEPP_API_KEY = os.getenv("FACEPP_API_KEY")
 FACEPP_API_SECRET = os.getenv("FACEPP_API_SECRET")
 FACEPP_DETECT_URL = "https://api-us.faceplusplus.com/facepp/v3/detect"
+# Detect results are reused by the worker and for photos sent again after a rejection
+FACEPP_CACHE_TTL = int(os.getenv("FACEPP_CACHE_TTL", "86400"))
+# Limits of our Face++ plan (per API key, shared by the bot and all workers)
+FACEPP_MAX_QPS = float(os.getenv("FACEPP_MAX_QPS", "10"))
+FACEPP_MAX_CONCURRENCY = int(os.getenv("FACEPP_MAX_CONCURRENCY", "10"))
+# How long a caller may wait in line for Face++ capacity before giving up
+FACEPP_QUEUE_TIMEOUT = float(os.getenv("FACEPP_QUEUE_TIMEOUT", "60"))
+FACEPP_REQUEST_TIMEOUT = 30
+FACEPP_OVERLOAD_ERRORS = {"CONCURRENCY_LIMIT_EXCEEDED"}
+# Pause before retrying an overloaded call: doubles per attempt up to the cap, randomized so callers spread out
+FACEPP_OVERLOAD_BACKOFF = float(os.getenv("FACEPP_OVERLOAD_BACKOFF", "0.5"))
+FACEPP_OVERLOAD_BACKOFF_MAX = float(os.getenv("FACEPP_OVERLOAD_BACKOFF_MAX", "8"))
+
+facepp_limiter = AdaptiveRateLimiter(
+    "facepp",
+    max_rate=FACEPP_MAX_QPS,
+    max_concurrency=FACEPP_MAX_CONCURRENCY,
+    lease_timeout=FACEPP_REQUEST_TIMEOUT * 2,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -26,7 +51,81 @@ def is_bright_enough(img_bytes: bytes) -> bool:
     return gray.mean() >= 40
 
 
+def perceptual_hash(img_bytes: bytes, hash_size: int = 8) -> Optional[int]:
+    """Difference hash (dHash) of the image: near-identical photos differ in only a few bits."""
+    nparr = np.frombuffer(img_bytes, np.uint8)
+    img = cv2.imdecode(nparr, cv2.IMREAD_GRAYSCALE)
+    if img is None:
+        return None
+    small = cv2.resize(img, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return int(sum(1 << i for i, bit in enumerate(bits) if bit))
+
+
+def hamming_distance(a: int, b: int) -> int:
+    """Number of differing bits between two hashes."""
+    return bin(a ^ b).count("1")
+
+
+def _detect_cache_key(photo_bytes: bytes) -> str:
+    return f"facepp:detect:{hashlib.sha256(photo_bytes).hexdigest()}"
+
+
 async def detect_face(photo_bytes: bytes) -> dict:
+    """Returns the Face++ detect result, served from cache for bytes seen before."""
+    cache_key = _detect_cache_key(photo_bytes)
+    try:
+        cached = await get_redis().get(cache_key)
+        if cached:
+            logger.info("Face++ detect result served from cache")
+            return json.loads(cached)
+    except Exception as e:
+        logger.warning(f"Face++ cache read failed: {e}")
+
+    result = await _detect_face_uncached(photo_bytes)
+
+    # Only real API answers are cached; transport/quota errors must be retried
+    if "error_message" not in result:
+        try:
+            await get_redis().set(cache_key, json.dumps(result), ex=FACEPP_CACHE_TTL)
+        except Exception as e:
+            logger.warning(f"Face++ cache write failed: {e}")
+    return result
+
+
+_FACEPP_BUSY_MESSAGE = "Сервис анализа лица сейчас перегружен. Пожалуйста, попробуйте через минуту."
+
+
+async def _detect_face_uncached(photo_bytes: bytes) -> dict:
+    """Calls Face++ through the shared limiter, waiting out overloads instead of failing."""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + FACEPP_QUEUE_TIMEOUT
+    overloads = 0
+    while True:
+        try:
+            async with facepp_limiter.slot(timeout=max(0.0, deadline - loop.time())):
+                result = await _call_facepp_detect(photo_bytes)
+        except RateLimitTimeout:
+            logger.error("Face++ capacity not available in time")
+            return {"error_message": _FACEPP_BUSY_MESSAGE}
+
+        if result.get("error_message") in FACEPP_OVERLOAD_ERRORS:
+            # Лимит ключа превышен: снижаем темп, ждём со случайной добавкой и встаём в очередь заново
+            await facepp_limiter.record_overload()
+            backoff = min(FACEPP_OVERLOAD_BACKOFF_MAX, FACEPP_OVERLOAD_BACKOFF * 2 ** overloads)
+            overloads += 1
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                logger.error(f"Face++ still overloaded after {overloads} attempts")
+                return {"error_message": _FACEPP_BUSY_MESSAGE}
+            await asyncio.sleep(min(remaining, random.uniform(backoff / 2, backoff)))
+            continue
+        if "error_message" not in result:
+            await facepp_limiter.record_success()
+        return result
+
+
+async def _call_facepp_detect(photo_bytes: bytes) -> dict:
     """Sends photo to Face++ detect API and returns the result."""
     data = aiohttp.FormData()
     data.add_field('api_key', FACEPP_API_KEY)
@@ -35,7 +134,7 @@ async def detect_face(photo_bytes: bytes) -> dict:
     data.add_field('return_attributes', "gender,age,beauty,facequality,eyestatus,emotion,ethnicity,mouthstatus,eyegaze,headpose,skinstatus")
     data.add_field('image_file', photo_bytes, filename='photo.jpg', content_type='image/jpeg')
 
-    async with aiohttp.ClientSession() as session:
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=FACEPP_REQUEST_TIMEOUT)) as session:
         try:
             async with session.post(FACEPP_DETECT_URL, data=data) as response:
                 if response.status == 200:
@@ -49,7 +148,7 @@ async def detect_face(photo_bytes: bytes) -> dict:
                         return {"error_message": error_json.get("error_message", f"API request failed with status {response.status}")}
                     except json.JSONDecodeError:
                         return {"error_message": f"API request failed with status {response.status}. Could not parse error response."}
-        except aiohttp.ClientError as e:
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
             logger.error(f"Aiohttp client error: {e}")
             return {"error_message": "Failed to connect to face analysis service."}
 
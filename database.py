@@ -5,13 +5,20 @@ from typing import AsyncGenerator
 
 from datetime import datetime, timedelta, timezone
 from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine, AsyncSession
-from sqlalchemy import text, TIMESTAMP
+from sqlalchemy import and_, text, TIMESTAMP, case, insert, literal, update
 from sqlalchemy.orm import sessionmaker, Mapped, mapped_column
 from sqlmodel import SQLModel, select, func
 
-from models import User, Session, Task
+from models import (
+    AnalysisResult, AnalysisStatus, QuotaKind, QuotaReservation, ReservationStatus,
+    User, Session, SessionStatus, Task
+)
 from sqlalchemy import JSON
 
+import migrations
+from core import admin_stats, entitlements, leaderboard
+from core.entitlements import Entitlement
+
 import logging
 logger = logging.getLogger(__name__)
 
@@ -36,93 +43,13 @@ async_session = sessionmaker(
 )
 
 
-async def _ensure_referral_columns(conn):
-    # This is a hacky way to add columns to the users table if they don't exist
-    # This is needed for backward compatibility with older versions of the database
-    columns_to_add = {
-        "is_ambassador": "BOOLEAN DEFAULT FALSE",
-        "referred_by_id": "BIGINT",
-        "referral_payout_pending": "BOOLEAN DEFAULT FALSE"
-    }
+# Balance column each kind of quota is taken from
+_QUOTA_COLUMNS = {QuotaKind.ANALYSIS: "analyses_left", QuotaKind.MESSAGE: "messages_left"}
 
-    dialect_name = conn.dialect.name
-
-    if dialect_name == 'sqlite':
-        for column, definition in columns_to_add.items():
-            result = await conn.execute(text(f"PRAGMA table_info(users);"))
-            existing_columns = [row[1] for row in result.fetchall()]
-            if column not in existing_columns:
-                stmt = f"ALTER TABLE users ADD COLUMN {column} {definition};"
-                await conn.execute(text(stmt))
-    else:  # Assuming postgresql
-        for column, definition in columns_to_add.items():
-            stmt = f"ALTER TABLE IF EXISTS users ADD COLUMN IF NOT EXISTS {column} {definition};"
-            await conn.execute(text(stmt))
-
-
-async def _ensure_last_analysis_metrics_column(conn):
-    """Ensure the last_analysis_metrics column exists."""
-    column_name = "last_analysis_metrics"
-    dialect_name = conn.dialect.name
-
-    if dialect_name == 'sqlite':
-        result = await conn.execute(text(f"PRAGMA table_info(users);"))
-        existing_columns = [row[1] for row in result.fetchall()]
-        if column_name not in existing_columns:
-            await conn.execute(text(f'ALTER TABLE users ADD COLUMN {column_name} JSON;'))
-            logger.info(f"Added '{column_name}' column to 'users' table for sqlite.")
-    else:  # Assuming postgresql
-        # For PostgreSQL, JSON type is appropriate
-        await conn.execute(text(f'ALTER TABLE users ADD COLUMN IF NOT EXISTS {column_name} JSONB;'))
-        logger.info(f"Ensured '{column_name}' column exists in 'users' table for postgresql.")
-
-
-async def _ensure_subscription_source_column(conn):
-    """Ensure the subscription_source column exists."""
-    column_name = "subscription_source"
-    dialect_name = conn.dialect.name
-
-    if dialect_name == 'sqlite':
-        result = await conn.execute(text(f"PRAGMA table_info(users);"))
-        existing_columns = [row[1] for row in result.fetchall()]
-        if column_name not in existing_columns:
-            await conn.execute(text(f'ALTER TABLE users ADD COLUMN {column_name} TEXT;'))
-            logger.info(f"Added '{column_name}' column to 'users' table for sqlite.")
-    else:  # Assuming postgresql
-        await conn.execute(text(f'ALTER TABLE users ADD COLUMN IF NOT EXISTS {column_name} VARCHAR(255);'))
-        logger.info(f"Ensured '{column_name}' column exists in 'users' table for postgresql.")
-
-
-async def _ensure_bigint_columns(conn):
-    """Ensure critical id columns are BIGINT (int8) to allow large Telegram IDs."""
-    alter_statements = [
-        # Convert child FK columns first to avoid constraint errors
-        "ALTER TABLE IF EXISTS sessions ALTER COLUMN user_id TYPE BIGINT USING user_id::BIGINT;",
-        "ALTER TABLE IF EXISTS tasks ALTER COLUMN session_id TYPE BIGINT USING session_id::BIGINT;",
-        # Then convert parent and other columns
-        "ALTER TABLE IF EXISTS users ALTER COLUMN id TYPE BIGINT USING id::BIGINT;",
-        "ALTER TABLE IF EXISTS users ALTER COLUMN referred_by_id TYPE BIGINT USING referred_by_id::BIGINT;"
-    ]
-    for stmt in alter_statements:
-        try:
-            await conn.execute(text(stmt))
-        except Exception as exc:
-            # Ignore errors where type is already bigint or column missing.
-            logger.debug(f"Skipping alter column statement due to: {exc}")
 
 async def create_db_and_tables() -> None:
-    """Create database tables."""
-    async with engine.begin() as conn:
-        logger.info("Creating database tables if they do not exist…")
-        await conn.run_sync(SQLModel.metadata.create_all)
-        # Ensure new columns exist for referral system
-        await _ensure_referral_columns(conn)
-        # Ensure critical ID columns are BIGINT to fit Telegram IDs
-        await _ensure_bigint_columns(conn)
-        # Ensure the new metrics column exists
-        await _ensure_last_analysis_metrics_column(conn)
-        await _ensure_subscription_source_column(conn)
-        logger.info("Database setup complete")
+    """Create database tables and bring the schema up to date (see migrations.py)."""
+    await migrations.migrate(engine)
 
 
 async def get_session() -> AsyncGenerator[AsyncSession, None]:
@@ -136,6 +63,26 @@ async def close_db() -> None:
     await engine.dispose()
 
 
+async def _bump_referral_counters(session: AsyncSession, referrer_id: int, **deltas: int) -> None:
+    """Atomically adds `deltas` to the referrer's counters, within the caller's transaction."""
+    values = {column: getattr(User, column) + delta for column, delta in deltas.items() if delta}
+    if values:
+        await session.execute(update(User).where(User.id == referrer_id).values(**values))
+
+
+async def _sync_leaderboard(ambassador_id: int) -> None:
+    """Puts the ambassador's committed paid-referral count on the leaderboard."""
+    async with async_session() as session:
+        result = await session.execute(
+            select(User.is_ambassador, User.paid_referrals_count).where(User.id == ambassador_id)
+        )
+        row = result.first()
+    if row and row.is_ambassador:
+        await leaderboard.set_score(ambassador_id, row.paid_referrals_count)
+    else:
+        await leaderboard.remove(ambassador_id)
+
+
 async def add_user(user_id: int, username: str | None = None, referred_by_id: int | None = None) -> None:
     """Add a new user or update their username, optionally with a referrer."""
     async with async_session() as session:
@@ -143,23 +90,40 @@ async def add_user(user_id: int, username: str | None = None, referred_by_id: in
             user = await session.get(User, user_id)
             if not user:
                 session.add(User(id=user_id, username=username, referred_by_id=referred_by_id))
-            elif user.username != username:
-                user.username = username
+                if referred_by_id:
+                    await _bump_referral_counters(session, referred_by_id, referred_count=1)
+            else:
+                if user.username != username:
+                    user.username = username
+                if user.is_blocked:
+                    user.is_blocked = False  # /start means the bot is no longer blocked
             await session.commit()
 
 async def check_subscription(user_id: int) -> bool:
     """Check if a user has an active subscription."""
-    async with async_session() as session:
-        user = await session.get(User, user_id)
-        if not user or not user.is_active_until:
-            return False
-
-        # Сделаем is_active_until таймзон-осведомленным, если он еще не такой
-        active_until = user.is_active_until
-        if active_until.tzinfo is None:
-            active_until = active_until.replace(tzinfo=timezone.utc)
-
-        return active_until > datetime.now(timezone.utc)
+    entitlement = await get_entitlement(user_id)
+    return entitlement is not None and entitlement.has_subscription
+
+
+async def get_entitlement(user_id: int) -> Entitlement | None:
+    """Subscription expiry and remaining quota, served from cache when possible."""
+    entitlement, generation = await entitlements.lookup(user_id)
+    if entitlement:
+        return entitlement
+
+    user = await get_user(user_id)
+    if not user:
+        return None
+    entitlement = Entitlement(
+        user_id=user.id,
+        active_until=user.is_active_until,
+        analyses_left=user.analyses_left or 0,
+        messages_left=user.messages_left or 0,
+        is_ambassador=bool(user.is_ambassador),
+        last_analysis_metrics=user.last_analysis_metrics,
+    )
+    await entitlements.store(entitlement, generation)
+    return entitlement
 
 async def get_users_with_expiring_subscription(days_left: int) -> list[User]:
     """Находит пользователей, у которых подписка истекает через указанное количество дней."""
@@ -186,34 +150,182 @@ async def get_user(user_id: int) -> User | None:
         return user
 
 
-async def decrement_user_messages(user_id: int):
-    """Уменьшает количество оставшихся сообщений пользователя на 1."""
+async def set_session_status(session_id: int, status: SessionStatus, result_json: dict | None = None) -> None:
+    """Stores the final status and result of an analysis session."""
     async with async_session() as session:
-        user = await session.get(User, user_id)
-        if user and user.messages_left > 0:
-            user.messages_left -= 1
-            await session.commit()
+        async with session.begin():
+            db_session = await session.get(Session, session_id)
+            if db_session:
+                db_session.status = status
+                db_session.result_json = result_json
+                db_session.finished_at = datetime.utcnow()
+
+
+async def finalize_analysis(
+    user_id: int,
+    status: AnalysisStatus,
+    metrics: dict | None = None,
+    report: str | None = None,
+    timings: dict | None = None,
+    error: str | None = None,
+    session_id: int | None = None,
+    reservation_id: int | None = None,
+    charge: bool = False,
+) -> None:
+    """Records a finished analysis job in analysis_results.
 
-async def save_user_metrics(user_id: int, metrics: dict) -> None:
-    """Saves the latest analysis metrics for a user."""
+    A successful job also becomes the user's last_analysis_metrics and its
+    quota reservation is committed; any other outcome releases it. `charge`
+    debits the balance directly for tasks queued without a reservation.
+    Everything is written in one transaction; on PostgreSQL the user update
+    rides along with the insert as a CTE.
+    """
+    users = User.__table__
+    charged = charge or (reservation_id is not None and status == AnalysisStatus.DONE)
+    insert_stmt = insert(AnalysisResult.__table__).values(
+        user_id=user_id,
+        session_id=session_id,
+        status=status,
+        metrics=metrics,
+        report=report,
+        error=error,
+        timings=timings,
+        charged=charged,
+        created_at=datetime.now(timezone.utc),
+    )
+
+    user_values = {}
+    if status == AnalysisStatus.DONE and metrics is not None:
+        user_values["last_analysis_metrics"] = metrics
+    if charge:
+        user_values["analyses_left"] = case((users.c.analyses_left > 0, users.c.analyses_left - 1), else_=users.c.analyses_left)
+
+    settled = None
     async with async_session() as session:
         async with session.begin():
-            user = await session.get(User, user_id)
-            if user:
-                user.last_analysis_metrics = metrics
-                await session.commit()
-                logger.info(f"Saved latest analysis metrics for user {user_id}")
+            if reservation_id is not None:
+                settled = await _settle_reservation(session, reservation_id, commit=status == AnalysisStatus.DONE)
+            if user_values:
+                user_update = update(users).where(users.c.id == user_id).values(**user_values)
+                if engine.dialect.name == "postgresql":
+                    insert_stmt = insert_stmt.add_cte(user_update.returning(users.c.id).cte("user_update"))
+                else:
+                    await session.execute(user_update)
+            await session.execute(insert_stmt)
+    if user_values:
+        await entitlements.invalidate(user_id)
+    elif settled is not None and status != AnalysisStatus.DONE:
+        await _refund_cached(settled)
+    logger.info(f"Recorded {status.value} analysis for user {user_id} (charged: {charged})")
+
+
+async def reserve_quota(user_id: int, kind: QuotaKind) -> int | None:
+    """Moves one credit from the user's balance into a reservation; None if the balance is empty.
+
+    The balance check and the debit are one conditional UPDATE, so concurrent
+    requests can never spend the same credit twice.
+    """
+    users = User.__table__
+    reservations = QuotaReservation.__table__
+    balance = users.c[_QUOTA_COLUMNS[kind]]
+    debit = update(users).where(users.c.id == user_id, balance > 0).values({balance: balance - 1}).returning(users.c.id)
+    row_values = {
+        "kind": literal(kind, reservations.c.kind.type),
+        "status": literal(ReservationStatus.RESERVED, reservations.c.status.type),
+        "created_at": literal(datetime.now(timezone.utc), reservations.c.created_at.type),
+    }
+
+    async with async_session() as session:
+        async with session.begin():
+            if engine.dialect.name == "postgresql":
+                debit_cte = debit.cte("debit")
+                stmt = insert(reservations).from_select(
+                    ["user_id", *row_values],
+                    select(debit_cte.c.id, *row_values.values()),
+                ).returning(reservations.c.id)
+                reservation_id = (await session.execute(stmt)).scalar_one_or_none()
+            elif (await session.execute(debit)).first() is None:
+                reservation_id = None
+            else:
+                stmt = insert(reservations).values(user_id=user_id, **row_values).returning(reservations.c.id)
+                reservation_id = (await session.execute(stmt)).scalar_one()
+
+    if reservation_id is not None:
+        await entitlements.adjust(user_id, _QUOTA_COLUMNS[kind], -1)
+    return reservation_id
 
 
-async def decrement_user_analyses(user_id: int) -> bool:
-    """Уменьшает количество оставшихся анализов пользователя на 1."""
+async def _settle_reservation(session: AsyncSession, reservation_id: int, commit: bool):
+    """Commits or releases a reservation that is still open; releasing refunds the credit.
+
+    Returns the reservation's (user_id, kind) row, or None if it was already settled.
+    """
+    users = User.__table__
+    reservations = QuotaReservation.__table__
+    settle = (
+        update(reservations)
+        .where(reservations.c.id == reservation_id, reservations.c.status == ReservationStatus.RESERVED)
+        .values(
+            status=ReservationStatus.COMMITTED if commit else ReservationStatus.RELEASED,
+            settled_at=datetime.now(timezone.utc),
+        )
+        .returning(reservations.c.user_id, reservations.c.kind)
+    )
+    row = (await session.execute(settle)).first()
+    if row is None:
+        return None
+    if not commit:
+        balance = users.c[_QUOTA_COLUMNS[QuotaKind(row.kind)]]
+        await session.execute(update(users).where(users.c.id == row.user_id).values({balance: balance + 1}))
+    return row
+
+
+async def _refund_cached(settled) -> None:
+    """Applies a released reservation's refund to the cached entitlement."""
+    await entitlements.adjust(settled.user_id, _QUOTA_COLUMNS[QuotaKind(settled.kind)], 1)
+
+
+async def commit_quota(reservation_id: int) -> bool:
+    """Keeps the reserved credit spent."""
     async with async_session() as session:
-        user = await session.get(User, user_id)
-        if user and user.analyses_left > 0:
-            user.analyses_left -= 1
-            await session.commit()
-            return True
+        async with session.begin():
+            return await _settle_reservation(session, reservation_id, commit=True) is not None
+
+
+async def release_quota(reservation_id: int) -> bool:
+    """Returns the reserved credit to the user's balance."""
+    async with async_session() as session:
+        async with session.begin():
+            settled = await _settle_reservation(session, reservation_id, commit=False)
+    if settled is None:
         return False
+    await _refund_cached(settled)
+    logger.info(f"Released quota reservation {reservation_id}")
+    return True
+
+
+async def release_stale_reservations(max_age_seconds: int) -> int:
+    """Refunds reservations whose work was lost (e.g. a task that never finished)."""
+    reservations = QuotaReservation.__table__
+    cutoff = datetime.now(timezone.utc) - timedelta(seconds=max_age_seconds)
+    async with async_session() as session:
+        async with session.begin():
+            result = await session.execute(
+                select(reservations.c.id).where(
+                    reservations.c.status == ReservationStatus.RESERVED,
+                    reservations.c.created_at < cutoff,
+                )
+            )
+            refunded = []
+            for reservation_id in result.scalars().all():
+                settled = await _settle_reservation(session, reservation_id, commit=False)
+                if settled is not None:
+                    refunded.append(settled)
+    for settled in refunded:
+        await _refund_cached(settled)
+    if refunded:
+        logger.warning(f"Released {len(refunded)} stale quota reservations")
+    return len(refunded)
 
 
 async def give_subscription_to_user(
@@ -230,7 +342,9 @@ async def give_subscription_to_user(
             if not user:
                 user = User(id=user_id)
                 session.add(user)
-            
+            was_paid = user.is_active_until is not None
+            was_pending = user.referral_payout_pending
+
             if user.is_active_until and user.is_active_until > datetime.now(timezone.utc):
                 # Если подписка уже активна, продлеваем ее
                 user.is_active_until += timedelta(days=days)
@@ -245,8 +359,19 @@ async def give_subscription_to_user(
             # Handle referral logic: if user was referred and this is their first payment, mark for payout
             if user.referred_by_id and not user.referral_payout_pending:
                 user.referral_payout_pending = True
-            
+
+            referrer_id = user.referred_by_id
+            if referrer_id:
+                await _bump_referral_counters(
+                    session, referrer_id,
+                    paid_referrals_count=int(not was_paid),
+                    pending_payouts_count=int(user.referral_payout_pending and not was_pending),
+                )
             await session.commit()
+    await entitlements.invalidate(user_id)
+    await admin_stats.invalidate()
+    if referrer_id and not was_paid:
+        await _sync_leaderboard(referrer_id)
 
 async def revoke_subscription(user_id: int) -> bool:
     """Revokes a user's subscription."""
@@ -259,8 +384,15 @@ async def revoke_subscription(user_id: int) -> bool:
             user.is_active_until = None
             user.analyses_left = 0
             user.messages_left = 0
+            referrer_id = user.referred_by_id
+            if referrer_id:
+                await _bump_referral_counters(session, referrer_id, paid_referrals_count=-1)
             await session.commit()
-            return True
+    await entitlements.invalidate(user_id)
+    await admin_stats.invalidate()
+    if referrer_id:
+        await _sync_leaderboard(referrer_id)
+    return True
 
 async def get_all_users() -> list[User]:
     """Получает всех пользователей из базы данных."""
@@ -289,6 +421,45 @@ async def get_unsubscribed_users() -> list[User]:
         return result.scalars().all()
 
 
+def _audience_filter(audience: str):
+    """WHERE clause of a broadcast audience: 'all', 'subscribed' or 'unsubscribed'."""
+    now = datetime.now(timezone.utc)
+    if audience == 'subscribed':
+        return User.is_active_until > now
+    if audience == 'unsubscribed':
+        return (User.is_active_until == None) | (User.is_active_until <= now)
+    return literal(True)
+
+
+async def get_broadcast_recipient_ids(audience: str, after_id: int, limit: int) -> list[int]:
+    """Next page of recipient IDs in ID order (keyset pagination); users who blocked the bot are skipped."""
+    async with async_session() as session:
+        result = await session.execute(
+            select(User.id)
+            .where(User.id > after_id, User.is_blocked == False, _audience_filter(audience))
+            .order_by(User.id)
+            .limit(limit)
+        )
+        return list(result.scalars().all())
+
+
+async def count_broadcast_recipients(audience: str) -> int:
+    async with async_session() as session:
+        result = await session.execute(
+            select(func.count(User.id)).where(User.is_blocked == False, _audience_filter(audience))
+        )
+        return result.scalar_one()
+
+
+async def mark_users_blocked(user_ids: list[int]) -> None:
+    """Flags users whose chats the bot can no longer write to."""
+    if not user_ids:
+        return
+    async with async_session() as session:
+        await session.execute(update(User).where(User.id.in_(user_ids)).values(is_blocked=True))
+        await session.commit()
+
+
 async def get_user_by_username(username: str) -> User | None:
     """Finds a user by their username (case-insensitive)."""
     async with async_session() as session:
@@ -311,7 +482,9 @@ async def set_ambassador_status(user_id: int, status: bool) -> bool:
                 return False
             user.is_ambassador = status
             await session.commit()
-            return True
+    await entitlements.invalidate(user_id)
+    await _sync_leaderboard(user_id)
+    return True
 
 
 async def get_all_ambassadors() -> list[User]:
@@ -323,6 +496,16 @@ async def get_all_ambassadors() -> list[User]:
         return list(result.scalars().all())
 
 
+def _referral_stats(user: User | None) -> dict:
+    if not user:
+        return {"total_referred": 0, "pending_payouts": 0, "total_paid_referrals": 0}
+    return {
+        "total_referred": user.referred_count,
+        "pending_payouts": user.pending_payouts_count,
+        "total_paid_referrals": user.paid_referrals_count,
+    }
+
+
 async def get_referral_stats(ambassador_id: int) -> dict:
     """Returns referral statistics for a specific ambassador.
 
@@ -330,97 +513,55 @@ async def get_referral_stats(ambassador_id: int) -> dict:
         total_referred:  Число пользователей, пришедших по ссылке (created with referred_by_id)
         pending_payouts: Число рефералов, у которых оплатa подтверждена и ждёт выплаты
         total_paid_referrals: Число рефералов с любой активной подпиской (для общей аналитики)
+        leaderboard_rank: Место в рейтинге амбассадоров (None, если рейтинг недоступен)
     """
     async with async_session() as session:
-        # 1. Всего пришедших (по ссылке)
-        total_ref_result = await session.execute(
-            select(func.count(User.id)).where(
-                User.referred_by_id == ambassador_id
-            )
-        )
-        total_referred = total_ref_result.scalar_one()
-
-        # 2. Ожидают выплаты (pending)
-        pending_result = await session.execute(
-            select(func.count(User.id)).where(
-                User.referred_by_id == ambassador_id,
-                User.referral_payout_pending == True
-            )
-        )
-        pending_count = pending_result.scalar_one()
-
-        # 3. Всего оплативших (имеют активную подписку)
-        total_paid_result = await session.execute(
-            select(func.count(User.id)).where(
-                User.referred_by_id == ambassador_id,
-                User.is_active_until != None
-            )
-        )
-        total_paid_count = total_paid_result.scalar_one()
-
-        return {
-            "total_referred": total_referred,
-            "pending_payouts": pending_count,
-            "total_paid_referrals": total_paid_count,
-        }
+        # Счётчики хранятся в строке амбассадора
+        stats = _referral_stats(await session.get(User, ambassador_id))
+    rank = await leaderboard.rank(ambassador_id)
+    if rank is None and await leaderboard.top(1) is None:
+        # Рейтинг пропал (Redis сброшен): восстанавливаем его из счётчиков в БД
+        async with async_session() as session:
+            await _rebuild_leaderboard(session)
+        rank = await leaderboard.rank(ambassador_id)
+    stats["leaderboard_rank"] = rank
+    return stats
 
 
 async def get_bulk_referral_stats(ambassador_ids: list[int]) -> dict[int, dict]:
-    """Returns referral statistics for many ambassadors in one pass.
+    """Returns referral statistics for many ambassadors in one query, keyed by ambassador_id.
 
-    The returned dict is keyed by ambassador_id and each value contains:
-        total_referred        – users that came with this referral code
-        pending_payouts       – first-time payers awaiting payout
-        total_paid_referrals  – users with any active subscription
-    Designed to minimise DB queries when there are many ambassadors.
+    Each value has the same keys as `get_referral_stats` (without the rank).
     """
     if not ambassador_ids:
         return {}
+    async with async_session() as session:
+        result = await session.execute(select(User).where(User.id.in_(ambassador_ids)))
+        users = {user.id: user for user in result.scalars().all()}
+    return {amb_id: _referral_stats(users.get(amb_id)) for amb_id in ambassador_ids}
 
-    # Initialise result structure
-    stats: dict[int, dict] = {
-        amb_id: {
-            "total_referred": 0,
-            "pending_payouts": 0,
-            "total_paid_referrals": 0,
-        }
-        for amb_id in ambassador_ids
-    }
 
-    async with async_session() as session:
-        # 1. Total referred
-        result = await session.execute(
-            select(User.referred_by_id, func.count(User.id)).where(
-                User.referred_by_id.in_(ambassador_ids)
-            ).group_by(User.referred_by_id)
-        )
-        for amb_id, cnt in result.all():
-            if amb_id in stats:
-                stats[amb_id]["total_referred"] = cnt
+async def _rebuild_leaderboard(session: AsyncSession) -> list[User]:
+    """Refills the leaderboard from the ambassadors' DB counters; returns the ambassadors."""
+    result = await session.execute(select(User).where(User.is_ambassador == True))
+    ambassadors = list(result.scalars().all())
+    await leaderboard.rebuild({amb.id: amb.paid_referrals_count for amb in ambassadors})
+    return ambassadors
 
-        # 2. Pending payouts
-        result = await session.execute(
-            select(User.referred_by_id, func.count(User.id)).where(
-                User.referred_by_id.in_(ambassador_ids),
-                User.referral_payout_pending.is_(True),
-            ).group_by(User.referred_by_id)
-        )
-        for amb_id, cnt in result.all():
-            if amb_id in stats:
-                stats[amb_id]["pending_payouts"] = cnt
 
-        # 3. Total paid
+async def get_ambassador_leaderboard() -> list[User]:
+    """Ambassadors ordered by paid referrals, most first; the rows carry their referral counters."""
+    ranked_ids = await leaderboard.top()
+    async with async_session() as session:
+        if ranked_ids is None:
+            # The board is missing (first use or Redis flushed): rebuild it from the DB
+            ambassadors = await _rebuild_leaderboard(session)
+            return sorted(ambassadors, key=lambda amb: amb.paid_referrals_count, reverse=True)
         result = await session.execute(
-            select(User.referred_by_id, func.count(User.id)).where(
-                User.referred_by_id.in_(ambassador_ids),
-                User.is_active_until.is_not(None),
-            ).group_by(User.referred_by_id)
+            select(User).where(User.id.in_(ranked_ids), User.is_ambassador == True)
         )
-        for amb_id, cnt in result.all():
-            if amb_id in stats:
-                stats[amb_id]["total_paid_referrals"] = cnt
-
-    return stats
+        users = {user.id: user for user in result.scalars().all()}
+    return [users[amb_id] for amb_id in ranked_ids if amb_id in users]
 
 
 async def confirm_referral_payouts(ambassador_id: int) -> int:
@@ -441,73 +582,59 @@ async def confirm_referral_payouts(ambassador_id: int) -> int:
                 count += 1
 
             if count > 0:
+                await _bump_referral_counters(session, ambassador_id, pending_payouts_count=-count)
                 await session.commit()
-            
-            return count
 
+    if count:
+        await admin_stats.invalidate()
+    return count
 
-async def get_bot_statistics() -> dict:
-    """Retrieves general bot statistics."""
-    async with async_session() as session:
-        total_users = await session.execute(select(func.count(User.id)))
-        
-        active_subscriptions = await session.execute(
-            select(func.count(User.id)).where(User.is_active_until > datetime.now(timezone.utc))
-        )
-        
-        return {
-            "total_users": total_users.scalar_one(),
-            "active_subscriptions": active_subscriptions.scalar_one(),
-        }
 
-async def get_subscription_stats() -> dict:
-    """Returns detailed subscription statistics, broken down by source."""
+async def _compute_admin_statistics() -> dict:
+    """All admin panel counters in one pass over `users` (conditional aggregates)."""
     now = datetime.now(timezone.utc)
-    async with async_session() as session:
-        # Base query for all active subscriptions
-        active_subs_query = select(User).where(User.is_active_until > now)
-        active_subs_result = await session.execute(active_subs_query)
-        active_subs = active_subs_result.scalars().all()
-
-        total_active = len(active_subs)
-        total_purchased = sum(1 for u in active_subs if u.subscription_source == 'purchased')
-        total_granted = sum(1 for u in active_subs if u.subscription_source == 'granted')
-        # For legacy users who got a sub before this field was added
-        total_other = total_active - total_purchased - total_granted
-
-        # New users in the last periods (based on when their sub was last updated)
-        def _count_new_since(ts):
-            count = 0
-            for u in active_subs:
-                if not u.updated_at:
-                    continue
-                # Make updated_at timezone-aware before comparing
-                updated_at_aware = u.updated_at.replace(tzinfo=timezone.utc) if u.updated_at.tzinfo is None else u.updated_at
-                if updated_at_aware >= ts:
-                    count += 1
-            return count
-
-        new_24h = _count_new_since(now - timedelta(hours=24))
-        new_48h = _count_new_since(now - timedelta(hours=48))
-        new_7d = _count_new_since(now - timedelta(days=7))
-
-        return {
-            "total_active": total_active,
-            "total_purchased": total_purchased,
-            "total_granted": total_granted,
-            "total_other": total_other,
-            "new_24h": new_24h,
-            "new_48h": new_48h,
-            "new_7d": new_7d,
-        }
+    active = User.is_active_until > now
+
+    def count_where(*conditions):
+        return func.count(case((and_(*conditions), 1)))
 
-async def get_pending_payouts_count() -> int:
-    """Returns number of referred users awaiting payout across all ambassadors."""
     async with async_session() as session:
         result = await session.execute(
-            select(func.count(User.id)).where(User.referral_payout_pending == True)
+            select(
+                func.count(User.id),
+                count_where(active),
+                count_where(active, User.subscription_source == 'purchased'),
+                count_where(active, User.subscription_source == 'granted'),
+                # New subscriptions: based on when the subscribed user was last updated
+                count_where(active, User.updated_at >= now - timedelta(hours=24)),
+                count_where(active, User.updated_at >= now - timedelta(hours=48)),
+                count_where(active, User.updated_at >= now - timedelta(days=7)),
+                count_where(User.referral_payout_pending == True),
+            )
         )
-        return result.scalar_one()
+        total_users, total_active, purchased, granted, new_24h, new_48h, new_7d, pending = result.one()
+
+    return {
+        "total_users": total_users,
+        "total_active": total_active,
+        "total_purchased": purchased,
+        "total_granted": granted,
+        # For legacy users who got a sub before the source field was added
+        "total_other": total_active - purchased - granted,
+        "new_24h": new_24h,
+        "new_48h": new_48h,
+        "new_7d": new_7d,
+        "pending_payouts": pending,
+    }
+
+
+async def get_admin_statistics() -> dict:
+    """Bot, subscription and payout statistics for the admin panel, from the cached snapshot."""
+    stats, generation = await admin_stats.lookup()
+    if stats is None:
+        stats = await _compute_admin_statistics()
+        await admin_stats.store(stats, generation)
+    return stats
 
 
 async def get_user_detailed_stats(user_id: int) -> dict:
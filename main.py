@@ -55,18 +55,25 @@ from admin_handlers import admin_router
 # --- Импорт модулей проекта ---
 from core.payments import create_yookassa_payment
 from database import (
-    create_db_and_tables, add_user, check_subscription, 
-    give_subscription_to_user, get_user, decrement_user_analyses, decrement_user_messages,
-    get_bot_statistics, get_subscription_stats, get_pending_payouts_count,
-    get_user_detailed_stats, get_user_by_username, revoke_subscription, get_all_users,
-    get_all_ambassadors, get_referral_stats, set_ambassador_status, confirm_referral_payouts
+    create_db_and_tables, add_user, give_subscription_to_user,
+    get_user_detailed_stats, get_user_by_username, revoke_subscription,
+    get_all_ambassadors, get_referral_stats, set_ambassador_status, confirm_referral_payouts,
+    reserve_quota, commit_quota, release_quota, get_entitlement
 )
+from models import QuotaKind
 
 from core.report_logic import generate_report_text
-from core.integrations.deepseek import get_deepseek_response
+from core import broadcast, entitlements, prompts, retrieval
+from core.integrations.deepseek import deepseek_client, get_deepseek_response
 from core.utils import split_long_message, sanitize_html_for_telegram
 from core.validators import detect_face, check_head_pose, is_bright_enough
-import redis.asyncio as redis
+from core.photo_store import put_photo
+from core.analysis_dedup import pop_deduplicated_task
+from core.redis_client import get_redis
+from core.fsm_storage import CompactRedisStorage
+from core.edit_scheduler import edit_scheduler
+from core.chat_history import append_turn, build_context, clear_history
+from task_queue import AnalysisScheduler
 
 # --- Состояния FSM ---
 
@@ -94,12 +101,16 @@ YOOKASSA_WEBHOOK_PATH = os.getenv("YOOKASSA_WEBHOOK_PATH", "/yookassa/webhook")
 if not BOT_TOKEN:
     raise ValueError("Токен бота не найден. Проверьте .env файл.")
 
-dp = Dispatcher()
+redis_client = get_redis()
+# Состояния FSM живут в Redis: переживают рестарт и общие для всех реплик веб-приложения
+dp = Dispatcher(storage=CompactRedisStorage(redis_client))
 
 # Регистрируем админ-роутер в первую очередь, чтобы его хендлеры имели приоритет
 dp.include_router(admin_router)
 bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-redis_client = redis.from_url(os.getenv("REDIS_URL", "redis://localhost"))
+# Drops cached entitlements changed by the worker (refunds, finished analyses)
+entitlement_updates_task: asyncio.Task | None = None
+analysis_scheduler = AnalysisScheduler(redis_client)
 
 # --- Клавиатуры --- #
 def escape_html(text: str) -> str:
@@ -126,23 +137,23 @@ def is_admin(user_id: int) -> bool:
 async def show_profile(callback: types.CallbackQuery, bot: Bot):
     """Shows the user's profile with subscription and referral stats."""
     user_id = callback.from_user.id
-    user = await get_user(user_id)
+    user = await get_entitlement(user_id)
 
-    if not user or not user.is_active_until or user.is_active_until < datetime.now(timezone.utc):
+    if not user or not user.has_subscription:
         await callback.answer("У вас нет активной подписки.", show_alert=True)
         return
 
     response_text = (
         f"<b>👤 Ваш профиль</b>\n\n"
-        f"Подписка активна до: {user.is_active_until.strftime('%d.%m.%Y')}\n"
+        f"Подписка активна до: {user.active_until.strftime('%d.%m.%Y')}\n"
         f"Анализов осталось: {user.analyses_left}\n"
         f"Сообщений осталось: {user.messages_left}"
     )
 
     if user.is_ambassador:
-        stats = await get_referral_stats(user.id)
+        stats = await get_referral_stats(user.user_id)
         bot_user = await bot.get_me()
-        referral_link = f"https://t.me/{bot_user.username}?start=ref{user.id}"
+        referral_link = f"https://t.me/{bot_user.username}?start=ref{user.user_id}"
         
         response_text += (
             f"\n\n<b>👑 Статус Амбассадора</b>\n"
@@ -151,6 +162,8 @@ async def show_profile(callback: types.CallbackQuery, bot: Bot):
             f"  - Всего оплативших: {stats['total_paid_referrals']}\n"
             f"  - Ожидают выплаты: {stats['pending_payouts']}"
         )
+        if stats['leaderboard_rank']:
+            response_text += f"\n  - Место в рейтинге: {stats['leaderboard_rank']}"
 
     await callback.message.answer(response_text, disable_web_page_preview=True)
     await callback.answer()
@@ -161,6 +174,7 @@ async def show_profile(callback: types.CallbackQuery, bot: Bot):
 async def cmd_start(message: types.Message, state: FSMContext, bot: Bot, command: CommandObject):
     await state.clear()
     user_id = message.from_user.id
+    await clear_history(user_id)
     # Parse referral code from the start command
     referred_by_id = None
     if command.args and command.args.startswith('ref'):
@@ -178,16 +192,15 @@ async def cmd_start(message: types.Message, state: FSMContext, bot: Bot, command
     await add_user(user_id, message.from_user.username, referred_by_id=referred_by_id)
     
     is_admin_user = is_admin(user_id)
-    has_subscription = await check_subscription(user_id)
+    user = await get_entitlement(user_id)
 
     if is_admin_user:
         await message.answer("👑 Добро пожаловать, Администратор!", reply_markup=get_main_keyboard(True))
         return
 
-    if has_subscription:
-        user = await get_user(user_id)
+    if user and user.has_subscription:
         await message.answer(
-            f"Добро пожаловать! У вас активная подписка до {user.is_active_until.strftime('%d.%m.%Y')}.\n"
+            f"Добро пожаловать! У вас активная подписка до {user.active_until.strftime('%d.%m.%Y')}.\n"
             f"Анализов осталось: {user.analyses_left}\n"
             f"Сообщений осталось: {user.messages_left}",
             reply_markup=get_main_keyboard(False)
@@ -252,14 +265,14 @@ async def begin_analysis_flow(message_or_cq: types.Message | types.CallbackQuery
         responder = message_or_cq.message
 
     if not is_admin(user_id):
-        if not await check_subscription(user_id):
+        user = await get_entitlement(user_id)
+        if not user or not user.has_subscription:
             payment = create_yookassa_payment(user_id, amount="999.00", bot_username=bot_username)
             keyboard = get_payment_keyboard(payment.confirmation.confirmation_url)
             await responder.answer("Для доступа к анализу необходима активная подписка.", reply_markup=keyboard)
             return
 
-        user = await get_user(user_id)
-        if user and user.analyses_left <= 0:
+        if user.analyses_left <= 0:
             payment = create_yookassa_payment(user_id, amount="999.00", bot_username=bot_username)
             keyboard = get_payment_keyboard(payment.confirmation.confirmation_url)
             await responder.answer("У вас закончились доступные анализы. Чтобы получить новые, оформите подписку.", reply_markup=keyboard)
@@ -297,15 +310,15 @@ async def analyze_command_handler(message: types.Message, state: FSMContext, bot
 async def stats_command_handler(message: types.Message, bot: Bot):
     """Handles the /stats command and shows user's subscription info."""
     user_id = message.from_user.id
-    user = await get_user(user_id)
+    user = await get_entitlement(user_id)
 
-    if not user or not user.is_active_until or user.is_active_until < datetime.now(timezone.utc):
+    if not user or not user.has_subscription:
         await message.answer("У вас нет активной подписки. Нажмите /start, чтобы узнать больше.")
         return
 
     response_text = (
         f"<b>📊 Ваша статистика</b>\n\n"
-        f"Подписка активна до: {user.is_active_until.strftime('%d.%m.%Y')}\n"
+        f"Подписка активна до: {user.active_until.strftime('%d.%m.%Y')}\n"
         f"Анализов осталось: {user.analyses_left}\n"
         f"Сообщений осталось: {user.messages_left}"
     )
@@ -313,8 +326,8 @@ async def stats_command_handler(message: types.Message, bot: Bot):
     # Если пользователь является амбассадором, добавляем реферальную статистику
     if user.is_ambassador:
         bot_user = await bot.get_me()
-        stats = await get_referral_stats(user.id)
-        referral_link = f"https://t.me/{bot_user.username}?start=ref{user.id}"
+        stats = await get_referral_stats(user.user_id)
+        referral_link = f"https://t.me/{bot_user.username}?start=ref{user.user_id}"
         
         response_text += (
             f"\n\n<b>👑 Статус Амбассадора</b>\n"
@@ -324,6 +337,8 @@ async def stats_command_handler(message: types.Message, bot: Bot):
             f"  - Всего оплативших: {stats['total_paid_referrals']}\n"
             f"  - Ожидают выплаты: {stats['pending_payouts']}"
         )
+        if stats['leaderboard_rank']:
+            response_text += f"\n  - Место в рейтинге: {stats['leaderboard_rank']}"
 
     await message.answer(response_text, disable_web_page_preview=True)
 
@@ -334,7 +349,7 @@ async def handle_front_photo(message: Message, state: FSMContext, bot: Bot):
     photo_bytes = (await bot.download_file(file_info.file_path)).read()
 
     # 1. Проверка яркости
-    if not is_bright_enough(photo_bytes):
+    if not await asyncio.to_thread(is_bright_enough, photo_bytes):
         await message.answer("❌ <b>Слишком темное фото.</b>\n\nПожалуйста, сделайте фото при хорошем, равномерном освещении.")
         return
 
@@ -357,8 +372,12 @@ async def handle_front_photo(message: Message, state: FSMContext, bot: Bot):
         await message.answer(error_message, parse_mode=ParseMode.HTML)
         return
 
-    # Все проверки пройдены
-    await state.update_data(front_photo_id=message.photo[-1].file_id)
+    # Все проверки пройдены: отдаём байты воркеру, чтобы он не скачивал фото повторно
+    await put_photo(message.photo[-1].file_unique_id, photo_bytes)
+    await state.update_data(
+        front_photo_id=message.photo[-1].file_id,
+        front_photo_unique_id=message.photo[-1].file_unique_id,
+    )
     await state.set_state(AnalysisStates.awaiting_profile_photo)
     
     await bot.send_photo(
@@ -381,7 +400,7 @@ async def handle_profile_photo(message: Message, state: FSMContext, bot: Bot):
     photo_bytes = (await bot.download_file(file_info.file_path)).read()
 
     # 1. Проверка яркости
-    if not is_bright_enough(photo_bytes):
+    if not await asyncio.to_thread(is_bright_enough, photo_bytes):
         await message.answer("❌ <b>Слишком темное фото.</b>\n\nПожалуйста, сделайте фото при хорошем, равномерном освещении.")
         return
 
@@ -405,6 +424,7 @@ async def handle_profile_photo(message: Message, state: FSMContext, bot: Bot):
         return
 
     # Все проверки пройдены
+    await put_photo(message.photo[-1].file_unique_id, photo_bytes)
     user_data = await state.get_data()
     front_photo_id = user_data.get('front_photo_id')
     profile_photo_id = message.photo[-1].file_id
@@ -413,34 +433,55 @@ async def handle_profile_photo(message: Message, state: FSMContext, bot: Bot):
         user_id=message.from_user.id,
         chat_id=message.chat.id,
         front_photo_id=front_photo_id,
-        profile_photo_id=profile_photo_id
+        profile_photo_id=profile_photo_id,
+        front_photo_unique_id=user_data.get('front_photo_unique_id'),
+        profile_photo_unique_id=message.photo[-1].file_unique_id,
     )
     
     await message.answer("✅ <b>Отлично!</b>\n\nВаши фотографии приняты и отправлены на анализ. Ожидайте, это может занять несколько минут.")
     await state.clear()
 
-async def queue_analysis_task(user_id: int, chat_id: int, front_photo_id: str, profile_photo_id: str):
-    """Queues the analysis task and decrements the user's analysis count."""
+async def queue_analysis_task(
+    user_id: int,
+    chat_id: int,
+    front_photo_id: str,
+    profile_photo_id: str,
+    front_photo_unique_id: str | None = None,
+    profile_photo_unique_id: str | None = None,
+    force: bool = False,
+):
+    """Reserves one of the user's analyses and queues the task; the worker settles the reservation."""
     task_data = {
         "user_id": user_id,
         "chat_id": chat_id,
         "front_photo_id": front_photo_id,
-        "profile_photo_id": profile_photo_id
+        "profile_photo_id": profile_photo_id,
+        # Ключи байтов фото, уже скачанных ботом при проверке
+        "front_photo_unique_id": front_photo_unique_id,
+        "profile_photo_unique_id": profile_photo_unique_id,
+        # Полный анализ, даже если такие же фото уже анализировались
+        "force": force,
     }
+    reservation_id = None
     try:
-        # Проверяем, остались ли у пользователя анализы
+        # Резервируем анализ: два запроса на один оставшийся анализ не пройдут оба
+        priority = "admin"
         if not is_admin(user_id):
-            user = await get_user(user_id)
-            if not user or user.analyses_left <= 0:
+            reservation_id = await reserve_quota(user_id, QuotaKind.ANALYSIS)
+            if reservation_id is None:
                 bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
                 await bot.send_message(chat_id, "У вас закончились анализы. Оформите подписку, чтобы получить новые.")
                 return
+            task_data["reservation_id"] = reservation_id
+            priority = "paid"
 
-        await redis_client.lpush("analysis_queue", json.dumps(task_data))
-        logger.info(f"Task for user {user_id} has been added to the queue.")
+        task_id = await analysis_scheduler.submit(task_data, priority=priority)
+        logger.info(f"Task {task_id} ({priority}) for user {user_id} has been added to the queue.")
 
     except Exception as e:
         logger.error(f"Failed to queue analysis task for user {user_id}: {e}")
+        if reservation_id is not None:
+            await release_quota(reservation_id)
         bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
         await bot.send_message(chat_id, "Не удалось поставить задачу в очередь. Пожалуйста, попробуйте позже.")
 
@@ -448,6 +489,28 @@ async def queue_analysis_task(user_id: int, chat_id: int, front_photo_id: str, p
 
 
 
+@dp.callback_query(F.data == "force_reanalysis")
+async def force_reanalysis_callback(callback: types.CallbackQuery):
+    """Re-runs the full analysis for photos that matched a previous analysis."""
+    user_id = callback.from_user.id
+    task_data = await pop_deduplicated_task(user_id)
+    if not task_data:
+        await callback.answer("Эти фото больше недоступны для повторного анализа. Начните новый: /analyze", show_alert=True)
+        return
+
+    await queue_analysis_task(
+        user_id=user_id,
+        chat_id=task_data["chat_id"],
+        front_photo_id=task_data["front_photo_id"],
+        profile_photo_id=task_data.get("profile_photo_id"),
+        front_photo_unique_id=task_data.get("front_photo_unique_id"),
+        profile_photo_unique_id=task_data.get("profile_photo_unique_id"),
+        force=True,
+    )
+    await callback.message.answer("🔄 Запускаю полный повторный анализ. Ожидайте, это может занять несколько минут.")
+    await callback.answer()
+
+
 # Должен срабатывать только когда нет активного FSM состояния (None) или пользователь в обычном чате
 @dp.message(F.text, StateFilter(None, ChatStates.chatting))
 async def handle_all_text(message: types.Message, state: FSMContext, bot: Bot):
@@ -461,94 +524,94 @@ async def handle_all_text(message: types.Message, state: FSMContext, bot: Bot):
         return
 
     user_id = message.from_user.id
-    user_info = await get_user(user_id)
-    has_subscription = await check_subscription(user_id)
+    user_info = await get_entitlement(user_id)
+    has_subscription = user_info is not None and user_info.has_subscription
 
     # Check if user has a subscription or is an admin
     if not has_subscription and not is_admin(user_id):
         await message.answer("Для общения с ND нужна активная подписка.")
         return
 
-    # Check if user has messages left
-    if not is_admin(user_id) and ((not user_info) or user_info.messages_left <= 0):
-        await message.answer("У вас закончились сообщения для чата с ND.")
+    # DeepSeek недоступен: отвечаем сразу, не списывая сообщение и не вешая обработчик
+    if not deepseek_client.is_available():
+        await message.answer("ND сейчас перегружен. Попробуйте написать через пару минут — сообщение не списано.")
         return
 
-    # Get chat history from FSM or initialize it
-    data = await state.get_data()
-    chat_history = data.get('chat_history', [])
-    user_question = message.text
+    # Reserve one message; it is only spent once the answer has been delivered
+    reservation_id = None
+    if not is_admin(user_id):
+        reservation_id = await reserve_quota(user_id, QuotaKind.MESSAGE)
+        if reservation_id is None:
+            await message.answer("У вас закончились сообщения для чата с ND.")
+            return
 
-    # --- Prepare context for the AI ---
-    system_prompt_addendum = ""
-    if user_info and user_info.last_analysis_metrics:
-        try:
-            # Округляем числовые значения для компактности
-            metrics_to_show = {k: round(v, 2) if isinstance(v, (int, float)) else v for k, v in user_info.last_analysis_metrics.items()}
-            metrics_str = json.dumps(metrics_to_show, ensure_ascii=False, indent=2)
-            system_prompt_addendum = f"\n\n### Контекст последнего анализа пользователя:\n{metrics_str}"
-        except (TypeError, json.JSONDecodeError):
-            logger.warning(f"Could not serialize last_analysis_metrics for user {user_id}")
+    # Everything after the reservation is guarded, so any failure gives the message back
+    sent_message = None
+    try:
+        # Последние реплики в пределах бюджета токенов; всё, что раньше, — в кратком содержании
+        chat_history, history_summary = await build_context(user_id)
+        user_question = message.text
 
-    sent_message = await message.answer("ND печатает...")
+        # --- Prepare context for the AI ---
+        system_prompt_addendum = ""
+        if user_info and user_info.last_analysis_metrics:
+            try:
+                # Округляем числовые значения для компактности
+                metrics_to_show = {k: round(v, 2) if isinstance(v, (int, float)) else v for k, v in user_info.last_analysis_metrics.items()}
+                metrics_str = json.dumps(metrics_to_show, ensure_ascii=False, indent=2)
+                system_prompt_addendum = f"\n\n### Контекст последнего анализа пользователя:\n{metrics_str}"
+            except (TypeError, json.JSONDecodeError):
+                logger.warning(f"Could not serialize last_analysis_metrics for user {user_id}")
+        if history_summary:
+            system_prompt_addendum += f"\n\n### Краткое содержание предыдущего диалога:\n{history_summary}"
+
+        sent_message = await message.answer("ND печатает...")
+        chat_id, message_id = sent_message.chat.id, sent_message.message_id
+
+        # Intermediate text goes out plain: half-written HTML would not parse
+        async def show(text: str, parse_mode: str | None = None):
+            await sent_message.edit_text(text, parse_mode=parse_mode)
 
-    try:
         full_response = ""
-        last_sent_text = ""
-        update_task = None
-        lock = asyncio.Lock()
-
-        # This task will periodically update the message in Telegram
-        async def message_updater():
-            nonlocal last_sent_text
-            while True:
-                await asyncio.sleep(1.5)  # Update every 1.5 seconds
-                async with lock:
-                    current_text = full_response
-                if current_text and current_text != last_sent_text:
-                    with suppress(TelegramBadRequest): # Ignore "message is not modified" errors
-                        await sent_message.edit_text(current_text + "▌") # Add cursor
-                    last_sent_text = current_text
-
-        update_task = asyncio.create_task(message_updater())
-
-        # Stream response from the AI, including the new context
-        async for chunk in get_deepseek_response(user_question, chat_history, system_prompt_addendum=system_prompt_addendum):
-            async with lock:
-                full_response += chunk
-
-        # Stop the updater task once streaming is complete
-        if update_task:
-            update_task.cancel()
-            with suppress(asyncio.CancelledError):
-                await update_task
+        knowledge = retrieval.format_sections(retrieval.sections_for_question(user_question))
+        # The shared scheduler coalesces these edits and paces them under Telegram's limits
+        async for chunk in get_deepseek_response(
+            user_question, chat_history, system_prompt_addendum=system_prompt_addendum, knowledge=knowledge
+        ):
+            full_response += chunk
+            edit_scheduler.submit(chat_id, message_id, full_response + "▌", show)
 
         # Send the final, complete message without the cursor
         if full_response:
             sanitized_response = sanitize_html_for_telegram(full_response)
             try:
-                await sent_message.edit_text(sanitized_response, parse_mode=ParseMode.HTML)
+                await edit_scheduler.submit(
+                    chat_id, message_id, sanitized_response,
+                    lambda text: show(text, ParseMode.HTML), final=True,
+                )
             except TelegramBadRequest:
-                await sent_message.edit_text(full_response) # Fallback
+                await edit_scheduler.submit(chat_id, message_id, full_response, show, final=True)  # Fallback
         else:
-            await sent_message.edit_text("Не удалось получить ответ. Попробуйте позже.")
+            await edit_scheduler.submit(chat_id, message_id, "Не удалось получить ответ. Попробуйте позже.", show, final=True)
+            if reservation_id is not None:
+                await release_quota(reservation_id)
+            return
 
-        # Update chat history and decrement messages
-        if not is_admin(user_id):
-            await decrement_user_messages(user_id)
+        # Update chat history and spend the reserved message
+        if reservation_id is not None:
+            await commit_quota(reservation_id)
         
-        chat_history.append({"role": "user", "content": user_question})
-        chat_history.append({"role": "assistant", "content": full_response})
-        # Limit history to the last 40 messages to avoid large context
-        if len(chat_history) > 40:
-            chat_history = chat_history[-40:]
-        await state.update_data(chat_history=chat_history)
+        await append_turn(user_id, user_question, full_response)
 
     except Exception as e:
         logger.error(f"Error processing text message for user {user_id}: {e}", exc_info=True)
-        if 'update_task' in locals() and update_task and not update_task.done():
-            update_task.cancel()
-        await sent_message.edit_text("Произошла ошибка при обработке вашего запроса.")
+        if reservation_id is not None:
+            await release_quota(reservation_id)
+        with suppress(Exception):
+            if sent_message is None:
+                await message.answer("Произошла ошибка при обработке вашего запроса.")
+            else:
+                await edit_scheduler.submit(chat_id, message_id, "Произошла ошибка при обработке вашего запроса.", show, final=True)
 
 
 # --- Запуск бота в режиме Webhook --- #
@@ -569,6 +632,10 @@ async def set_main_menu(bot: Bot):
 async def on_startup(bot: Bot):
     """Выполняется при старте бота."""
     await set_main_menu(bot)
+    prompts.log_token_report()
+    await broadcast.resume_broadcasts(bot)
+    global entitlement_updates_task
+    entitlement_updates_task = asyncio.create_task(entitlements.listen_updates())
     # Устанавливаем вебхук для Telegram на правильный путь
     # Безопасно обрезаем пробелы и слэш на конце у BASE_WEBHOOK_URL
     clean_base = (BASE_WEBHOOK_URL or "").strip().rstrip("/")
@@ -588,6 +655,9 @@ async def on_shutdown(bot: Bot):
     """Выполняется при остановке бота."""
     logger.info("Остановка бота, удаление вебхука и закрытие соединений...")
     await bot.delete_webhook()
+    await broadcast.stop_broadcasts()
+    if entitlement_updates_task:
+        entitlement_updates_task.cancel()
     await redis_client.close()
     logger.info("Соединение с Redis закрыто.")
 
@@ -635,6 +705,9 @@ async def main_polling():
 
     # Убедимся, что таблицы в БД созданы
     await create_db_and_tables()
+    prompts.log_token_report()
+    await broadcast.resume_broadcasts(bot)
+    updates_task = asyncio.create_task(entitlements.listen_updates())
 
     # Настраиваем и запускаем планировщик
     scheduler = setup_scheduler(bot)
@@ -648,6 +721,8 @@ async def main_polling():
         await bot.delete_webhook(drop_pending_updates=True)
         await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
     finally:
+        await broadcast.stop_broadcasts()
+        updates_task.cancel()
         await redis_client.aclose()
         logger.info("Соединение с Redis закрыто.")
 
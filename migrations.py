@@ -0,0 +1,190 @@
+"""Versioned schema migrations.
+
+The schema version is kept in the `schema_version` table. At startup
+`migrate()` reads it with a single query and returns when it is current,
+which is the normal case. Otherwise it takes a lock, so only one of the
+processes booting together (bot, worker) migrates: a PostgreSQL advisory
+lock, or the database write lock on SQLite. It re-reads the version under
+the lock and applies the missing steps in one transaction, together with
+their version rows.
+
+A fresh database gets all tables from the models and is stamped with the
+latest version. A database from before versioning goes through every
+step, so each step checks what already exists before changing it.
+
+To change the schema, append a step to MIGRATIONS; never edit a released one.
+"""
+
+import logging
+from typing import Awaitable, Callable, List, Tuple
+
+from sqlalchemy import inspect, text
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
+from sqlmodel import SQLModel
+
+import models  # noqa: F401 - registers the tables in SQLModel.metadata
+
+logger = logging.getLogger(__name__)
+
+# Any constant shared by all processes of the app
+MIGRATION_LOCK_ID = 72_410_625
+
+Step = Callable[[AsyncConnection], Awaitable[None]]
+
+
+async def _columns(conn: AsyncConnection, table: str) -> dict:
+    """Column name -> lower-case type name of an existing table."""
+    if conn.dialect.name == 'sqlite':
+        result = await conn.execute(text(f"PRAGMA table_info({table});"))
+        return {row[1]: str(row[2]).lower() for row in result.fetchall()}
+    result = await conn.execute(
+        text(
+            "SELECT column_name, data_type FROM information_schema.columns "
+            "WHERE table_schema = current_schema() AND table_name = :table;"
+        ),
+        {"table": table},
+    )
+    return {row[0]: row[1].lower() for row in result.fetchall()}
+
+
+async def _add_columns(conn: AsyncConnection, table: str, columns: dict) -> List[str]:
+    """Adds the missing ones of `columns` (name -> (sqlite type, postgresql type)); returns their names."""
+    existing = await _columns(conn, table)
+    added = []
+    for column, (sqlite_type, postgres_type) in columns.items():
+        if column in existing:
+            continue
+        column_type = sqlite_type if conn.dialect.name == 'sqlite' else postgres_type
+        await conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {column_type};"))
+        added.append(column)
+    if added:
+        logger.info(f"Added columns {added} to '{table}'")
+    return added
+
+
+# --- Steps ---
+
+async def _create_tables(conn: AsyncConnection) -> None:
+    """Tables from the models that do not exist yet (including analysis_results and quota_reservations)."""
+    await conn.run_sync(SQLModel.metadata.create_all)
+
+
+async def _add_legacy_user_columns(conn: AsyncConnection) -> None:
+    """Columns added to `users` by releases before versioned migrations."""
+    await _add_columns(conn, "users", {
+        "is_ambassador": ("BOOLEAN DEFAULT FALSE", "BOOLEAN DEFAULT FALSE"),
+        "referred_by_id": ("BIGINT", "BIGINT"),
+        "referral_payout_pending": ("BOOLEAN DEFAULT FALSE", "BOOLEAN DEFAULT FALSE"),
+        "last_analysis_metrics": ("JSON", "JSONB"),
+        "subscription_source": ("TEXT", "VARCHAR(255)"),
+    })
+
+
+async def _widen_id_columns(conn: AsyncConnection) -> None:
+    """Telegram IDs need BIGINT; only columns that are still narrower are altered (PostgreSQL only)."""
+    if conn.dialect.name == 'sqlite':
+        return  # SQLite integers are 64-bit already
+    # Child FK columns first to avoid constraint errors
+    for table, column in (("sessions", "user_id"), ("tasks", "session_id"), ("users", "id"), ("users", "referred_by_id")):
+        data_type = (await _columns(conn, table)).get(column)
+        if data_type and data_type != "bigint":
+            await conn.execute(text(f"ALTER TABLE {table} ALTER COLUMN {column} TYPE BIGINT USING {column}::BIGINT;"))
+            logger.info(f"Converted {table}.{column} to BIGINT")
+
+
+async def _add_is_blocked(conn: AsyncConnection) -> None:
+    await _add_columns(conn, "users", {"is_blocked": ("BOOLEAN DEFAULT FALSE", "BOOLEAN DEFAULT FALSE")})
+
+
+async def _add_referral_counters(conn: AsyncConnection) -> None:
+    """Per-referrer counters, filled in from the existing referrals."""
+    added = await _add_columns(conn, "users", {
+        column: ("INTEGER NOT NULL DEFAULT 0", "INTEGER NOT NULL DEFAULT 0")
+        for column in ("referred_count", "paid_referrals_count", "pending_payouts_count")
+    })
+    if not added:
+        return
+    await conn.execute(text("""
+        UPDATE users SET
+            referred_count = (SELECT COUNT(*) FROM users r WHERE r.referred_by_id = users.id),
+            paid_referrals_count = (
+                SELECT COUNT(*) FROM users r WHERE r.referred_by_id = users.id AND r.is_active_until IS NOT NULL
+            ),
+            pending_payouts_count = (
+                SELECT COUNT(*) FROM users r WHERE r.referred_by_id = users.id AND r.referral_payout_pending = TRUE
+            );
+    """))
+
+
+MIGRATIONS: List[Tuple[int, str, Step]] = [
+    (1, "create tables", _create_tables),
+    (2, "legacy user columns", _add_legacy_user_columns),
+    (3, "bigint id columns", _widen_id_columns),
+    (4, "users.is_blocked", _add_is_blocked),
+    (5, "referral counters", _add_referral_counters),
+]
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+# --- Runner ---
+
+async def _current_version(conn: AsyncConnection) -> int:
+    result = await conn.execute(text("SELECT MAX(version) FROM schema_version;"))
+    return result.scalar() or 0
+
+
+async def _fast_path_version(engine: AsyncEngine) -> int:
+    """The recorded version, or 0 when the version table does not exist yet.
+
+    Connection errors are raised as they are, not mistaken for an empty database.
+    """
+    async with engine.connect() as conn:
+        if not await conn.run_sync(lambda sync_conn: inspect(sync_conn).has_table("schema_version")):
+            return 0
+        return await _current_version(conn)
+
+
+async def _is_fresh(conn: AsyncConnection) -> bool:
+    return not await _columns(conn, "users")
+
+
+async def migrate(engine: AsyncEngine) -> None:
+    """Brings the schema to LATEST_VERSION; safe to call from several processes at once."""
+    version = await _fast_path_version(engine)
+    if version >= LATEST_VERSION:
+        logger.info(f"Database schema is up to date (version {version})")
+        return
+
+    async with engine.begin() as conn:
+        # Held until the transaction ends; the other booting processes wait here
+        if conn.dialect.name == 'postgresql':
+            await conn.execute(text("SELECT pg_advisory_xact_lock(:id);"), {"id": MIGRATION_LOCK_ID})
+        elif conn.dialect.name == 'sqlite':
+            # The driver would start a deferred transaction, which takes the write lock only at the
+            # first write; two processes could then both read an old version and both migrate
+            await conn.exec_driver_sql("BEGIN IMMEDIATE;")
+        await conn.execute(text(
+            "CREATE TABLE IF NOT EXISTS schema_version ("
+            "version INTEGER PRIMARY KEY, "
+            "description VARCHAR(255) NOT NULL, "
+            "applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP);"
+        ))
+        version = await _current_version(conn)
+        if version >= LATEST_VERSION:
+            return  # Another process migrated while we waited for the lock
+
+        pending = [m for m in MIGRATIONS if m[0] > version]
+        if version == 0 and await _is_fresh(conn):
+            # Empty database: the models already describe the latest schema
+            await _create_tables(conn)
+            logger.info(f"Created a fresh database schema at version {LATEST_VERSION}")
+        else:
+            for number, description, step in pending:
+                logger.info(f"Applying migration {number}: {description}")
+                await step(conn)
+        for number, description, _ in pending:
+            await conn.execute(
+                text("INSERT INTO schema_version (version, description) VALUES (:version, :description);"),
+                {"version": number, "description": description},
+            )
+    logger.info(f"Database schema migrated from version {version} to {LATEST_VERSION}")
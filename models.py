@@ -4,7 +4,7 @@ from datetime import datetime, timezone
 from enum import Enum
 from typing import Optional, Dict, Any
 
-from sqlalchemy import TIMESTAMP, BigInteger, ForeignKey
+from sqlalchemy import TIMESTAMP, BigInteger, ForeignKey, Text
 from sqlmodel import SQLModel, Field, JSON, Column
 
 
@@ -16,6 +16,26 @@ class SessionStatus(str, Enum):
     FAILED = "failed"
 
 
+class AnalysisStatus(str, Enum):
+    """Outcome of an analysis job."""
+    DONE = "done"
+    FAILED = "failed"
+    DEDUPLICATED = "deduplicated"
+
+
+class QuotaKind(str, Enum):
+    """Kind of credit a quota reservation holds."""
+    ANALYSIS = "analysis"
+    MESSAGE = "message"
+
+
+class ReservationStatus(str, Enum):
+    """Quota reservation lifecycle."""
+    RESERVED = "reserved"
+    COMMITTED = "committed"
+    RELEASED = "released"
+
+
 class TaskStatus(str, Enum):
     """Task processing status."""
     PENDING = "pending"
@@ -44,8 +64,14 @@ class User(SQLModel, table=True):
     is_ambassador: bool = Field(default=False, index=True)
     referred_by_id: Optional[int] = Field(default=None, sa_column=Column(BigInteger, ForeignKey("users.id")))
     referral_payout_pending: bool = Field(default=False, index=True)
+    # Counters over the users this one referred, kept up to date on add_user / subscription / payout events
+    referred_count: int = Field(default=0)
+    paid_referrals_count: int = Field(default=0)
+    pending_payouts_count: int = Field(default=0)
     subscription_source: Optional[str] = Field(default=None, index=True) # e.g., 'purchased', 'granted'
     last_analysis_metrics: Optional[Dict[str, Any]] = Field(default=None, sa_column=Column(JSON))
+    # The user blocked the bot; broadcasts skip them until they /start it again
+    is_blocked: bool = Field(default=False, index=True)
 
 
 class Session(SQLModel, table=True):
@@ -75,3 +101,37 @@ class Task(SQLModel, table=True):
     created_at: datetime = Field(default_factory=datetime.utcnow)
     started_at: Optional[datetime] = Field(default=None)
     finished_at: Optional[datetime] = Field(default=None)
+
+
+class AnalysisResult(SQLModel, table=True):
+    """One finished analysis job: what was computed, what the user got and what it cost."""
+
+    __tablename__ = "analysis_results"
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    user_id: int = Field(sa_column=Column(BigInteger, ForeignKey("users.id"), index=True))
+    session_id: Optional[int] = Field(default=None, foreign_key="sessions.id")
+    status: AnalysisStatus = Field(default=AnalysisStatus.DONE)
+    metrics: Optional[Dict[str, Any]] = Field(default=None, sa_column=Column(JSON))
+    report: Optional[str] = Field(default=None, sa_column=Column(Text))
+    error: Optional[str] = Field(default=None)
+    timings: Optional[Dict[str, float]] = Field(default=None, sa_column=Column(JSON))  # stage -> seconds
+    charged: bool = Field(default=False)
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc), sa_column=Column(TIMESTAMP(timezone=True)))
+
+
+class QuotaReservation(SQLModel, table=True):
+    """A credit taken from the user's balance until the work it pays for is done.
+
+    Reserving moves the credit out of analyses_left/messages_left; committing
+    keeps it spent, releasing returns it.
+    """
+
+    __tablename__ = "quota_reservations"
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    user_id: int = Field(sa_column=Column(BigInteger, ForeignKey("users.id"), index=True))
+    kind: QuotaKind
+    status: ReservationStatus = Field(default=ReservationStatus.RESERVED, index=True)
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc), sa_column=Column(TIMESTAMP(timezone=True)))
+    settled_at: Optional[datetime] = Field(default=None, sa_column=Column(TIMESTAMP(timezone=True)))
@@ -3,100 +3,569 @@
 import os
 import json
 import logging
+import socket
 import time
+import uuid
+import zlib
 import asyncio
-from typing import Optional, Dict, Any
+from dataclasses import dataclass
+from typing import Optional, Dict, Any, List
 import redis.asyncio as redis
+from redis.exceptions import ResponseError
 
 logger = logging.getLogger(__name__)
 
+# --- Analysis queue settings ---
+ANALYSIS_QUEUE_NAME = "analysis_queue"
+# Seconds a dequeued task stays invisible to other workers without a heartbeat
+ANALYSIS_LEASE_TIMEOUT = int(os.getenv("ANALYSIS_LEASE_TIMEOUT", "20"))
+# Deliveries after which a task is moved to the dead-letter list instead of being retried
+ANALYSIS_MAX_ATTEMPTS = int(os.getenv("ANALYSIS_MAX_ATTEMPTS", "3"))
+# 'streams' (consumer groups, several worker hosts) or 'list' (single Redis list)
+ANALYSIS_QUEUE_BACKEND = os.getenv("ANALYSIS_QUEUE_BACKEND", "streams")
+# Number of streams tasks are sharded over by user_id; tasks of one user are processed in order
+ANALYSIS_STREAM_SHARDS = int(os.getenv("ANALYSIS_STREAM_SHARDS", "16"))
+ANALYSIS_STREAM_GROUP = "analysis_workers"
+# Priority classes, highest first. Within a class users are served round-robin.
+PRIORITY_CLASSES = ("paid", "retry", "admin", "backfill")
+# Tasks the scheduler keeps in the backend queue at once; the rest wait in the fair queues.
+# Should be about the total number of runners across all workers.
+ANALYSIS_DISPATCH_WINDOW = int(os.getenv("ANALYSIS_DISPATCH_WINDOW", "16"))
+# Milliseconds a consumer may hold a shard while claiming its next task
+ANALYSIS_CLAIM_LOCK_TTL = 5000
+# Seconds after which a task picked by a dispatcher that died before enqueueing it is recovered
+ANALYSIS_HANDOFF_GRACE = 30
+
+
+# Atomically takes an expired task out of the in-flight list and re-queues it
+# (or dead-letters it). Returns 0 if the task was acked in the meantime.
+_REQUEUE_SCRIPT = """
+redis.call('ZREM', KEYS[2], ARGV[1])
+if redis.call('LREM', KEYS[1], 1, ARGV[1]) == 0 then
+    return 0
+end
+redis.call('RPUSH', KEYS[3], ARGV[2])
+return 1
+"""
+
+
+@dataclass
+class LeasedTask:
+    """A task taken from the analysis queue together with its lease handle."""
+
+    raw: bytes
+    id: str
+    attempts: int
+    data: Dict[str, Any]
+
+
+class AnalysisQueue:
+    """At-least-once Redis queue for analysis tasks.
+
+    Producers LPUSH task envelopes. A worker takes a task with BLMOVE into an
+    in-flight list and holds a lease on it in a sorted set (score = deadline).
+    The lease is extended while the task runs and removed by ack(); a reaper
+    puts tasks with expired leases back at the head of the queue, so work lost
+    to a crash or a deploy comes back within a lease timeout.
+    """
+
+    def __init__(
+        self,
+        redis_client: redis.Redis,
+        name: str = ANALYSIS_QUEUE_NAME,
+        lease_timeout: int = ANALYSIS_LEASE_TIMEOUT,
+        max_attempts: int = ANALYSIS_MAX_ATTEMPTS,
+    ):
+        self.redis = redis_client
+        self.queue_key = name
+        self.processing_key = f"{name}:processing"
+        self.leases_key = f"{name}:leases"
+        self.dead_key = f"{name}:dead"
+        self.lease_timeout = lease_timeout
+        self.max_attempts = max_attempts
+        self._requeue = self.redis.register_script(_REQUEUE_SCRIPT)
+
+    @staticmethod
+    def _encode(task_id: str, attempts: int, data: Dict[str, Any]) -> str:
+        return json.dumps({
+            "id": task_id,
+            "attempts": attempts,
+            "enqueued_at": int(time.time()),
+            "task": data,
+        })
+
+    @staticmethod
+    def _decode(raw: bytes) -> LeasedTask:
+        envelope = json.loads(raw)
+        if "task" not in envelope:
+            # Bare task dict pushed by an older producer
+            return LeasedTask(raw=raw, id=uuid.uuid4().hex, attempts=0, data=envelope)
+        return LeasedTask(raw=raw, id=envelope["id"], attempts=envelope["attempts"], data=envelope["task"])
+
+    async def enqueue(self, task_data: Dict[str, Any]) -> str:
+        """Adds a task to the tail of the queue and returns its id."""
+        task_id = uuid.uuid4().hex
+        await self.redis.lpush(self.queue_key, self._encode(task_id, 0, task_data))
+        return task_id
+
+    async def dequeue(self, timeout: int = 1) -> Optional[LeasedTask]:
+        """Takes the next task and leases it; returns None on timeout."""
+        raw = await self.redis.blmove(self.queue_key, self.processing_key, timeout, src="RIGHT", dest="LEFT")
+        if raw is None:
+            return None
+        await self.redis.zadd(self.leases_key, {raw: time.time() + self.lease_timeout})
 
-class TaskQueue:
-    """Redis-based task queue for background processing."""
-    
-    def __init__(self):
-        self.redis_url = os.getenv("REDIS_URL", "redis://localhost:6379")
-        self.queue_name = "hd_lookism:tasks"
-        self.redis: Optional[redis.Redis] = None
-    
-    async def connect(self) -> None:
-        """Connect to Redis."""
         try:
-            self.redis = redis.from_url(self.redis_url)
-            await self.redis.ping()
-            logger.info("Connected to Redis")
-        except Exception as e:
-            logger.error(f"Failed to connect to Redis: {e}")
-            raise
-    
-    async def disconnect(self) -> None:
-        """Disconnect from Redis."""
-        if self.redis:
-            await self.redis.close()
-            logger.info("Disconnected from Redis")
-    
-    async def enqueue(self, session_id: int) -> None:
-        """
-        Add a session to the processing queue.
-        
-        Args:
-            session_id: Session ID to process
-        """
-        if not self.redis:
-            raise RuntimeError("Redis not connected")
-        
-        task_data = {
-            "session_id": session_id,
-            "enqueued_at": str(int(time.time()))
-        }
-        
-        await self.redis.lpush(self.queue_name, json.dumps(task_data))
-        logger.info(f"Enqueued session {session_id} for processing")
-    
-    async def dequeue(self, timeout: int = 1) -> Optional[Dict[str, Any]]:
-        """
-        Get next task from queue (blocking).
-        
-        Args:
-            timeout: Timeout in seconds
-            
-        Returns:
-            Task data or None if timeout
+            task = self._decode(raw)
+        except (json.JSONDecodeError, KeyError, TypeError):
+            logger.error(f"Dropping malformed task from '{self.queue_key}': {raw!r}")
+            await self._requeue(keys=[self.processing_key, self.leases_key, self.dead_key], args=[raw, raw])
+            return None
+        return task
+
+    async def extend(self, task: LeasedTask) -> bool:
+        """Pushes the lease deadline forward; False if the lease was already reaped."""
+        changed = await self.redis.zadd(
+            self.leases_key, {task.raw: time.time() + self.lease_timeout}, xx=True, ch=True
+        )
+        return bool(changed)
+
+    async def ack(self, task: LeasedTask) -> None:
+        """Marks a task as finished and drops its lease."""
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.lrem(self.processing_key, 1, task.raw)
+            pipe.zrem(self.leases_key, task.raw)
+            await pipe.execute()
+
+    async def reap(self) -> List[LeasedTask]:
+        """Re-queues tasks whose lease expired and returns the ones given up on.
+
+        Safe to run from every worker process at once: each expired task is
+        moved by exactly one caller.
         """
-        if not self.redis:
-            raise RuntimeError("Redis not connected")
-        
+        # Tasks moved by BLMOVE whose owner died before writing the lease get one now
+        in_flight = await self.redis.lrange(self.processing_key, 0, -1)
+        if in_flight:
+            deadline = time.time() + self.lease_timeout
+            await self.redis.zadd(self.leases_key, {raw: deadline for raw in in_flight}, nx=True)
+
+        expired = await self.redis.zrangebyscore(self.leases_key, "-inf", time.time())
+        dead = []
+        for raw in expired:
+            try:
+                task = self._decode(raw)
+            except (json.JSONDecodeError, KeyError, TypeError):
+                await self._requeue(keys=[self.processing_key, self.leases_key, self.dead_key], args=[raw, raw])
+                continue
+
+            attempts = task.attempts + 1
+            if attempts >= self.max_attempts:
+                target, new_raw = self.dead_key, raw
+            else:
+                # Retries go to the head of the queue: the user has already waited once
+                target, new_raw = self.queue_key, self._encode(task.id, attempts, task.data)
+
+            moved = await self._requeue(keys=[self.processing_key, self.leases_key, target], args=[raw, new_raw])
+            if not moved:
+                continue
+            if target == self.dead_key:
+                logger.error(f"Task {task.id} failed {attempts} deliveries, moved to '{self.dead_key}'")
+                dead.append(task)
+            else:
+                logger.warning(f"Lease for task {task.id} expired, re-queued (attempt {attempts + 1})")
+        return dead
+
+    async def get_queue_size(self) -> int:
+        """Number of tasks waiting to be picked up."""
+        return await self.redis.llen(self.queue_key)
+
+
+# Releases a shard's claim lock only if it is still held by the caller
+_RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+# Resets the idle time of a pending entry (its lease) if the caller's consumer still owns it;
+# XCLAIM with JUSTID does not count as another delivery
+_EXTEND_LEASE_SCRIPT = """
+local pending = redis.call('XPENDING', KEYS[1], ARGV[1], ARGV[2], ARGV[2], 1)
+if #pending == 0 or pending[1][2] ~= ARGV[3] then
+    return 0
+end
+redis.call('XCLAIM', KEYS[1], ARGV[1], ARGV[3], 0, ARGV[2], 'JUSTID')
+return 1
+"""
+
+
+@dataclass
+class StreamLeasedTask(LeasedTask):
+    """A task read from a shard stream; the lease is its entry in the consumer group's pending list."""
+
+    stream: str
+    message_id: bytes
+
+
+class StreamAnalysisQueue:
+    """Redis Streams backend for analysis tasks with the AnalysisQueue interface.
+
+    Tasks are sharded over ANALYSIS_STREAM_SHARDS streams by user_id and read
+    through one consumer group, so worker processes on any number of hosts
+    share the load. A task is owned by the consumer it was delivered to for as
+    long as its pending entry is kept fresh by extend(); an entry idle for
+    longer than the lease (its consumer died) is reclaimed with XAUTOCLAIM
+    before new entries are read. Claims from one shard are serialized by a
+    short lock, so a user's tasks start in the order they were queued, while
+    the shard stays free for other users as soon as a task is claimed.
+    """
+
+    def __init__(
+        self,
+        redis_client: redis.Redis,
+        name: str = "analysis_stream",
+        shards: int = ANALYSIS_STREAM_SHARDS,
+        lease_timeout: int = ANALYSIS_LEASE_TIMEOUT,
+        max_attempts: int = ANALYSIS_MAX_ATTEMPTS,
+        consumer: Optional[str] = None,
+    ):
+        self.redis = redis_client
+        self.name = name
+        self.queue_key = name
+        self.shards = shards
+        self.group = ANALYSIS_STREAM_GROUP
+        self.consumer = consumer or f"{socket.gethostname()}-{os.getpid()}"
+        self.wake_key = f"{name}:wake"
+        self.dead_key = f"{name}:dead"
+        self.lease_timeout = lease_timeout
+        self.max_attempts = max_attempts
+        self._release_lock = self.redis.register_script(_RELEASE_LOCK_SCRIPT)
+        self._extend_lease = self.redis.register_script(_EXTEND_LEASE_SCRIPT)
+        self._groups_ready = False
+        self._next_shard = 0
+        self._dead: List[LeasedTask] = []
+
+    def _stream_key(self, shard: int) -> str:
+        return f"{self.name}:{shard}"
+
+    def _lock_key(self, stream: str) -> str:
+        return f"{stream}:lock"
+
+    def shard_for(self, task_data: Dict[str, Any]) -> int:
+        """Shard index for a task; all tasks of one user land in the same shard."""
+        user_id = task_data.get("user_id")
+        if isinstance(user_id, int):
+            return user_id % self.shards
+        return zlib.crc32(str(user_id).encode()) % self.shards
+
+    async def _ensure_groups(self) -> None:
+        if self._groups_ready:
+            return
+        for shard in range(self.shards):
+            try:
+                await self.redis.xgroup_create(self._stream_key(shard), self.group, id="0", mkstream=True)
+            except ResponseError as e:
+                if "BUSYGROUP" not in str(e):
+                    raise
+        self._groups_ready = True
+
+    async def _wake(self) -> None:
+        """Wakes one idle consumer; the list is capped since tokens only mean 'look again'."""
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.lpush(self.wake_key, 1)
+            pipe.ltrim(self.wake_key, 0, 63)
+            await pipe.execute()
+
+    async def enqueue(self, task_data: Dict[str, Any]) -> str:
+        """Appends a task to its user's shard stream and returns the message id."""
+        stream = self._stream_key(self.shard_for(task_data))
+        message_id = await self.redis.xadd(stream, {
+            "task": json.dumps(task_data),
+            "enqueued_at": int(time.time()),
+        })
+        await self._wake()
+        return message_id.decode() if isinstance(message_id, bytes) else message_id
+
+    def _to_task(self, stream: str, message_id: bytes, fields: Dict[bytes, bytes], attempts: int) -> StreamLeasedTask:
+        data = json.loads(fields[b"task"])
+        mid = message_id.decode() if isinstance(message_id, bytes) else message_id
+        return StreamLeasedTask(
+            raw=fields[b"task"], id=f"{stream}/{mid}", attempts=attempts, data=data,
+            stream=stream, message_id=message_id,
+        )
+
+    async def _dead_letter(self, stream: str, message_id: bytes, fields: Dict[bytes, bytes]) -> None:
+        """Moves an entry to the dead-letter stream and removes it from its shard."""
+        await self.redis.xadd(self.dead_key, fields)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.xack(stream, self.group, message_id)
+            pipe.xdel(stream, message_id)
+            await pipe.execute()
+
+    async def _decode(
+        self, stream: str, message_id: bytes, fields: Dict[bytes, bytes], attempts: int
+    ) -> Optional[StreamLeasedTask]:
+        """Builds the task; a malformed entry is dead-lettered instead, or it would block its shard forever."""
         try:
-            result = await self.redis.brpop(self.queue_name, timeout=timeout)
-            if result:
-                _, task_json = result
-                return json.loads(task_json)
-            return None
-        except Exception as e:
-            logger.error(f"Error dequeuing task: {e}")
+            return self._to_task(stream, message_id, fields, attempts)
+        except (json.JSONDecodeError, KeyError, UnicodeDecodeError):
+            logger.error(f"Malformed entry {message_id!r} in '{stream}', moved to '{self.dead_key}'", exc_info=True)
+            await self._dead_letter(stream, message_id, fields)
             return None
-    
+
+    async def _read_shard(self, stream: str) -> Optional[StreamLeasedTask]:
+        """Claims the next task of a shard: expired work first, then new entries.
+
+        Entries that are dead-lettered on the way are skipped, so one bad entry
+        never stalls the tasks queued behind it.
+        """
+        while True:
+            # Entries not extended for a whole lease belong to a consumer that died
+            # Reply is [next_id, claimed] on Redis 6.2 and [next_id, claimed, deleted] on 7+
+            claimed = (await self.redis.xautoclaim(
+                stream, self.group, self.consumer, min_idle_time=self.lease_timeout * 1000, start_id="0-0", count=1
+            ))[1]
+            if claimed:
+                message_id, fields = claimed[0]
+                if fields is None:  # Entry was deleted while pending
+                    await self.redis.xack(stream, self.group, message_id)
+                    continue
+                info = await self.redis.xpending_range(stream, self.group, min=message_id, max=message_id, count=1)
+                deliveries = info[0]["times_delivered"] if info else 1
+                if deliveries > self.max_attempts:
+                    # Checked on the raw entry: it has to leave the shard even if it cannot be decoded
+                    await self._dead_letter(stream, message_id, fields)
+                    logger.error(
+                        f"Entry {message_id!r} in '{stream}' failed {deliveries - 1} deliveries, moved to '{self.dead_key}'"
+                    )
+                    try:
+                        self._dead.append(self._to_task(stream, message_id, fields, deliveries - 1))
+                    except (json.JSONDecodeError, KeyError, UnicodeDecodeError):
+                        pass  # Nobody to notify
+                    continue
+                task = await self._decode(stream, message_id, fields, deliveries - 1)
+                if task is None:
+                    continue
+                logger.warning(f"Reclaimed task {task.id} from a dead consumer (attempt {deliveries})")
+                return task
+
+            response = await self.redis.xreadgroup(self.group, self.consumer, {stream: ">"}, count=1)
+            messages = [message for _, batch in response or [] for message in batch]
+            if not messages:
+                return None
+            message_id, fields = messages[0]
+            task = await self._decode(stream, message_id, fields, 0)
+            if task is not None:
+                return task
+
+    async def _poll_once(self) -> Optional[StreamLeasedTask]:
+        """One pass over all shards, starting where the previous pass stopped."""
+        for offset in range(self.shards):
+            shard = (self._next_shard + offset) % self.shards
+            stream = self._stream_key(shard)
+            token = f"{self.consumer}:{uuid.uuid4().hex}"
+            if not await self.redis.set(self._lock_key(stream), token, nx=True, px=ANALYSIS_CLAIM_LOCK_TTL):
+                continue  # Another consumer is claiming from this shard right now
+            try:
+                task = await self._read_shard(stream)
+            finally:
+                await self._release_lock(keys=[self._lock_key(stream)], args=[token])
+            if task is not None:
+                self._next_shard = (shard + 1) % self.shards
+                return task
+        return None
+
+    async def dequeue(self, timeout: int = 1) -> Optional[StreamLeasedTask]:
+        """Takes the next task from any free shard; returns None on timeout."""
+        await self._ensure_groups()
+        task = await self._poll_once()
+        if task is not None:
+            return task
+        # Nothing ready: block until a producer or an ack signals new work
+        if await self.redis.brpop(self.wake_key, timeout=timeout):
+            return await self._poll_once()
+        return None
+
+    async def extend(self, task: StreamLeasedTask) -> bool:
+        """Keeps the task's lease fresh; False if it was reclaimed by another consumer."""
+        extended = await self._extend_lease(keys=[task.stream], args=[self.group, task.message_id, self.consumer])
+        return bool(extended)
+
+    async def ack(self, task: StreamLeasedTask) -> None:
+        """Acknowledges and deletes the entry."""
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.xack(task.stream, self.group, task.message_id)
+            pipe.xdel(task.stream, task.message_id)
+            await pipe.execute()
+
+    async def reap(self) -> List[LeasedTask]:
+        """Returns tasks dead-lettered since the last call.
+
+        Expired work is reclaimed by dequeue() itself; this only hands over the
+        tasks that ran out of attempts so the caller can notify their users.
+        """
+        dead, self._dead = self._dead, []
+        return dead
+
+    async def absorb_list(self, list_keys: List[str]) -> int:
+        """Moves tasks left in list-backend keys into the streams (used when switching backends)."""
+        moved = 0
+        for key in list_keys:
+            while (raw := await self.redis.rpop(key)) is not None:
+                try:
+                    envelope = json.loads(raw)
+                except json.JSONDecodeError:
+                    logger.error(f"Dropping malformed task from '{key}': {raw!r}")
+                    continue
+                await self.enqueue(envelope.get("task", envelope))
+                moved += 1
+        if moved:
+            logger.info(f"Moved {moved} task(s) from list queue into '{self.name}' streams")
+        return moved
+
     async def get_queue_size(self) -> int:
-        """Get current queue size."""
-        if not self.redis:
-            return 0
-        
-        try:
-            return await self.redis.llen(self.queue_name)
-        except Exception as e:
-            logger.error(f"Error getting queue size: {e}")
-            return 0
+        """Number of tasks not yet finished, across all shards."""
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for shard in range(self.shards):
+                pipe.xlen(self._stream_key(shard))
+            return sum(await pipe.execute())
+
+    async def describe(self) -> List[Dict[str, Any]]:
+        """Per-shard view: backlog, pending entries and what each consumer holds."""
+        await self._ensure_groups()
+        shards = []
+        for shard in range(self.shards):
+            stream = self._stream_key(shard)
+            consumers = await self.redis.xinfo_consumers(stream, self.group)
+            pending = await self.redis.xpending(stream, self.group)
+            shards.append({
+                "shard": shard,
+                "length": await self.redis.xlen(stream),
+                "pending": pending["pending"],
+                "consumers": [
+                    {"name": c["name"].decode() if isinstance(c["name"], bytes) else c["name"], "pending": c["pending"], "idle_ms": c["idle"]}
+                    for c in consumers
+                ],
+            })
+        return shards
+
+
+def create_analysis_queue(redis_client: redis.Redis):
+    """Returns the analysis queue for the backend selected by ANALYSIS_QUEUE_BACKEND."""
+    if ANALYSIS_QUEUE_BACKEND == "list":
+        return AnalysisQueue(redis_client)
+    if ANALYSIS_QUEUE_BACKEND != "streams":
+        logger.warning(f"Unknown ANALYSIS_QUEUE_BACKEND '{ANALYSIS_QUEUE_BACKEND}', using streams")
+    return StreamAnalysisQueue(redis_client)
+
+
+# Appends a task to its user's list and puts the user on the class ring if not there yet
+_SUBMIT_SCRIPT = """
+redis.call('RPUSH', KEYS[1], ARGV[2])
+if redis.call('SADD', KEYS[2], ARGV[1]) == 1 then
+    redis.call('RPUSH', KEYS[3], ARGV[1])
+end
+return 1
+"""
+
+# Picks the next task: first non-empty class in priority order, next user on that
+# class ring. The user goes back to the tail of the ring while they have tasks left.
+# The picked task is parked in the handoff set until it reaches the backend queue.
+# ARGV: key prefix, now, classes...
+_DISPATCH_SCRIPT = """
+for i = 3, #ARGV do
+    local base = ARGV[1] .. ':' .. ARGV[i]
+    local uid = redis.call('LPOP', base .. ':ring')
+    if uid then
+        local user_key = base .. ':user:' .. uid
+        local raw = redis.call('LPOP', user_key)
+        if redis.call('LLEN', user_key) > 0 then
+            redis.call('RPUSH', base .. ':ring', uid)
+        else
+            redis.call('SREM', base .. ':members', uid)
+        end
+        if raw then
+            redis.call('ZADD', ARGV[1] .. ':handoff', ARGV[2], raw)
+            return raw
+        end
+    end
+end
+return false
+"""
+
+
+class AnalysisScheduler:
+    """Priority and per-user fair scheduling in front of the analysis queue.
+
+    Producers submit() tasks with a priority class. Dispatchers in the worker
+    processes move tasks into the backend queue only while its backlog is below
+    ANALYSIS_DISPATCH_WINDOW, always taking the highest non-empty class and,
+    within it, the next user round-robin. A user who submits five times gets
+    one slot per round, so a paid user's wait is bounded by the window and the
+    number of other users ahead of them, not by how much anyone else sends.
+    """
 
+    def __init__(self, redis_client: redis.Redis, prefix: str = "analysis_sched", window: int = ANALYSIS_DISPATCH_WINDOW):
+        self.redis = redis_client
+        self.prefix = prefix
+        self.window = window
+        self.wake_key = f"{prefix}:wake"
+        self.handoff_key = f"{prefix}:handoff"
+        self._submit = self.redis.register_script(_SUBMIT_SCRIPT)
+        self._dispatch = self.redis.register_script(_DISPATCH_SCRIPT)
 
-# Global queue instance
-task_queue = TaskQueue()
+    async def submit(self, task_data: Dict[str, Any], priority: str = "paid") -> str:
+        """Adds a task to its user's fair queue in the given class and returns its id."""
+        if priority not in PRIORITY_CLASSES:
+            raise ValueError(f"Unknown priority class '{priority}'")
+        task_id = uuid.uuid4().hex
+        user_id = str(task_data.get("user_id"))
+        base = f"{self.prefix}:{priority}"
+        raw = json.dumps({"id": task_id, "priority": priority, "submitted_at": time.time(), "task": task_data})
+        await self._submit(
+            keys=[f"{base}:user:{user_id}", f"{base}:members", f"{base}:ring"],
+            args=[user_id, raw],
+        )
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.lpush(self.wake_key, 1)
+            pipe.ltrim(self.wake_key, 0, 63)
+            await pipe.execute()
+        return task_id
 
+    async def _recover_handoffs(self, backend) -> None:
+        """Re-enqueues tasks a dispatcher picked but never handed to the backend."""
+        stale = await self.redis.zrangebyscore(self.handoff_key, "-inf", time.time() - ANALYSIS_HANDOFF_GRACE)
+        for raw in stale:
+            if await self.redis.zrem(self.handoff_key, raw):
+                entry = json.loads(raw)
+                await backend.enqueue(entry["task"])
+                logger.warning(f"Recovered task {entry['id']} lost between scheduler and queue")
 
-async def init_queue() -> None:
-    """Initialize the task queue."""
-    await task_queue.connect()
+    async def dispatch(self, backend) -> int:
+        """Fills the backend queue up to the window; returns how many tasks were moved."""
+        await self._recover_handoffs(backend)
+        room = self.window - await backend.get_queue_size()
+        moved = 0
+        while room > 0:
+            raw = await self._dispatch(args=[self.prefix, time.time(), *PRIORITY_CLASSES])
+            if raw is None:
+                break
+            entry = json.loads(raw)
+            await backend.enqueue(entry["task"])
+            await self.redis.zrem(self.handoff_key, raw)
+            waited = time.time() - entry["submitted_at"]
+            logger.info(f"Dispatched {entry['priority']} task {entry['id']} for user {entry['task'].get('user_id')} after {waited:.1f}s in scheduler")
+            room -= 1
+            moved += 1
+        return moved
 
+    async def wait_for_work(self, timeout: int = 1) -> None:
+        """Blocks until a task is submitted or the timeout passes."""
+        await self.redis.brpop(self.wake_key, timeout=timeout)
 
-async def close_queue() -> None:
-    """Close the task queue."""
-    await task_queue.disconnect()
+    async def get_backlog(self) -> Dict[str, int]:
+        """Number of users waiting in each priority class."""
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for priority in PRIORITY_CLASSES:
+                pipe.llen(f"{self.prefix}:{priority}:ring")
+            return dict(zip(PRIORITY_CLASSES, await pipe.execute()))
@@ -0,0 +1,8 @@
+"""Settings the app modules read at import time, set before any test imports them."""
+
+import os
+import tempfile
+
+os.environ.setdefault("DEEPSEEK_API_KEY", "test")
+# Always a throwaway SQLite file: tests must never touch the database from the developer's environment
+os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{tempfile.mkdtemp(prefix='lookism-tests-')}/test.db"
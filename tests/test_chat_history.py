@@ -0,0 +1,132 @@
+import asyncio
+import json
+
+import fakeredis
+
+from core import chat_history, redis_client
+from core.chat_history import estimate_tokens, split_by_budget
+
+USER_ID = 7
+
+
+def turn(i, length=10):
+    return [
+        {"role": "user", "content": f"q{i}" + "x" * length},
+        {"role": "assistant", "content": f"a{i}" + "x" * length},
+    ]
+
+
+def history(turns, length=10):
+    return [message for i in range(turns) for message in turn(i, length)]
+
+
+def tokens(messages):
+    return sum(estimate_tokens(m) for m in messages)
+
+
+def test_everything_fits():
+    messages = history(3)
+    older, recent = split_by_budget(messages, budget=10_000)
+    assert older == []
+    assert recent == messages
+
+
+def test_recent_is_the_longest_tail_within_budget():
+    messages = history(10)
+    turn_tokens = tokens(turn(0))
+    older, recent = split_by_budget(messages, budget=turn_tokens * 3 + 1)
+    assert recent == messages[-6:]
+    assert older + recent == messages
+
+
+def test_split_is_on_turn_boundaries():
+    messages = history(10)
+    for budget in range(1, tokens(messages) + 1, 7):
+        older, recent = split_by_budget(messages, budget=budget)
+        assert len(recent) % 2 == 0
+        assert recent[0]["role"] == "user"
+        assert older + recent == messages
+        assert tokens(recent) <= budget or len(recent) == 2
+
+
+def test_last_turn_is_kept_even_over_budget():
+    messages = history(4, length=10) + turn(4, length=5000)
+    older, recent = split_by_budget(messages, budget=50)
+    assert recent == messages[-2:]
+    assert older == messages[:-2]
+
+
+def test_last_turn_is_kept_with_zero_budget():
+    messages = history(2)
+    assert split_by_budget(messages, budget=0) == (messages[:2], messages[2:])
+
+
+def test_empty_history():
+    assert split_by_budget([], budget=100) == ([], [])
+
+
+def stored(messages):
+    """Messages serialized the way append_turn keeps them in Redis."""
+    return [json.dumps(m, ensure_ascii=False, separators=(",", ":")).encode() for m in messages]
+
+
+def run_fold(monkeypatch, seeded, during_summary):
+    """Runs two concurrent folds over `seeded`; `during_summary` acts on Redis while the summary is written."""
+    calls = []
+
+    async def summarize(previous, messages):
+        calls.append(messages)
+        await asyncio.sleep(0.01)  # Lets the second fold find the lock taken
+        await during_summary(redis_client.get_redis())
+        return "summary"
+
+    monkeypatch.setattr(chat_history, "_summarize", summarize)
+    monkeypatch.setattr(chat_history.deepseek_client, "is_available", lambda: True)
+
+    async def scenario():
+        redis_client._client = fakeredis.FakeAsyncRedis()
+        try:
+            client = redis_client.get_redis()
+            await client.rpush(chat_history._key(USER_ID), *stored(seeded))
+            await asyncio.gather(chat_history._fold_old_turns(USER_ID), chat_history._fold_old_turns(USER_ID))
+            return (
+                await client.lrange(chat_history._key(USER_ID), 0, -1),
+                await client.get(chat_history._summary_key(USER_ID)),
+                await client.exists(chat_history._lock_key(USER_ID)),
+            )
+        finally:
+            redis_client._client = None
+
+    return calls, asyncio.run(scenario())
+
+
+def test_fold_trims_the_list_and_stores_the_summary_once_under_concurrent_appends(monkeypatch):
+    seeded = history(chat_history.CHAT_HISTORY_LIMIT // 2, length=400)
+    older, recent = split_by_budget(seeded)
+    appended = history(3, length=400)
+    assert len(older) > len(appended)  # The appends below cut only messages that are being folded
+
+    async def append_turns(client):
+        key = chat_history._key(USER_ID)
+        for message in stored(appended):
+            await client.rpush(key, message)
+            await client.ltrim(key, -chat_history.CHAT_HISTORY_LIMIT, -1)
+
+    calls, (remaining, summary, locked) = run_fold(monkeypatch, seeded, append_turns)
+    assert calls == [older]
+    assert remaining == stored(recent + appended)
+    assert summary == b"summary"
+    assert not locked
+
+
+def test_fold_of_a_history_cleared_meanwhile_stores_nothing(monkeypatch):
+    seeded = history(chat_history.CHAT_HISTORY_LIMIT // 2, length=400)
+
+    async def clear(client):
+        await client.delete(chat_history._key(USER_ID), chat_history._summary_key(USER_ID))
+
+    calls, (remaining, summary, locked) = run_fold(monkeypatch, seeded, clear)
+    assert len(calls) == 1
+    assert remaining == []
+    assert summary is None
+    assert not locked
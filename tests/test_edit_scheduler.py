@@ -0,0 +1,162 @@
+import asyncio
+import contextlib
+
+import pytest
+
+from core.edit_scheduler import EditScheduler
+
+CHAT_INTERVAL = 0.05
+
+
+class LocalLimiter:
+    """In-process stand-in for AdaptiveRateLimiter: always has capacity, counts the feedback."""
+
+    def __init__(self):
+        self.successes = 0
+        self.overloads = 0
+
+    @contextlib.asynccontextmanager
+    async def slot(self, timeout):
+        yield
+
+    async def record_success(self):
+        self.successes += 1
+
+    async def record_overload(self):
+        self.overloads += 1
+
+
+class FloodError(Exception):
+    def __init__(self, retry_after):
+        super().__init__(f"Flood control exceeded, retry in {retry_after}")
+        self.retry_after = retry_after
+
+
+class Message:
+    """Records the texts shown in one message; `failures` are raised by the next edits, in order."""
+
+    def __init__(self, failures=()):
+        self.shown = []
+        self.failures = list(failures)
+
+    async def edit(self, text):
+        await asyncio.sleep(0.001)
+        if self.failures:
+            raise self.failures.pop(0)
+        self.shown.append(text)
+
+
+def make_scheduler():
+    limiter = LocalLimiter()
+    return EditScheduler(limiter, chat_interval=CHAT_INTERVAL, max_chat_interval=CHAT_INTERVAL * 4), limiter
+
+
+def test_first_edit_goes_out_and_later_texts_are_coalesced():
+    async def scenario():
+        scheduler, _ = make_scheduler()
+        message = Message()
+        scheduler.submit(1, 10, "a", message.edit)
+        await asyncio.sleep(0.01)
+        for text in ("ab", "abc", "abcd"):
+            scheduler.submit(1, 10, text, message.edit)
+        await asyncio.wait_for(scheduler.submit(1, 10, "abcde", message.edit, final=True), timeout=1)
+        return scheduler, message
+
+    scheduler, message = asyncio.run(scenario())
+    assert message.shown == ["a", "abcde"]
+    assert scheduler.coalesced == 3
+
+
+def test_final_future_resolves_after_its_text_is_shown_last():
+    async def scenario():
+        scheduler, _ = make_scheduler()
+        message = Message()
+        shown_when_resolved = []
+        for i in range(1, 6):
+            scheduler.submit(1, 10, "x" * i, message.edit)
+            await asyncio.sleep(CHAT_INTERVAL / 2)
+        final = scheduler.submit(1, 10, "final", message.edit, final=True)
+        final.add_done_callback(lambda _: shown_when_resolved.append(list(message.shown)))
+        await asyncio.wait_for(final, timeout=1)
+        await asyncio.sleep(CHAT_INTERVAL * 2)  # Nothing may be shown after the final text
+        return message, shown_when_resolved
+
+    message, shown_when_resolved = asyncio.run(scenario())
+    assert message.shown[-1] == "final"
+    assert shown_when_resolved == [message.shown]
+
+
+def test_rate_limited_final_edit_is_retried_and_slows_the_chat():
+    async def scenario():
+        scheduler, limiter = make_scheduler()
+        message = Message(failures=[FloodError(CHAT_INTERVAL)])
+        await asyncio.wait_for(scheduler.submit(1, 10, "final", message.edit, final=True), timeout=1)
+        return scheduler, limiter, message
+
+    scheduler, limiter, message = asyncio.run(scenario())
+    assert message.shown == ["final"]
+    assert limiter.overloads == 1
+    assert scheduler._chat_intervals[1] > CHAT_INTERVAL
+
+
+def test_newer_text_submitted_during_a_failed_final_edit_keeps_the_waiter():
+    async def scenario():
+        scheduler, _ = make_scheduler()
+        message = Message(failures=[FloodError(CHAT_INTERVAL)])
+        first_final = scheduler.submit(1, 10, "v1", message.edit, final=True)
+        await asyncio.sleep(0)  # The edit of "v1" is now in flight and will hit the flood limit
+        second_final = scheduler.submit(1, 10, "v2", message.edit, final=True)
+        await asyncio.wait_for(asyncio.gather(first_final, second_final), timeout=1)
+        return message
+
+    message = asyncio.run(scenario())
+    assert message.shown == ["v2"]
+
+
+def test_final_edit_error_is_raised_to_the_caller():
+    async def scenario():
+        scheduler, _ = make_scheduler()
+        message = Message(failures=[RuntimeError("message to edit not found")])
+        await asyncio.wait_for(scheduler.submit(1, 10, "final", message.edit, final=True), timeout=1)
+
+    with pytest.raises(RuntimeError, match="not found"):
+        asyncio.run(scenario())
+
+
+def test_not_modified_counts_as_shown():
+    async def scenario():
+        scheduler, _ = make_scheduler()
+        message = Message(failures=[RuntimeError("Bad Request: message is not modified")])
+        await asyncio.wait_for(scheduler.submit(1, 10, "same", message.edit, final=True), timeout=1)
+
+    asyncio.run(scenario())
+
+
+def test_chats_are_paced_independently():
+    async def scenario():
+        scheduler, _ = make_scheduler()
+        slow_chat, other_chat = Message(), Message()
+        scheduler.submit(1, 10, "a", slow_chat.edit)
+        await asyncio.sleep(0.01)
+        scheduler.submit(1, 10, "ab", slow_chat.edit)  # Waits for chat 1's interval
+        await asyncio.wait_for(scheduler.submit(2, 20, "b", other_chat.edit, final=True), timeout=CHAT_INTERVAL / 2)
+        return slow_chat, other_chat
+
+    slow_chat, other_chat = asyncio.run(scenario())
+    assert other_chat.shown == ["b"]
+    assert slow_chat.shown == ["a"]
+
+
+def test_failed_intermediate_edit_is_not_counted_as_success():
+    async def scenario():
+        scheduler, limiter = make_scheduler()
+        scheduler._chat_intervals[1] = CHAT_INTERVAL * 2  # Slowed down by an earlier 429
+        message = Message(failures=[RuntimeError("Bad Request: message to edit not found")])
+        scheduler.submit(1, 10, "partial", message.edit)
+        await asyncio.sleep(0.02)
+        return scheduler, limiter, message
+
+    scheduler, limiter, message = asyncio.run(scenario())
+    assert message.shown == []
+    assert limiter.successes == 0
+    assert scheduler._chat_intervals[1] == CHAT_INTERVAL * 2
@@ -0,0 +1,168 @@
+import asyncio
+import sqlite3
+
+import pytest
+from sqlalchemy import event, text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.asyncio import create_async_engine
+
+import migrations
+
+# `users` as it was before versioned migrations, without the columns the later steps add
+LEGACY_USERS = """
+CREATE TABLE users (
+    id BIGINT PRIMARY KEY,
+    username VARCHAR,
+    is_active_until TIMESTAMP,
+    analyses_left INTEGER NOT NULL DEFAULT 0,
+    messages_left INTEGER NOT NULL DEFAULT 0,
+    created_at TIMESTAMP,
+    updated_at TIMESTAMP,
+    is_ambassador BOOLEAN DEFAULT FALSE,
+    referred_by_id BIGINT,
+    referral_payout_pending BOOLEAN DEFAULT FALSE
+);
+"""
+
+
+def run(tmp_path, scenario):
+    async def wrapper():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/migrations.db")
+        try:
+            return await scenario(engine)
+        finally:
+            await engine.dispose()
+
+    return asyncio.run(wrapper())
+
+
+async def versions(engine):
+    async with engine.connect() as conn:
+        result = await conn.execute(text("SELECT version FROM schema_version ORDER BY version;"))
+        return [row[0] for row in result.fetchall()]
+
+
+async def user_columns(engine):
+    async with engine.connect() as conn:
+        return await migrations._columns(conn, "users")
+
+
+def test_fresh_database_is_created_and_stamped_with_every_version(tmp_path):
+    async def scenario(engine):
+        await migrations.migrate(engine)
+        return await versions(engine), await user_columns(engine)
+
+    stamped, columns = run(tmp_path, scenario)
+    assert stamped == [number for number, _, _ in migrations.MIGRATIONS]
+    assert {"is_blocked", "referred_count", "paid_referrals_count", "pending_payouts_count"} <= set(columns)
+
+
+def test_migrate_is_idempotent(tmp_path):
+    async def scenario(engine):
+        await migrations.migrate(engine)
+        first = await versions(engine)
+        await migrations.migrate(engine)
+        await migrations.migrate(engine)
+        return first, await versions(engine)
+
+    first, again = run(tmp_path, scenario)
+    assert first == again
+
+
+def test_legacy_database_goes_through_every_step(tmp_path):
+    async def scenario(engine):
+        async with engine.begin() as conn:
+            await conn.execute(text(LEGACY_USERS))
+            await conn.execute(text("INSERT INTO users (id, is_ambassador) VALUES (1, TRUE);"))
+            await conn.execute(text(
+                "INSERT INTO users (id, referred_by_id, is_active_until, referral_payout_pending) VALUES "
+                "(2, 1, '2030-01-01 00:00:00', TRUE), (3, 1, '2030-01-01 00:00:00', FALSE), (4, 1, NULL, FALSE);"
+            ))
+        await migrations.migrate(engine)
+        async with engine.connect() as conn:
+            counters = (await conn.execute(text(
+                "SELECT referred_count, paid_referrals_count, pending_payouts_count, is_blocked FROM users WHERE id = 1;"
+            ))).one()
+            tables = {row[0] for row in (await conn.execute(text("SELECT name FROM sqlite_master WHERE type = 'table';")))}
+        return await versions(engine), counters, tables
+
+    stamped, counters, tables = run(tmp_path, scenario)
+    assert stamped == [number for number, _, _ in migrations.MIGRATIONS]
+    assert tuple(counters) == (3, 2, 1, 0)
+    assert {"sessions", "tasks", "quota_reservations", "analysis_results"} <= tables
+
+
+def test_legacy_database_migrated_twice_keeps_its_data(tmp_path):
+    async def scenario(engine):
+        async with engine.begin() as conn:
+            await conn.execute(text(LEGACY_USERS))
+            await conn.execute(text("INSERT INTO users (id, username) VALUES (1, 'kept');"))
+        await migrations.migrate(engine)
+        await migrations.migrate(engine)
+        async with engine.connect() as conn:
+            username = (await conn.execute(text("SELECT username FROM users WHERE id = 1;"))).scalar_one()
+        return await versions(engine), username
+
+    stamped, username = run(tmp_path, scenario)
+    assert stamped == [number for number, _, _ in migrations.MIGRATIONS]
+    assert username == "kept"
+
+
+def test_only_missing_steps_are_applied(tmp_path):
+    async def scenario(engine):
+        await migrations.migrate(engine)
+        async with engine.begin() as conn:
+            # Pretend the last step was released after this database was migrated
+            await conn.execute(text("DELETE FROM schema_version WHERE version = :v;"), {"v": migrations.LATEST_VERSION})
+        applied = []
+        original = migrations.MIGRATIONS
+        migrations.MIGRATIONS = [
+            (number, description, step if number != migrations.LATEST_VERSION else _recording(step, applied))
+            for number, description, step in original
+        ]
+        try:
+            await migrations.migrate(engine)
+        finally:
+            migrations.MIGRATIONS = original
+        return applied, await versions(engine)
+
+    applied, stamped = run(tmp_path, scenario)
+    assert applied == [migrations.LATEST_VERSION]
+    assert stamped == [number for number, _, _ in migrations.MIGRATIONS]
+
+
+def _recording(step, applied):
+    async def recorded(conn):
+        applied.append(migrations.LATEST_VERSION)
+        await step(conn)
+    return recorded
+
+
+def test_concurrent_migrations_of_a_legacy_database(tmp_path):
+    async def scenario(engine):
+        async with engine.begin() as conn:
+            await conn.execute(text(LEGACY_USERS))
+        # A second engine stands in for another process booting at the same time
+        other = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/migrations.db")
+        try:
+            results = await asyncio.gather(migrations.migrate(engine), migrations.migrate(other), return_exceptions=True)
+        finally:
+            await other.dispose()
+        return results, await versions(engine)
+
+    results, stamped = run(tmp_path, scenario)
+    assert results == [None, None]
+    assert stamped == [number for number, _, _ in migrations.MIGRATIONS]
+
+
+def test_connection_errors_are_not_taken_for_an_empty_database(tmp_path):
+    async def scenario(engine):
+        @event.listens_for(engine.sync_engine, "do_connect")
+        def refuse(dialect, connection_record, cargs, cparams):
+            raise sqlite3.OperationalError("unable to open database file")
+
+        # Must not read as "no version table yet", which sends migrate() down the DDL path
+        await migrations._fast_path_version(engine)
+
+    with pytest.raises(OperationalError, match="unable to open database file"):
+        run(tmp_path, scenario)
@@ -0,0 +1,131 @@
+import asyncio
+
+from core.pipeline import Pipeline, PipelineJob, Stage
+
+
+class Job(PipelineJob):
+    def __init__(self):
+        super().__init__()
+        self.stages = []
+
+
+def test_job_passes_every_stage_in_order():
+    async def scenario():
+        def stage(name):
+            async def handler(job):
+                job.stages.append(name)
+                return True
+            return Stage(name, handler, concurrency=2)
+
+        pipeline = Pipeline([stage("fetch"), stage("detect"), stage("report")])
+        job = Job()
+        await pipeline.run(job)
+        await pipeline.stop()
+        return job, pipeline
+
+    job, pipeline = asyncio.run(scenario())
+    assert job.stages == ["fetch", "detect", "report"]
+    assert [m["processed"] for m in pipeline.metrics()] == [1, 1, 1]
+
+
+def test_cancel_interrupts_running_stage_and_skips_the_rest():
+    async def scenario():
+        started = asyncio.Event()
+        reached_next = []
+
+        async def slow(job):
+            started.set()
+            await asyncio.sleep(10)
+            return True
+
+        async def following(job):
+            reached_next.append(job)
+            return True
+
+        pipeline = Pipeline([Stage("slow", slow, 1), Stage("next", following, 1)])
+        job = Job()
+        run = asyncio.create_task(pipeline.run(job))
+        await started.wait()
+        job.cancel()
+        await asyncio.wait_for(run, timeout=1)
+        await pipeline.stop()
+        return job, reached_next, pipeline
+
+    job, reached_next, pipeline = asyncio.run(scenario())
+    assert job.future.done()
+    assert reached_next == []
+    assert "slow" in job.timings
+    assert pipeline.metrics()[0]["failed"] == 0
+
+
+def test_cancelling_the_caller_cancels_the_job_and_frees_the_worker():
+    async def scenario():
+        started = asyncio.Event()
+        handled = []
+
+        async def slow(job):
+            handled.append(job)
+            started.set()
+            await asyncio.sleep(10 if len(handled) == 1 else 0)
+            return True
+
+        pipeline = Pipeline([Stage("slow", slow, 1)])
+        first = Job()
+        run = asyncio.create_task(pipeline.run(first))
+        await started.wait()
+        run.cancel()
+        await asyncio.gather(run, return_exceptions=True)
+
+        # The single worker must be free again for the next job
+        second = Job()
+        await asyncio.wait_for(pipeline.run(second), timeout=1)
+        await pipeline.stop()
+        return first, second, handled
+
+    first, second, handled = asyncio.run(scenario())
+    assert first.cancelled
+    assert handled == [first, second]
+
+
+def test_job_queued_after_cancel_is_not_handled():
+    async def scenario():
+        gate = asyncio.Event()
+        handled = []
+
+        async def blocking(job):
+            handled.append(job)
+            await gate.wait()
+            return True
+
+        pipeline = Pipeline([Stage("only", blocking, 1)])
+        first, second = Job(), Job()
+        runs = [asyncio.create_task(pipeline.run(first)), asyncio.create_task(pipeline.run(second))]
+        await asyncio.sleep(0)
+        second.cancel()  # Still waiting in the queue behind the first job
+        gate.set()
+        await asyncio.wait_for(asyncio.gather(*runs), timeout=1)
+        await pipeline.stop()
+        return first, handled
+
+    first, handled = asyncio.run(scenario())
+    assert handled == [first]
+
+
+def test_failing_handler_calls_error_hook_and_finishes_job():
+    async def scenario():
+        errors = []
+
+        async def broken(job):
+            raise ValueError("boom")
+
+        async def on_error(job, stage_name, error):
+            errors.append((stage_name, str(error)))
+
+        pipeline = Pipeline([Stage("broken", broken, 1)], on_error=on_error)
+        await asyncio.wait_for(pipeline.run(Job()), timeout=1)
+        await pipeline.stop()
+        return errors, pipeline
+
+    errors, pipeline = asyncio.run(scenario())
+    assert errors == [("broken", "boom")]
+    assert pipeline.metrics()[0]["failed"] == 1
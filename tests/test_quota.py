@@ -0,0 +1,146 @@
+import asyncio
+import itertools
+from datetime import datetime, timedelta, timezone
+
+import fakeredis
+
+import database
+from core import entitlements, redis_client
+from models import QuotaKind, QuotaReservation, User
+
+_user_ids = itertools.count(1000)
+
+
+def run(scenario):
+    """Runs a scenario on a fresh event loop with its own fake Redis and DB connections."""
+
+    async def wrapper():
+        redis_client._client = fakeredis.FakeAsyncRedis()
+        entitlements._local.clear()
+        try:
+            await database.create_db_and_tables()
+            return await scenario()
+        finally:
+            await database.engine.dispose()
+            redis_client._client = None
+
+    return asyncio.run(wrapper())
+
+
+async def new_user(analyses=0, messages=0) -> int:
+    user_id = next(_user_ids)
+    async with database.async_session() as session:
+        async with session.begin():
+            session.add(User(id=user_id, analyses_left=analyses, messages_left=messages))
+    return user_id
+
+
+async def balance(user_id: int) -> tuple:
+    async with database.async_session() as session:
+        user = await session.get(User, user_id)
+        return user.analyses_left, user.messages_left
+
+
+def test_reserve_takes_credits_until_the_balance_is_empty():
+    async def scenario():
+        user_id = await new_user(analyses=2)
+        reservations = [await database.reserve_quota(user_id, QuotaKind.ANALYSIS) for _ in range(3)]
+        return reservations, await balance(user_id)
+
+    reservations, left = run(scenario)
+    assert None not in reservations[:2] and reservations[2] is None
+    assert left == (0, 0)
+
+
+def test_concurrent_reservations_never_spend_a_credit_twice():
+    async def scenario():
+        user_id = await new_user(messages=3)
+        reservations = await asyncio.gather(*(database.reserve_quota(user_id, QuotaKind.MESSAGE) for _ in range(10)))
+        return reservations, await balance(user_id)
+
+    reservations, left = run(scenario)
+    granted = [r for r in reservations if r is not None]
+    assert len(granted) == 3 and len(set(granted)) == 3
+    assert left == (0, 0)
+
+
+def test_release_refunds_exactly_once():
+    async def scenario():
+        user_id = await new_user(analyses=1)
+        reservation_id = await database.reserve_quota(user_id, QuotaKind.ANALYSIS)
+        first = await database.release_quota(reservation_id)
+        second = await database.release_quota(reservation_id)
+        return first, second, await balance(user_id)
+
+    first, second, left = run(scenario)
+    assert (first, second) == (True, False)
+    assert left == (1, 0)
+
+
+def test_concurrent_releases_refund_once():
+    async def scenario():
+        user_id = await new_user(analyses=1)
+        reservation_id = await database.reserve_quota(user_id, QuotaKind.ANALYSIS)
+        results = await asyncio.gather(*(database.release_quota(reservation_id) for _ in range(5)))
+        return results, await balance(user_id)
+
+    results, left = run(scenario)
+    assert results.count(True) == 1
+    assert left == (1, 0)
+
+
+def test_committed_reservation_cannot_be_released():
+    async def scenario():
+        user_id = await new_user(analyses=1)
+        reservation_id = await database.reserve_quota(user_id, QuotaKind.ANALYSIS)
+        committed = await database.commit_quota(reservation_id)
+        released = await database.release_quota(reservation_id)
+        committed_again = await database.commit_quota(reservation_id)
+        return committed, released, committed_again, await balance(user_id)
+
+    committed, released, committed_again, left = run(scenario)
+    assert (committed, released, committed_again) == (True, False, False)
+    assert left == (0, 0)
+
+
+def test_stale_release_and_explicit_release_do_not_both_refund():
+    async def scenario():
+        user_id = await new_user(analyses=2)
+        stale_id = await database.reserve_quota(user_id, QuotaKind.ANALYSIS)
+        fresh_id = await database.reserve_quota(user_id, QuotaKind.ANALYSIS)
+        async with database.async_session() as session:
+            async with session.begin():
+                stale = await session.get(QuotaReservation, stale_id)
+                stale.created_at = datetime.now(timezone.utc) - timedelta(hours=2)
+        released = await database.release_stale_reservations(max_age_seconds=3600)
+        late_release = await database.release_quota(stale_id)
+        return released, late_release, await database.release_quota(fresh_id), await balance(user_id)
+
+    released, late_release, fresh_released, left = run(scenario)
+    assert released == 1
+    assert late_release is False
+    assert fresh_released is True
+    assert left == (2, 0)
+
+
+def test_cached_entitlement_follows_reserve_and_release():
+    async def cached_balance(user_id):
+        entitlement = await database.get_entitlement(user_id)
+        return entitlement.analyses_left, entitlement.messages_left
+
+    async def scenario():
+        user_id = await new_user(analyses=2, messages=1)
+        await database.get_entitlement(user_id)  # Warm the cache
+        reservation_id = await database.reserve_quota(user_id, QuotaKind.ANALYSIS)
+        await database.reserve_quota(user_id, QuotaKind.MESSAGE)
+        after_reserve = await cached_balance(user_id)
+        await database.release_quota(reservation_id)
+        after_release = await cached_balance(user_id)
+        # Without the local copy the entry comes from Redis, which must agree as well
+        entitlements._local.clear()
+        from_redis = await cached_balance(user_id)
+        return after_reserve, after_release, from_redis, await balance(user_id)
+
+    after_reserve, after_release, from_redis, left = run(scenario)
+    assert after_reserve == (1, 0)
+    assert after_release == from_redis == left == (2, 0)
@@ -0,0 +1,69 @@
+from core import retrieval
+from core.retrieval import KnowledgeIndex, PINNED_SECTIONS, Section, split_sections, tokenize
+
+KNOWLEDGE = """
+**Кожа:**
+Уход за кожей: ретинол на ночь, SPF утром. Кожа любит регулярность.
+
+**Челюсть:**
+Jawline и жевательная мышца: mastic gum, mewing.
+
+--- Осанка ---
+Осанка и шея: упражнения на спину.
+"""
+
+
+def test_split_sections_on_both_heading_styles():
+    sections = split_sections(KNOWLEDGE)
+    assert [s.title for s in sections] == ["Кожа", "Челюсть", "Осанка"]
+    assert sections[0].text.startswith("Кожа:\nУход за кожей")
+
+
+def test_tokenize_stems_inflections_and_drops_stopwords():
+    assert tokenize("кожа") == tokenize("кожи") == tokenize("кожей")
+    assert tokenize("и в на 2024") == []
+
+
+def test_bm25_ranks_the_matching_section_first():
+    index = KnowledgeIndex(split_sections(KNOWLEDGE))
+    assert [s.title for s in index.search("как улучшить кожу, нужен ли ретинол", k=3)] == ["Кожа"]
+    assert index.search("mewing для челюсти", k=1)[0].title == "Челюсть"
+
+
+def test_bm25_prefers_more_occurrences_and_shorter_sections():
+    index = KnowledgeIndex([
+        Section("once", "once:\nкожа " + "текст " * 30),
+        Section("often", "often:\nкожа кожа кожа " + "текст " * 30),
+        Section("short", "short:\nкожа кожа кожа"),
+    ])
+    assert [s.title for s in index.search("кожа", k=3)] == ["short", "often", "once"]
+
+
+def test_search_never_returns_sections_without_a_matching_term():
+    index = KnowledgeIndex(split_sections(KNOWLEDGE))
+    assert index.search("бюджет поездки", k=3) == []
+
+
+def test_search_skips_excluded_sections_but_still_fills_k():
+    index = KnowledgeIndex(split_sections(KNOWLEDGE))
+    found = index.search("кожа осанка челюсть", k=2, exclude=("Кожа",))
+    assert len(found) == 2
+    assert {s.title for s in found} == {"Челюсть", "Осанка"}
+
+
+def test_pinned_sections_exist_in_the_knowledge_base():
+    for title in PINNED_SECTIONS:
+        assert retrieval.index.get(title) is not None, title
+
+
+def test_metric_sections_exclude_the_pinned_ones():
+    weak = {"skin_score": 20, "acne": 10, "gonial_angle": 140, "beauty_avg": 30}
+    for metrics in (weak, {}):
+        sections = retrieval.sections_for_metrics(metrics, k=10)
+        assert sections
+        assert not {s.title for s in sections} & set(PINNED_SECTIONS)
+
+
+def test_weakest_metrics_orders_by_deviation():
+    metrics = {"skin_score": 70, "acne": 20, "canthal_tilt": 6, "gonial_angle": "n/a"}
+    assert retrieval.weakest_metrics(metrics) == ["acne", "skin_score"]